@@ -0,0 +1,78 @@
+"""
+Benchmarks of the pyg_mongo hot paths, writing JSON results so that runs can be compared over time.
+
+Against a local mongod (round trips are counted):
+
+    python benchmarks/bench.py --url mongodb://localhost:27017 -n 1000 --output results.json
+
+In-process against mongomock (useful for the python-side cost only):
+
+    python benchmarks/bench.py --mock
+"""
+from pyg_base import dictable, Dict
+from pyg_mongo import mongo_cursor, mongo_pk_cursor, q, Q
+from functools import reduce
+from common import parser, database, timed
+import datetime
+import platform
+import pymongo
+import json
+import sys
+
+
+def _cursors(db):
+    for name in ('plain', 'keyed', 'many'):
+        db.drop_collection(name)
+    db.client.drop_database('deleted_' + db.name)
+    keyed = mongo_pk_cursor(db['keyed'], pk = 'key')
+    keyed.create_index()
+    return mongo_cursor(db['plain']), keyed
+
+
+def benchmarks(db, n = 1000, mock = False):
+    """
+    runs the benchmarks, returning a list of results, each with the seconds taken, the time per operation and the round trips per operation
+    """
+    plain, keyed = _cursors(db)
+    many = mongo_cursor(db['many'])
+    keys = Q(['k%i'%i for i in range(n)])
+    docs = [dict(key = i, x = i % 10, y = float(i)) for i in range(n)]
+    cases = [('insert_one', n, lambda: [plain.insert_one(dict(doc)) for doc in docs]),
+             ('insert_one_pk', n, lambda: [keyed.insert_one(dict(doc)) for doc in docs]),
+             ('update_pk', n, lambda: [keyed.insert_one(dict(doc, y = -doc['y'])) for doc in docs]),
+             ('insert_many', n, lambda: many.insert_many(dictable(docs))),
+             ('insert_many_pk', n, lambda: keyed.insert_many(dictable(docs))),
+             ('read_one_pk', n, lambda: [keyed.read_one(key = i) for i in range(n)]),
+             ('iter', n, lambda: list(keyed)),
+             ('getitem_slice', n, lambda: keyed[::]),
+             ('set_static', n, lambda: keyed.set(z = 1)),
+             ('set_lambda', n, lambda: keyed.set(z = lambda x, y: x + y)),
+             ('dedup', n, lambda: (mongo_cursor(db['keyed']).insert_many(dictable(docs, pk = [['key']])), keyed.dedup())),
+             ('q_and_%i'%n, 1, lambda: q(*[q['k%i'%i] == i for i in range(n)])),
+             ('Q_reduce_%i'%n, 1, lambda: reduce(lambda a, b: a & b, [keys['k%i'%i] == i for i in range(n)])),
+            ]
+    res = []
+    for name, ops, case in cases:
+        _, seconds, trips = timed(case, mock = mock)
+        res.append(Dict(name = name, ops = ops, seconds = seconds, us_per_op = 1e6 * seconds / ops, 
+                        round_trips = trips, round_trips_per_op = None if trips is None else trips / ops))
+    db.client.drop_database(db.name)
+    db.client.drop_database('deleted_' + db.name)
+    return res
+
+
+def main(argv = None):
+    args = parser('benchmarks of pyg_mongo hot paths').parse_args(argv)
+    db = database(args.url, args.db, args.mock)
+    results = benchmarks(db, n = args.n, mock = args.mock)
+    print(dictable(results)[['name', 'ops', 'us_per_op', 'round_trips_per_op']])
+    if args.output:
+        meta = dict(time = datetime.datetime.now().isoformat(), python = platform.python_version(), pymongo = pymongo.version, 
+                    server = None if args.mock else db.client.server_info()['version'], mock = args.mock, n = args.n)
+        with open(args.output, 'w') as f:
+            json.dump(dict(meta = meta, results = [dict(r) for r in results]), f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,49 @@
+"""
+helpers shared by the benchmarks: connecting to a local mongod or to mongomock, timing and counting round trips
+"""
+from pyg_mongo import monitor
+import argparse
+import time
+
+
+def parser(description):
+    res = argparse.ArgumentParser(description = description)
+    res.add_argument('--url', default = 'mongodb://localhost:27017', help = 'a local mongod. The default is mongodb://localhost:27017')
+    res.add_argument('--mock', action = 'store_true', help = 'run in-process against mongomock rather than a server. Round trips are then not counted')
+    res.add_argument('--db', default = 'pyg_benchmarks', help = 'the database used, dropped at the end. The default is pyg_benchmarks')
+    res.add_argument('-n', type = int, default = 1000, help = 'the number of documents/operations per benchmark. The default is 1000')
+    res.add_argument('--output', default = None, help = 'the JSON file the results are written to')
+    return res
+
+
+def database(url = 'mongodb://localhost:27017', db = 'pyg_benchmarks', mock = False):
+    """
+    returns the benchmark database, on a local server or in mongomock
+    """
+    if mock:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(url, serverSelectionTimeoutMS = 5000)
+        client.admin.command('ping')
+    return client[db]
+
+
+def timed(function, mock = False):
+    """
+    runs function once, returning its result, the seconds taken and the number of commands sent to the server (None with mongomock, which sends none).
+    Commands are counted by the pyg_mongo command monitor, whose bookkeeping costs a few microseconds per call.
+    """
+    if not mock:
+        monitor.clear().enable()
+    t0 = time.perf_counter()
+    try:
+        res = function()
+    finally:
+        seconds = time.perf_counter() - t0
+        if not mock:
+            monitor.disable()
+    stats = monitor.stats()
+    trips = None if mock else sum(stats.commands) if len(stats) else 0
+    return res, seconds, trips
@@ -0,0 +1,81 @@
+"""
+Import-time benchmark: runs each statement in a fresh interpreter under `python -X importtime` and checks the total against a budget.
+
+    python benchmarks/importtime.py --output importtime.json
+
+`import pyg_mongo` alone resolves nothing (see pyg_mongo.__init__). The other statements are dominated by pyg_base, which imports pandas on import;
+the pyg_mongo column isolates the time spent in pyg_mongo's own modules.
+"""
+import argparse
+import subprocess
+import json
+import sys
+
+#: statement: budget in milliseconds for the whole import, None for unchecked
+default_budgets = {'import pyg_mongo' : 50,
+                   'from pyg_mongo import q' : None,
+                   'from pyg_mongo import mongo_table' : None}
+
+#: budget in milliseconds for the self time of pyg_mongo's own modules, per statement
+own_budget = 50
+
+
+def importtime(statement, python = sys.executable, env = None):
+    """
+    returns the modules a statement imports with their self and cumulative times in microseconds, in import order
+    """
+    res = subprocess.run([python, '-X', 'importtime', '-c', statement], capture_output = True, text = True, env = env, check = True)
+    rows = []
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        rows.append(dict(module = name.strip(), self_us = int(own), cumulative_us = int(cumulative)))
+    return rows
+
+
+def summary(statement, top = 5, **kwargs):
+    rows = importtime(statement, **kwargs)
+    total = sum(row['self_us'] for row in rows) / 1e3
+    own = sum(row['self_us'] for row in rows if row['module'].split('.')[0] == 'pyg_mongo') / 1e3
+    heaviest = sorted(rows, key = lambda row: -row['cumulative_us'])
+    packages = []
+    for row in heaviest:
+        package = row['module'].split('.')[0]
+        if package not in packages and package != 'pyg_mongo':
+            packages.append(package)
+    return dict(statement = statement, total_ms = total, pyg_mongo_ms = own, modules = len(rows), heaviest = packages[:top])
+
+
+def check_importtime(budgets = None, **kwargs):
+    """
+    runs the statements, raising an AssertionError if any is over budget
+    """
+    budgets = default_budgets if budgets is None else budgets
+    res = [summary(statement, **kwargs) for statement in budgets]
+    failed = ['%s: %.1fms (budget %sms), pyg_mongo %.1fms (budget %sms)'%(r['statement'], r['total_ms'], budgets[r['statement']], r['pyg_mongo_ms'], own_budget)
+              for r in res if (budgets[r['statement']] is not None and r['total_ms'] > budgets[r['statement']]) or r['pyg_mongo_ms'] > own_budget]
+    if failed:
+        raise AssertionError('import time over budget:\n' + '\n'.join(failed))
+    return res
+
+
+def main(argv = None):
+    args = argparse.ArgumentParser(description = 'import time of pyg_mongo')
+    args.add_argument('--output', default = None, help = 'the JSON file the results are written to')
+    args = args.parse_args(argv)
+    res = [summary(statement) for statement in default_budgets]
+    for r in res:
+        print('%-36s total %8.1fms  pyg_mongo %6.1fms  heaviest: %s'%(r['statement'], r['total_ms'], r['pyg_mongo_ms'], ', '.join(r['heaviest'])))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent = 2)
+    try:
+        check_importtime()
+    except AssertionError as e:
+        return str(e)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,137 @@
+"""
+Measures the latency the pyg_mongo layer adds on top of raw pymongo: each operation runs alongside its minimal pymongo equivalent against the same server,
+and the absolute (microseconds) and relative overheads are checked against budgets.
+
+    python benchmarks/overhead.py --url mongodb://localhost:27017 -n 200 --budget read_one=3 --budget find=50us
+
+Exits with an error if an operation exceeds its budget. The ratios are only meaningful against a server: with --mock, pymongo calls are in-process and nearly free.
+In tests:
+
+    >>> from overhead import check_overhead
+    >>> check_overhead(MongoClient()['pyg_overhead'], n = 100) ## a throwaway database
+"""
+from pyg_base import Dict, dictable
+from pyg_mongo import mongo_cursor, mongo_pk_cursor
+import time
+import json
+import sys
+
+#: op: (max ratio of pyg_mongo to pymongo time, max overhead in microseconds). None means unchecked.
+default_budgets = dict(find = (None, 200),             ## copying a cursor and building its _spec vs. building the filter dict
+                       write = (None, 500),            ## _write encoding of a small document vs. copying it
+                       read = (3, None),
+                       read_one = (4, None),           ## also counts matches to assert uniqueness
+                       count = (2, None),
+                       insert_one = (3, None),
+                       insert_one_pk = (6, None),      ## also archives the previous version to the deleted_ database
+                       scan = (5, None))               ## decodes every document
+
+
+def _drop(db):
+    db.client.drop_database(db.name)
+    db.client.drop_database('deleted_' + db.name)
+
+
+def _operations(db, n):
+    """
+    returns (op, pyg_mongo, pymongo) pairs of callables of an integer i, with their collections populated with n documents
+    """
+    _drop(db)
+    plain, raw_plain = mongo_cursor(db['plain']), db['plain']
+    keyed, raw = mongo_pk_cursor(db['keyed'], pk = 'key'), db['keyed']
+    keyed.create_index()
+    keyed.insert_many(dictable(key = list(range(n)), x = [i % 10 for i in range(n)]))
+    doc = dict(key = 1, x = 1, y = 'hello')
+    return [('find', lambda i: keyed.inc(key = i)._spec, lambda i: {'key' : i}),
+            ('write', lambda i: keyed._write(doc), lambda i: dict(doc)),
+            ('read', lambda i: keyed.inc(key = i % n)[0], lambda i: next(raw.find({'key' : i % n}))),
+            ('read_one', lambda i: keyed.read_one(key = i % n), lambda i: raw.find_one({'key' : i % n})),
+            ('count', lambda i: len(keyed.inc(x = i % 10)), lambda i: raw.count_documents({'x' : i % 10})),
+            ('insert_one', lambda i: plain.insert_one(dict(key = i, x = 1)), lambda i: raw_plain.insert_one(dict(key = i, x = 1))),
+            ('insert_one_pk', lambda i: keyed.insert_one(dict(key = i % n, x = i)), lambda i: raw.replace_one({'key' : i % n}, dict(key = i % n, x = i), upsert = True)),
+            ('scan', lambda i: keyed[::], lambda i: list(raw.find()))]
+
+
+def _per_op(function, repeat, start):
+    t0 = time.perf_counter()
+    for i in range(start, start + repeat):
+        function(i)
+    return (time.perf_counter() - t0) / repeat
+
+
+def overhead(db, n = 100, repeat = 50, rounds = 3, budgets = None):
+    """
+    times each operation and its pymongo equivalent, returning the best of rounds of the mean time per call
+
+    :Parameters:
+    ----------------
+    db : pymongo.database.Database
+        a throwaway database on a local server. It and its deleted_ history database are dropped before and after the run.
+    n : int
+        the number of documents in the table. The default is 100.
+    repeat : int
+        calls per round. Scans are repeated less. The default is 50.
+    budgets : dict, optional
+        op: (max ratio, max microseconds overhead), updating default_budgets.
+
+    :Returns:
+    -------
+    dictable
+        op, pyg_us, raw_us, overhead_us, ratio, budget_ratio, budget_us and ok
+    """
+    limits = dict(default_budgets)
+    limits.update(budgets or {})
+    rows = []
+    for op, pyg, raw in _operations(db, n):
+        calls = max(1, repeat // 10) if op == 'scan' else repeat
+        pyg(0); raw(0) ## warm up
+        pyg_s = raw_s = float('inf')
+        for r in range(rounds):
+            pyg_s = min(pyg_s, _per_op(pyg, calls, r * calls))
+            raw_s = min(raw_s, _per_op(raw, calls, r * calls))
+        ratio, us = limits.get(op, (None, None))
+        row = Dict(op = op, pyg_us = 1e6 * pyg_s, raw_us = 1e6 * raw_s, overhead_us = 1e6 * (pyg_s - raw_s), ratio = pyg_s / raw_s if raw_s else None,
+                   budget_ratio = ratio, budget_us = us)
+        row.ok = (ratio is None or row.ratio is None or row.ratio <= ratio) and (us is None or row.overhead_us <= us)
+        rows.append(row)
+    _drop(db)
+    return dictable(rows)
+
+
+def check_overhead(db, n = 100, repeat = 50, rounds = 3, budgets = None):
+    """
+    as overhead() but raises an AssertionError listing the operations over budget
+    """
+    res = overhead(db, n = n, repeat = repeat, rounds = rounds, budgets = budgets)
+    failed = res.inc(ok = False)
+    if len(failed):
+        raise AssertionError('pyg_mongo overhead over budget:\n%s'%failed[['op', 'pyg_us', 'raw_us', 'overhead_us', 'ratio', 'budget_ratio', 'budget_us']])
+    return res
+
+
+def _budget(text):
+    """
+    parses op=3 (a ratio) or op=50us (microseconds of overhead)
+    """
+    op, value = text.split('=')
+    return (op, (None, float(value[:-2]))) if value.endswith('us') else (op, (float(value), None))
+
+
+def main(argv = None):
+    from common import parser, database
+    args = parser('overhead of pyg_mongo over raw pymongo')
+    args.add_argument('--budget', action = 'append', default = [], type = _budget, help = 'op=ratio or op=<n>us, e.g. read_one=3 or find=50us')
+    args = args.parse_args(argv)
+    res = overhead(database(args.url, args.db, args.mock), n = args.n, budgets = dict(args.budget))
+    print(res)
+    if args.output and args.output.endswith('.csv'):
+        res.to_csv(args.output)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump([dict(row) for row in res], f, indent = 2)
+    failed = res.inc(ok = False)
+    return 'over budget: %s'%failed.op if len(failed) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
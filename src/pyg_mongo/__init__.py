@@ -1,8 +1,34 @@
 # -*- coding: utf-8 -*-
+"""
+The public names are resolved lazily (PEP 562): `import pyg_mongo` loads nothing heavy and each name imports only the modules it needs on first use,
+e.g. `from pyg_mongo import q` does not import pymongo.
+"""
+import importlib
 
-from pyg_mongo._q import Q, q, mdict
-from pyg_mongo._base_reader import mongo_base_reader
-from pyg_mongo._reader import mongo_reader
-from pyg_mongo._cursor import mongo_cursor, mongo_pk_cursor
-from pyg_mongo._cursor import mongo_cursor, mongo_pk_cursor
-from pyg_mongo._table import mongo_table
+_exports = dict(Q = '_q', q = '_q', mdict = '_q',
+                q_match = '_match', q_mask = '_match', q_filter = '_match',
+                mongo_base_reader = '_base_reader',
+                doc_cache = '_cache', single_flight = '_cache',
+                disk_cache = '_disk_cache',
+                mongo_monitor = '_monitor', monitor = '_monitor',
+                index_advisor = '_advisor', advisor = '_advisor',
+                decode_profiler = '_profiler', profiler = '_profiler',
+                mongo_reader = '_reader',
+                mongo_pipeline = '_pipeline',
+                mongo_cursor = '_cursor', mongo_pk_cursor = '_cursor',
+                mongo_table = '_table', mongo_cfg = '_table')
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError('module %r has no attribute %r'%(__name__, name))
+    value = getattr(importlib.import_module('%s.%s'%(__name__, module)), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
@@ -0,0 +1,214 @@
+from pyg_base import Dict, dictable, logger
+from pyg_mongo._q import _id, _and, _eq, _in
+import threading
+
+__all__ = ['index_advisor', 'advisor']
+
+_equalities = (_eq, _in)
+
+
+def _query_shape(spec, sort = None):
+    """
+    returns the shape of a query: the fields matched by equality, the sort keys and the fields matched by range (or by any other operator), ignoring the values.
+    Conditions inside $or/$nor are ignored as a compound index cannot serve them.
+
+    :Example:
+    ---------
+    >>> assert _query_shape(q(a = 1, b = [1,2], c = {'$gt': 3}), [('d', -1)]) == (('a', 'b'), (('d', -1),), ('c',))
+    """
+    equality, ranges = set(), set()
+    conditions = list((spec or {}).items())
+    while conditions:
+        field, value = conditions.pop(0)
+        if field == _and:
+            for condition in value:
+                conditions.extend(condition.items())
+        elif field.startswith('$'):
+            continue
+        elif isinstance(value, dict) and any(op.startswith('$') for op in value):
+            if all(op in _equalities for op in value):
+                equality.add(field)
+            else:
+                ranges.add(field)
+        else:
+            equality.add(field)
+    sort = tuple((key, direction) for key, direction in (sort or []))
+    sorted_keys = set(key for key, _ in sort)
+    return tuple(sorted(equality)), sort, tuple(sorted(ranges - equality - sorted_keys))
+
+
+def _esr(shape):
+    """
+    the index keys for a query shape under the ESR rule: equality fields first, then the sort keys, then the range fields
+    """
+    equality, sort, ranges = shape
+    keys = [(field, 1) for field in equality]
+    keys += [(field, direction) for field, direction in sort if field not in equality]
+    keys += [(field, 1) for field in ranges]
+    return keys
+
+
+def _serves(index, shape):
+    """
+    True if an existing index (a list of (field, direction)) supports a query of this shape without a blocking sort or a scan of unrelated keys:
+    the equality fields (in any order), then the sort keys (all in the same or all in the reversed direction), then the range fields (in any order)
+    """
+    equality, sort, ranges = shape
+    fields = [field for field, _ in index]
+    n = len(equality)
+    if set(fields[:n]) != set(equality):
+        return False
+    sort = [(field, direction) for field, direction in sort if field not in equality]
+    head = [(field, 1 if direction > 0 else -1) for field, direction in index[n: n + len(sort)] if not isinstance(direction, str)]
+    if sort and head != sort and head != [(field, -direction) for field, direction in sort]:
+        return False
+    m = n + len(sort)
+    return set(fields[m: m + len(ranges)]) == set(ranges)
+
+
+class index_advisor(object):
+    """
+    Records the shapes of the queries issued through mongo_reader (the fields matched by equality or by range and the sort keys) and proposes
+    compound indexes, following the ESR (equality, sort, range) rule, for the shapes that no existing index serves.
+
+    Recording is opt-in and costs a walk of the spec per query.
+
+    :Example:
+    ---------
+    >>> from pyg_mongo import advisor
+    >>> advisor.enable()
+    >>> t = mongo_table('test', 'test')
+    >>> t.inc(q.x > 1, name = 'a').sort('-date')[::]
+    >>> advisor.advise()
+       table    |index                                 |queries|shapes
+       test.test|[('name', 1), ('date', -1), ('x', 1)] |1      |1
+    >>> advisor.apply() ## creates the index
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.clear()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def clear(self):
+        with self._lock:
+            self._shapes = {}
+            self._collections = {}
+        return self
+
+    def record(self, cursor):
+        """
+        records the shape of the cursor's query
+        """
+        shape = _query_shape(cursor._spec, cursor._sort)
+        if not any(shape) or shape == ((_id,), (), ()):
+            return
+        name = cursor.collection.full_name
+        key = (name, shape)
+        with self._lock:
+            self._collections[name] = cursor.collection
+            stats = self._shapes.get(key)
+            if stats is None:
+                self._shapes[key] = Dict(queries = 1, cursor = cursor)
+            else:
+                stats.queries += 1
+                stats.cursor = cursor
+
+    def shapes(self, table = None):
+        """
+        returns a dictable of the recorded query shapes, per table (db.collection)
+        """
+        with self._lock:
+            items = list(self._shapes.items())
+        return dictable([Dict(table = name, equality = list(shape[0]), sort = list(shape[1]), range = list(shape[2]), queries = stats.queries)
+                         for (name, shape), stats in items if table is None or name == table])
+
+    def advise(self, table = None, min_queries = 1, explain = False):
+        """
+        proposes indexes for the recorded query shapes that no existing index serves.
+        A proposal whose keys are a prefix of another's is merged into it.
+
+        :Parameters:
+        ----------------
+        table : str, optional
+            the full name (db.collection) of a table. The default is None, all tables.
+        min_queries : int
+            propose an index only if the queries it serves number at least min_queries. The default is 1.
+        explain : bool
+            explain the last query of each shape, adding the plan and the documents examined vs returned. The default is False.
+
+        :Returns:
+        -------
+        dictable
+            with columns table, index (the keys), queries, shapes (and plan, docs_examined and returned if explain)
+        """
+        with self._lock:
+            items = [(key, Dict(stats)) for key, stats in self._shapes.items() if table is None or key[0] == table]
+        indexes = {}
+        proposals = {}
+        for (name, shape), stats in items:
+            if name not in indexes:
+                indexes[name] = [info['key'] for info in self._collections[name].index_information().values()]
+            if any(_serves(index, shape) for index in indexes[name]):
+                continue
+            keys = tuple(_esr(shape))
+            proposal = proposals.setdefault((name, keys), Dict(table = name, index = list(keys), queries = 0, shapes = 0, cursors = []))
+            proposal.queries += stats.queries
+            proposal.shapes += 1
+            proposal.cursors.append(stats.cursor)
+        for (name, keys), proposal in sorted(proposals.items(), key = lambda item: len(item[0][1])):
+            longer = [other for (n, k), other in proposals.items() if n == name and len(k) > len(keys) and k[:len(keys)] == keys]
+            if longer:
+                longer[0].queries += proposal.queries
+                longer[0].shapes += proposal.shapes
+                longer[0].cursors.extend(proposal.cursors)
+                proposal.shapes = 0
+        res = []
+        for proposal in proposals.values():
+            if not proposal.shapes or proposal.queries < min_queries:
+                continue
+            cursors = proposal.pop('cursors')
+            if explain:
+                try:
+                    summary = cursors[-1].explain()
+                    proposal.update(plan = summary.plan, docs_examined = summary.docs_examined, returned = summary.returned)
+                except Exception as e:
+                    logger.info('INFO: could not explain a query on %s: %s'%(proposal.table, e))
+                    proposal.update(plan = None, docs_examined = None, returned = None)
+            res.append(proposal)
+        return dictable(sorted(res, key = lambda proposal: -proposal.queries))
+
+    def apply(self, table = None, min_queries = 1, wait = False):
+        """
+        creates the proposed indexes, see advise(). Index builds do not block reads and writes on the server.
+
+        :Parameters:
+        ----------------
+        wait : bool
+            If False (the default), the indexes are created in a background thread, which is returned. Otherwise returns the names of the indexes created.
+        """
+        proposals = [(self._collections[proposal.table], proposal.index) for proposal in self.advise(table = table, min_queries = min_queries)]
+        def create():
+            names = []
+            for collection, keys in proposals:
+                logger.info('INFO: creating index %s on %s'%(keys, collection.full_name))
+                names.append(collection.create_index(keys, background = True))
+            return names
+        if wait:
+            return create()
+        thread = threading.Thread(target = create, daemon = True)
+        thread.start()
+        return thread
+
+    def __repr__(self):
+        return 'index_advisor(enabled = %s)\n%s'%(self.enabled, self.shapes())
+
+
+advisor = index_advisor()
@@ -1,8 +1,18 @@
-from pyg_base import is_dict, as_list, ulist, cache, is_strs, Dict, sort
-
-from pyg_mongo._q import q, _id
+from pyg_base import is_dict, is_str, as_list, ulist, cache, is_strs, sort, dictable, logger
+
+from pyg_mongo._q import q, _id, _updated, _q_key, _canonical
+from pyg_mongo._cache import _invalidate
+from pyg_mongo._chunked import _find, _specs
+from pyg_mongo._monitor import monitored, _explain_summary
+from pyg_mongo._advisor import advisor
+from pyg_mongo._profiler import profiler
 from pyg_encoders import as_reader, as_writer, decode
 from bson import ObjectId
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import ReadPreference, Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.read_concern import ReadConcern
+import datetime
+import hashlib
 
 _root = 'root'
 _pk = 'pk'
@@ -47,8 +57,78 @@ def _pkq(pk):
     else:
         return q[_pk] == [pk]
 
-_empty_crsr = Dict(collection = None, spec = None, projection = None, sorter = None, reader = None, writer = None, pk = None)
+@cache
+def _pk_template(pk, keys):
+    """
+    Returns a compiled query for documents with primary keys pk, matching on the keys present
+    
+    :Example:
+    ---------
+    >>> assert _pk_template(('key',), ('key',))(key = 1) == q(_pkq(['key']), key = 1)
+    """
+    return q.compile(*keys, _pkq(list(pk)))
+
+
+@cache
+def _kwargs_template(keys):
+    return q.compile(*keys)
+
+
+_client_keys = {} ## id(client) : the url and options mongo_table opened it with, see _table._client
+
+
+def _client_key(client):
+    """
+    identifies a client by the url and options it was opened with (by mongo_table), without contacting the server.
+    Clients opened otherwise are identified by the object itself, so their key is not stable across processes.
+    """
+    res = _client_keys.get(id(client))
+    if res is None:
+        return ('client', id(client))
+    return res
+
+
+_read_preferences = dict(primary = Primary, primarypreferred = PrimaryPreferred, secondary = Secondary, secondarypreferred = SecondaryPreferred, nearest = Nearest)
+
+def _read_preference(read_preference = None, tags = None, max_staleness = -1):
+    """
+    converts a read preference name (primary, primaryPreferred, secondary, secondaryPreferred or nearest), with optional tag sets and maximum staleness (in seconds), into a pymongo read preference
+
+    :Example:
+    ---------
+    >>> assert _read_preference('secondaryPreferred', tags = dict(dc = 'ny'), max_staleness = 120) == SecondaryPreferred([dict(dc = 'ny')], 120)
+    >>> assert _read_preference('primary') == ReadPreference.PRIMARY
+    """
+    if read_preference is None or not is_str(read_preference):
+        return read_preference
+    mode = _read_preferences.get(read_preference.replace('_', '').lower())
+    if mode is None:
+        raise ValueError('unknown read preference %s, use one of %s'%(read_preference, list(_read_preferences)))
+    if mode is Primary:
+        if tags or max_staleness != -1:
+            raise ValueError('primary read preference does not accept tags or max_staleness')
+        return ReadPreference.PRIMARY
+    return mode(tag_sets = [tags] if is_dict(tags) else tags, max_staleness = max_staleness)
+
+
+def _read_concern(read_concern = None):
+    """
+    converts a read concern level (local, available, majority, linearizable or snapshot) into a pymongo ReadConcern
+    """
+    return ReadConcern(read_concern) if is_str(read_concern) else read_concern
+
+
 _attrs = ['collection', 'projection', 'sorter', 'reader', 'writer', 'pk']
+_state_attrs = ('collection', 'spec', 'projection', 'sorter', 'pk')
+_derived = {'_pk_' : ('pk',), ## the cached values of a cursor and the attributes they depend on
+            '_spec_' : ('spec', 'pk'),
+            '_projection_' : ('projection',),
+            '_sort_' : ('sorter',),
+            '_state_' : _state_attrs,
+            '_fingerprint' : _state_attrs}
+_invalidated = {attr : tuple(key for key, attrs in _derived.items() if attr in attrs) for attr in _state_attrs}
+_slots = ('collection', 'spec', 'projection', 'sorter', 'reader', 'writer', 'pk')
+_cached = tuple(_derived) + ('_primary_',) ## slots holding computed values, None until computed
 
 class mongo_base_reader(object):
     """
@@ -65,21 +145,97 @@ class mongo_base_reader(object):
     mongo_cursor     mongo_pk_cursor       mongo_async_cursor     mongo_async_pk_cursor
                      
                 
+    The cursor attributes, and the values derived from them, live in slots and subclasses declare __slots__ = () too. 
+    __dict__ is kept for ad-hoc attributes only and is not created unless one is set.
+    Chaining (find, inc, sort, project...) never modifies a cursor but returns a new one.
+    The derived _spec, _pk, _projection and _sort are computed once and shared by chained cursors that leave their inputs unchanged.
     """
+    __slots__ = _slots + _cached + ('__dict__',)
+
     def __init__(self, collection, spec = None, projection = None, sorter = None, reader = None, writer = None, pk = None):
+        init = object.__setattr__ ## a new cursor has nothing cached to invalidate
+        for key in _cached:
+            init(self, key, None)
         if isinstance(collection, mongo_base_reader):
             crsr = collection
-            collection = crsr.collection
-        else: 
-            crsr = _empty_crsr 
-        self.collection = collection 
-        self.spec = crsr.spec if spec is None else spec
-        self.projection = crsr.projection if projection is None else projection
-        self.sorter  = crsr.sorter  if sorter   is None else sorter
-        self.reader  = crsr.reader  if reader   is None else reader
-        self.writer  = crsr.writer  if writer   is None else writer 
-        self.pk      = crsr.pk      if pk       is None else pk
-        self.pk = self._pk
+            init(self, 'collection', crsr.collection)
+            init(self, 'spec', crsr.spec if spec is None else spec)
+            init(self, 'projection', crsr.projection if projection is None else projection)
+            init(self, 'sorter', crsr.sorter  if sorter   is None else sorter)
+            init(self, 'reader', crsr.reader  if reader   is None else reader)
+            init(self, 'writer', crsr.writer  if writer   is None else writer)
+            init(self, 'pk', crsr.pk      if pk       is None else pk)
+            self._share(crsr)
+        else:
+            init(self, 'collection', collection)
+            init(self, 'spec', spec)
+            init(self, 'projection', projection)
+            init(self, 'sorter', sorter)
+            init(self, 'reader', reader)
+            init(self, 'writer', writer)
+            init(self, 'pk', pk)
+        init(self, 'pk', self._pk)
+
+    def _share(self, other):
+        """
+        reuses the values other has computed for _spec, _pk, _projection, _sort and _state if they depend only on attributes the two cursors share
+        """
+        same = None
+        for key, attrs in _derived.items():
+            value = getattr(other, key)
+            if value is None:
+                continue
+            if same is None:
+                same = {attr : getattr(self, attr) is getattr(other, attr) for attr in _state_attrs}
+                same['pk'] = same['pk'] or self.pk == other.pk
+            if all(same[attr] for attr in attrs):
+                object.__setattr__(self, key, value)
+        return self
+
+    def __setattr__(self, attr, value):
+        if attr in _invalidated:
+            for key in _invalidated[attr]:
+                object.__setattr__(self, key, None)
+        if attr in _slots:
+            object.__setattr__(self, '_primary_', None) ## the primary copy shares all the attributes
+        object.__setattr__(self, attr, value)
+
+    @property
+    def _state(self):
+        """
+        A hashable, canonical form of what the cursor points to: (client, collection, read preference, read concern, spec, projection, sort, pk).
+        Cursors reading from different replica-set members (or with different read concerns) differ, so their cached results are never shared.
+        Semantically identical queries, e.g. $and of the same conditions in a different order, have the same state.
+        It is computed once and reset when any of these attributes is set.
+        """
+        res = self._state_
+        if res is None:
+            collection = self.collection
+            preference = collection.read_preference
+            res = (_client_key(collection.database.client), collection.full_name, 
+                                              (preference.mongos_mode, repr(preference.tag_sets), preference.max_staleness), collection.read_concern.level,
+                                              _q_key(self._spec), _canonical(self._projection), tuple(self._sort or ()), tuple(self._pk))
+            object.__setattr__(self, '_state_', res)
+        return res
+
+    @property
+    def fingerprint(self):
+        """
+        :Returns:
+        ---------
+        str
+            A stable (across processes) hash of the cursor state, for use as a key of result caches
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test')
+        >>> assert t.inc(a = 1, b = 2).fingerprint == t.inc(b = 2).inc(a = 1).fingerprint
+        """
+        res = self._fingerprint
+        if res is None:
+            res = hashlib.sha1(repr(self._state).encode()).hexdigest()
+            object.__setattr__(self, '_fingerprint', res)
+        return res
 
     def _callargs(self, **kwargs):
         spec = kwargs.pop('spec', None)
@@ -93,12 +249,12 @@ class mongo_base_reader(object):
 
     def __call__(self, **kwargs):
         callargs = self._callargs(**kwargs)
-        return type(self)(**callargs)
+        return type(self)(**callargs)._share(self)
 
     def find(self, *args, **kwargs):
-        res = self.copy()
-        res.spec = q(self.spec, *args, **kwargs)
-        return res
+        if kwargs:
+            args = args + (_kwargs_template(tuple(sorted(kwargs)))(**kwargs),)
+        return type(self)(self, spec = q(self.spec, *args))
     
     inc = find
     
@@ -108,6 +264,61 @@ class mongo_base_reader(object):
     def project(self, projection = None):
         return self(projection = projection)
 
+    def read_from(self, read_preference = None, tags = None, max_staleness = -1, read_concern = None):
+        """
+        returns a cursor reading from other replica-set members (e.g. secondaries, to scale out reads that can tolerate lag) or with another read concern.
+        Writes are unaffected: they go to the primary and the reads a write depends on use the primary too.
+
+        :Parameters:
+        ----------------
+        read_preference : str or a pymongo read preference, optional
+            primary, primaryPreferred, secondary, secondaryPreferred or nearest. The default is None, keeping the current read preference (with tags and max_staleness if given).
+        tags : dict/list of dicts, optional
+            tag sets of the members to read from, e.g. dict(dc = 'ny'), in order of preference
+        max_staleness : int
+            the maximum replication lag, in seconds (90 or more), of a member read from. The default is -1, no maximum.
+        read_concern : str, optional
+            local, available, majority, linearizable or snapshot. The default is None, keeping the current read concern.
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test', mode = 'r')
+        >>> t.read_from('nearest', tags = dict(dc = 'ny'), max_staleness = 120).inc(name = 'a')[::]
+        >>> t.read_from(read_concern = 'majority') ## still reading from the primary
+        """
+        if read_preference is None and (tags or max_staleness != -1): ## the current mode, updating its tags or max_staleness
+            current = self.collection.read_preference
+            read_preference = current.mongos_mode
+            tags = tags or ([tag for tag in current.tag_sets if tag] or None)
+            max_staleness = current.max_staleness if max_staleness == -1 else max_staleness
+        collection = self.collection.with_options(read_preference = _read_preference(read_preference, tags, max_staleness), 
+                                                  read_concern = _read_concern(read_concern))
+        return self(collection = collection)
+
+    def consistent(self):
+        """
+        returns a cursor reading from the primary with a local read concern: it sees the writes made through this client (read-your-writes),
+        overriding the read preference of a table opened with e.g. read_preference = 'secondaryPreferred'
+        """
+        collection = self.collection
+        if collection.read_preference.mode == ReadPreference.PRIMARY.mode and collection.read_concern.level in (None, 'local'):
+            return self
+        return self(collection = collection.with_options(read_preference = ReadPreference.PRIMARY, read_concern = ReadConcern('local')))
+
+    def _primary(self):
+        """
+        the cursor, reading from the primary. Writers read from it so that existence checks and history see the latest data.
+        The copy is kept until an attribute of the cursor is set.
+        """
+        res = self._primary_
+        if res is None:
+            collection = self.collection
+            if collection.read_preference.mode == ReadPreference.PRIMARY.mode:
+                return self
+            res = self(collection = collection.with_options(read_preference = ReadPreference.PRIMARY))
+            object.__setattr__(self, '_primary_', res)
+        return res
+
     @property
     def _ids(self):
         return [_id]
@@ -140,30 +351,128 @@ class mongo_base_reader(object):
 
     @property
     def _spec(self):
-        return q(self.spec, _pkq(self._pk))
+        res = self._spec_
+        if res is None:
+            res = q(self.spec, _pkq(self._pk))
+            object.__setattr__(self, '_spec_', res)
+        return res
 
     @property
     def _projection(self):
-        return _dict1(self.projection)
+        res = self._projection_
+        if res is None and self.projection is not None:
+            res = _dict1(self.projection)
+            object.__setattr__(self, '_projection_', res)
+        return res
 
     @property
     def _sort(self):
-        return list(_dict1(self.sorter).items()) if self.sorter else None
+        res = self._sort_
+        if res is None and self.sorter:
+            res = list(_dict1(self.sorter).items())
+            object.__setattr__(self, '_sort_', res)
+        return res
     
     @property
     def _pk(self):
-        return ulist(sorted(set(as_list(self.pk))))
+        res = self._pk_
+        if res is None:
+            res = ulist(sorted(set(as_list(self.pk))))
+            object.__setattr__(self, '_pk_', res)
+        return res
 
     def distinct(self, key):
         """
-        returns the distinct cursor values of the key        
+        returns the distinct cursor values of the key. 
+        If the values are too many for the distinct command (its result is capped at 16MB), they are computed by aggregation instead, see iter_distinct.
         """
-        res = self.cursor.distinct(key)
+        try:
+            res = self.cursor.distinct(key)
+        except OperationFailure as e:
+            logger.info('INFO: distinct %s failed (%s), using aggregation'%(key, e))
+            return list(self.iter_distinct(key))
         try:
             return sort(res)
         except TypeError:
             return res
 
+    def _distinct_pipeline(self, key, counts = False):
+        """
+        As with the distinct command, null values are kept while missing fields and empty arrays are not: 
+        $unwind keeps nulls (and removes the field of an empty array), the $match that follows drops the latter.
+        """
+        path = '$%s'%key
+        group = {_id : path, 'count' : {'$sum' : 1}} if counts else {_id : path}
+        return [{'$match' : q(self._spec, q[key].exists)},
+                {'$unwind' : {'path' : path, 'preserveNullAndEmptyArrays' : True}}, 
+                {'$match' : q[key].exists},
+                {'$group' : group}, 
+                {'$sort' : {_id : 1}}]
+
+    def iter_distinct(self, key):
+        """
+        streams the distinct values of the key, computed by a $group aggregation and sorted on the server (in BSON order).
+        Unlike distinct, the number of values is not limited by the 16MB document cap.
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test')
+        >>> for name in t.iter_distinct('name'):
+        >>>     print(name)
+        """
+        for doc in self.collection.aggregate(self._distinct_pipeline(key), allowDiskUse = True):
+            yield doc[_id]
+
+    @monitored
+    def distinct_counts(self, key):
+        """
+        returns the distinct values of the key and the number of documents with each value, in one round trip.
+        As with distinct, a document counts once for each element of an array value.
+
+        :Returns:
+        ---------
+        dictable
+            with columns key and count, sorted by key
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test')
+        >>> t.insert_many(dictable(name = ['a', 'b', 'a']))
+        >>> assert t.distinct_counts('name') == dictable(name = ['a', 'b'], count = [2, 1])
+        """
+        docs = list(self.collection.aggregate(self._distinct_pipeline(key, counts = True), allowDiskUse = True))
+        return dictable({key : [doc[_id] for doc in docs], 'count' : [doc['count'] for doc in docs]})
+
+    @monitored
+    def explain(self, verbosity = 'executionStats', raw = False):
+        """
+        explains how the server runs the cursor's query.
+
+        :Parameters:
+        ----------
+        verbosity : str, optional
+            'queryPlanner', 'executionStats' or 'allPlansExecution'. The default is 'executionStats', which runs the query.
+        raw : bool, optional
+            return the server's response rather than a summary. The default is False.
+
+        :Returns:
+        -------
+        Dict
+            plan (e.g. 'COLLSCAN' or 'FETCH/IXSCAN'), collscan, indexes, returned, docs_examined, keys_examined and millis
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test')
+        >>> assert t.inc(q.name == re.compile('^a')).explain().collscan ## no index on name
+        """
+        command = dict(find = self.collection.name, filter = _specs(self._spec)[0])
+        if self._projection:
+            command['projection'] = self._projection
+        if self._sort:
+            command['sort'] = dict(self._sort)
+        res = self.collection.database.command('explain', command, verbosity = verbosity)
+        return res if raw else _explain_summary(res)
+
     def _is_deleted(self):
         return self.collection.database.name.startswith('deleted_')
 
@@ -171,19 +480,17 @@ class mongo_base_reader(object):
     def deleted(self):
         if self._is_deleted():
             return self.distinct('deleted')
-        collection_name = self.collection.name
-        db = self.collection.database
-        db_name = db.name
-        collection = db.client['deleted_' + db_name][collection_name]
+        c = self.collection
+        db = c.database
+        collection = db.client['deleted_' + db.name][c.name].with_options(codec_options = c.codec_options, read_preference = c.read_preference, 
+                                                                          write_concern = c.write_concern, read_concern = c.read_concern) ## history is read and written like the table
         return type(self)(collection, spec = self.spec, projection = self.projection, sorter = self.sorter, reader = self.reader, writer = self.writer, pk = self.pk) 
 
     @property
     def cursor(self):
-        res = self.collection.find(self._spec, self._projection)
-        sorter = self.sorter
-        if sorter:
-            res = res.sort(self._sort)
-        return res
+        if advisor.enabled:
+            advisor.record(self)
+        return _find(self.collection, self._spec, self._projection, self._sort)
 
     @property
     def address(self):
@@ -204,8 +511,10 @@ class mongo_base_reader(object):
         """
         converts doc from Mongo into something we want
         """
-        res = doc
         reader = self._reader(reader)
+        if profiler.enabled:
+            return profiler.read(self, doc, reader)
+        res = doc
         for r in as_list(reader):
             res = res[r] if is_strs(r) else r(res)
         return res
@@ -222,14 +531,17 @@ class mongo_base_reader(object):
     def _write(self, doc, writer = None):
         res = doc.copy()
         writer = self._writer(writer, doc)
-        for w in as_list(writer):
-            res = w(res)
+        if profiler.enabled:
+            res = profiler.write(self, res, writer)
+        else:
+            for w in as_list(writer):
+                res = w(res)
         pk = self._pk
         missing = set(pk) - set(doc.keys())
         if len(missing):
             raise ValueError('trying to write a document with missing primary keys %s'%missing)
         if pk:
-            res.update({_pk: pk})
+            res.update({_pk: pk, _updated: datetime.datetime.now()})
         return res
 
     def _id(self, doc):
@@ -237,11 +549,19 @@ class mongo_base_reader(object):
             return q[_id] == decode(doc[_id])
         elif self.pk:
             pk = self._pk
-            return q(q[_pk] == [pk], **{key : doc[key] for key in pk if key in doc})
+            values = {key : doc[key] for key in pk if key in doc}
+            return _pk_template(tuple(pk), tuple(values))(**values)
         else:
             return doc
 
 
+    def _invalidate(self):
+        """
+        called after every write, clearing any cached results for the collection
+        """
+        _invalidate(self.collection)
+        return self
+
     def __repr__(self):
         return '%(t)s for %(c)s \nfilter: %(s)s projection: %(p)s sorted: %(r)s'%dict(t = type(self), 
                                                                                       c = self.collection, 
@@ -255,9 +575,7 @@ class mongo_base_reader(object):
     clone = copy
     
     def __eq__(self, other):
-        return type(other) == type(self) and self.reader == other.reader and self.writer == other.writer \
-            and self.collection == other.collection and self.spec == other.spec and self.projection == other.projection \
-            and self.sorter == other.sorter
+        return type(other) == type(self) and self.reader == other.reader and self.writer == other.writer and self._state == other._state
 
     @property
     def reset(self):
@@ -0,0 +1,228 @@
+from pyg_base import get_cache, Dict
+from collections import OrderedDict
+from bson import encode as bson_encode, ObjectId
+import threading
+import datetime
+import time
+import copy
+
+__all__ = ['doc_cache', 'single_flight']
+
+_doc_caches = get_cache('mongo_doc_cache')
+_result_caches = get_cache('mongo_result_cache')
+_flights = get_cache('mongo_single_flight')
+_immutable = (str, int, float, bytes, type(None), datetime.date, datetime.time, datetime.timedelta, ObjectId)
+
+
+def _copy(value):
+    """
+    a copy of a cached value that the caller may mutate without changing the cache: dicts and lists are copied recursively, scalars are shared
+    and anything else (DataFrames, arrays...) is deep-copied.
+
+    :Example:
+    ---------
+    >>> doc = dict(a = [1, dict(b = 2)], ts = pd.Series([1,2]))
+    >>> res = _copy(doc)
+    >>> res['a'][1]['b'] = 3; res['ts'][0] = 0
+    >>> assert doc['a'][1]['b'] == 2 and doc['ts'][0] == 1
+    """
+    if isinstance(value, _immutable):
+        return value
+    elif isinstance(value, dict):
+        res = copy.copy(value)
+        for key, v in value.items():
+            res[key] = _copy(v)
+        return res
+    elif type(value) is list:
+        return [_copy(v) for v in value]
+    elif type(value) is tuple:
+        return tuple(_copy(v) for v in value)
+    return copy.deepcopy(value)
+
+
+class doc_cache(object):
+    """
+    A process-local LRU cache of decoded documents, keyed by (collection name, _id, version).
+    The version is the '_updated' timestamp that _write stamps on primary-keyed documents, so a rewritten document is never served stale.
+    Documents without a version rely on write-invalidation and on the ttl.
+
+    :Parameters:
+    ----------------
+    entries : int
+        maximum number of documents held. The default is 1000.
+    nbytes : int, optional
+        maximum approximate size (of the raw BSON) of the documents held. The default is None, unbounded.
+    ttl : float, optional
+        number of seconds an entry is valid for. The default is None, valid until evicted or invalidated.
+    revalidate: bool
+        If True, a read first runs a cheap query projected on _id and version. The full document is only fetched and decoded on a miss.
+        If False, the full document is fetched and only the decoding is saved.
+
+    :Example:
+    ---------
+    >>> t = mongo_table('test', 'test', pk = 'key').use_cache(entries = 100, revalidate = True)
+    >>> t.insert_one(dict(key = 1, data = pd.Series([1,2,3])))
+    >>> doc = t.read_one(key = 1) ## miss: fetched and decoded
+    >>> doc = t.read_one(key = 1) ## hit: only a projected _id/version query is issued
+    >>> assert t.caches[0].stats.hits == 1
+    >>> t.insert_one(dict(key = 1, data = pd.Series([4,5,6]))) ## invalidates
+    """
+    def __init__(self, entries = 1000, nbytes = None, ttl = None, revalidate = False):
+        self.entries = entries
+        self.nbytes = nbytes
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self._docs = OrderedDict()
+        self._names = {} ## collection name -> the keys cached for it, so invalidating a collection does not scan the whole cache
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self, name = None):
+        """
+        clears the cache, or just the entries of a collection
+        """
+        with self._lock:
+            if name is None:
+                self._docs.clear()
+                self._names.clear()
+                self._nbytes = 0
+                self.hits = self.misses = self.evictions = 0
+            else:
+                for key in list(self._names.get(name, ())):
+                    self._pop(key)
+        return self
+
+    def invalidate(self, name):
+        """
+        called on writes to collection name
+        """
+        return self.clear(name)
+
+    def _pop(self, key):
+        doc, n, t = self._docs.pop(key)
+        self._nbytes -= n
+        keys = self._names[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._names[key[0]]
+        return doc
+
+    def get(self, key):
+        """
+        returns a copy of the cached document, or None if key is not cached. The copy is deep so the caller may mutate it.
+        """
+        with self._lock:
+            if key not in self._docs:
+                self.misses += 1
+                return None
+            doc, n, t = self._docs[key]
+            if self.ttl is not None and time.time() - t > self.ttl:
+                self._pop(key)
+                self.misses += 1
+                return None
+            self._docs.move_to_end(key)
+            self.hits += 1
+            return _copy(doc)
+
+    def put(self, key, doc, raw = None):
+        """
+        caches a decoded document. raw is the document as stored in Mongo and is only used to estimate size.
+        """
+        n = len(bson_encode(raw)) if self.nbytes is not None and raw is not None else 0
+        with self._lock:
+            if key in self._docs:
+                self._pop(key)
+            self._docs[key] = (doc, n, time.time())
+            self._names.setdefault(key[0], set()).add(key)
+            self._nbytes += n
+            while len(self._docs) > self.entries or (self.nbytes is not None and self._nbytes > self.nbytes and len(self._docs) > 1):
+                self._pop(next(iter(self._docs)))
+                self.evictions += 1
+        return _copy(doc)
+
+    @property
+    def stats(self):
+        return Dict(hits = self.hits, misses = self.misses, evictions = self.evictions, entries = len(self._docs), nbytes = self._nbytes)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __repr__(self):
+        return 'doc_cache(entries = %s, nbytes = %s, ttl = %s, revalidate = %s) %s'%(self.entries, self.nbytes, self.ttl, self.revalidate, dict(self.stats))
+
+
+class _call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class single_flight(object):
+    """
+    Coalesces concurrent identical calls: the first caller (the leader) runs the call, others with the same key wait for it and share its result.
+    Followers receive a (deep) copy of the result, so they may mutate it. 
+    A write to the collection starts a new generation of keys so that a read issued after a write never shares a call issued before it.
+
+    :Example:
+    ---------
+    >>> t = mongo_table('test', 'test', pk = 'key').use_single_flight()
+    >>> with ThreadPoolExecutor(32) as pool:
+    >>>     docs = list(pool.map(lambda _: t.read_one(key = 1), range(100)))
+    >>> t.flight.stats ## {'calls': 100, 'coalesced': ..., 'in_flight': 0}
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.generation = 0
+        self.calls = self.coalesced = 0
+
+    def __call__(self, key, calc):
+        key = (self.generation, key)
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _call()
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                call.result = calc()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+            return call.result
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return _copy(call.result)
+
+    def invalidate(self, name = None):
+        with self._lock:
+            self.generation += 1
+        return self
+
+    @property
+    def stats(self):
+        return Dict(calls = self.calls, coalesced = self.coalesced, in_flight = len(self._calls))
+
+    def __repr__(self):
+        return 'single_flight %s'%dict(self.stats)
+
+
+def _invalidate(collection):
+    """
+    clears cached documents and count/distinct results of a collection. Called by mongo_cursor on every write.
+    """
+    for cache in _doc_caches.get(collection, []):
+        cache.invalidate(collection.full_name)
+    for registry in (_result_caches, _flights):
+        cache = registry.get(collection)
+        if cache is not None:
+            cache.invalidate(collection.full_name)
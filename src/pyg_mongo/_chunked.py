@@ -0,0 +1,328 @@
+from pyg_mongo._q import mdict, _id, _and, _in, _or, _nor, _type
+from bson import ObjectId, Decimal128, Timestamp, Regex, MinKey, MaxKey, encode as bson_encode
+import datetime
+import re
+import itertools
+import heapq
+
+_max_in = 100000 ## the most values of an $in list sent in a single query
+_max_in_bytes = 8 * 1024 * 1024 ## the largest encoded $in list sent in a single query, leaving room for the rest of the query under the 16MB BSON limit
+_min_in_check = 1000 ## shorter $in lists are not encoded to check their size
+_pattern = re.compile('')
+
+
+def _in_size(values):
+    try:
+        return len(bson_encode({_in : values}))
+    except Exception: ## values bson cannot encode: the server would reject them anyway
+        return 0
+
+
+def _chunks(values, size, nbytes):
+    """
+    splits values into lists of at most size values, each encoding to at most nbytes (or a single value)
+    """
+    total = _in_size(values)
+    if len(values) <= size and total <= nbytes:
+        return [values]
+    step = max(1, min(size, len(values) * nbytes // max(total, 1)))
+    res = []
+    for j in range(0, len(values), step):
+        chunk = values[j: j + step]
+        if len(chunk) > 1 and _in_size(chunk) > nbytes:
+            res.extend(_chunks(chunk, size, nbytes))
+        else:
+            res.append(chunk)
+    return res
+
+
+def _split(spec, size = None, nbytes = None):
+    """
+    returns (field, specs) if spec has a top-level {field: {'$in': values}} condition too large for a single query (see _chunk_specs), otherwise None
+    """
+    size = size or _max_in
+    nbytes = nbytes or _max_in_bytes
+    if not spec:
+        return None
+    conditions = spec[_and] if len(spec) == 1 and _and in spec else [spec]
+    best = None
+    for i, condition in enumerate(conditions):
+        if len(condition) != 1:
+            continue
+        field, value = next(iter(condition.items()))
+        if field.startswith('$') or not isinstance(value, dict) or len(value) != 1 or not isinstance(value.get(_in), list):
+            continue
+        values = value[_in]
+        if best is not None and len(values) <= len(best[2]):
+            continue
+        if len(values) > size or (len(values) > _min_in_check and _in_size(values) > nbytes):
+            best = (i, field, values)
+    if best is None:
+        return None
+    i, field, values = best
+    others = conditions[:i] + conditions[i+1:]
+    chunks = [mdict({field : {_in : chunk}}) for chunk in _chunks(_unique(values), size, nbytes)]
+    return field, [mdict({_and : others + [chunk]}) if others else chunk for chunk in chunks]
+
+
+def _unique(values):
+    """
+    drops repeated values of an $in list so a document with a scalar field matches a single chunk
+    """
+    seen = set()
+    res = []
+    for value in values:
+        try:
+            key = (type(value) is bool, value)
+            if key in seen:
+                continue
+            seen.add(key)
+        except TypeError:
+            pass
+        res.append(value)
+    return res
+
+
+def _chunk_specs(spec, size = None, nbytes = None):
+    """
+    If spec has a top-level condition {field: {'$in': values}} with more than size values, or whose values encode to more than nbytes, 
+    splits it into queries whose union is spec. Otherwise returns None.
+
+    :Example:
+    ---------
+    >>> spec = q(q.a == list(range(250000)), b = 1)
+    >>> specs = _chunk_specs(spec)
+    >>> assert len(specs) == 3 and specs[0] == {'$and': [{'b': {'$eq': 1}}, {'a': {'$in': list(range(100000))}}]}
+    """
+    res = _split(spec, size, nbytes)
+    return None if res is None else res[1]
+
+
+def _specs(spec):
+    """
+    the queries to run instead of spec
+    """
+    return _chunk_specs(spec) or [spec]
+
+
+def _find(collection, spec, projection = None, sort = None):
+    """
+    collection.find(spec, projection, sort = sort), transparently chunking oversized $in lists
+    """
+    res = _split(spec)
+    if res is None:
+        return collection.find(spec, projection, sort = sort)
+    field, specs = res
+    return chunked_cursor(collection, specs, projection, sort, field = field)
+
+
+def _count(collection, spec):
+    res = _split(spec)
+    if res is None:
+        return collection.count_documents(spec)
+    field, specs = res
+    return chunked_cursor(collection, specs, field = field).count()
+
+
+def _in_values(spec, field):
+    """
+    the $in values of field in a chunk spec
+    """
+    conditions = spec[_and] if len(spec) == 1 and _and in spec else [spec]
+    for condition in conditions:
+        if field in condition and isinstance(condition[field], dict):
+            return condition[field].get(_in, [])
+    return []
+
+
+def _get(doc, key):
+    """
+    the value of a (dotted) key sorted on. Arrays are refused: MongoDB sorts on their smallest (or largest) element, which merging cannot reproduce
+    """
+    for k in key.split('.'):
+        if isinstance(doc, list):
+            raise ValueError('cannot merge documents sorted on %s: it holds arrays'%key)
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(k)
+    if isinstance(doc, (list, tuple)):
+        raise ValueError('cannot merge documents sorted on %s: it holds arrays'%key)
+    return doc
+
+
+def _number(value):
+    """
+    numbers compare by value across int, float, Int64 and Decimal128, with NaN below all numbers
+    """
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+        return (-1, 0) if value.is_nan() else (0, value)
+    return (-1, 0) if value != value else (0, value)
+
+
+def _rank(value, key = None):
+    """
+    a key sorting scalar values as BSON does: MinKey < null < numbers < strings < binary < ObjectId < bool < date < timestamp < regex < MaxKey.
+    Strings compare by code point, i.e. the binary collation. Embedded documents are refused, their order depends on field order and types.
+    """
+    if isinstance(value, MinKey):
+        return (0,)
+    elif value is None:
+        return (1,)
+    elif isinstance(value, bool):
+        return (8, value)
+    elif isinstance(value, (int, float, Decimal128)):
+        return (2, _number(value))
+    elif isinstance(value, str):
+        return (3, value)
+    elif isinstance(value, bytes):
+        return (6, len(value), getattr(value, 'subtype', 0), bytes(value))
+    elif isinstance(value, ObjectId):
+        return (7, value.binary)
+    elif isinstance(value, datetime.datetime):
+        return (9, value)
+    elif isinstance(value, Timestamp):
+        return (10, value.time, value.inc)
+    elif isinstance(value, (Regex, type(_pattern))):
+        return (11, value.pattern, value.flags)
+    elif isinstance(value, MaxKey):
+        return (12,)
+    raise ValueError('cannot merge documents sorted on %s: it holds %s values'%(key, type(value).__name__))
+
+
+class _desc(object):
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _sort_key(sort):
+    def key(doc):
+        return tuple(_rank(_get(doc, k), k) if direction > 0 else _desc(_rank(_get(doc, k), k)) for k, direction in sort)
+    return key
+
+
+def _with_keys(projection, keys):
+    """
+    makes sure keys are returned by the projection, returning the keys added so they can be removed later
+    """
+    if not projection:
+        return projection, []
+    projection = dict(projection)
+    extra = []
+    inclusion = any(value for key, value in projection.items() if key != _id)
+    for key in keys:
+        if key == _id or not inclusion:
+            if key in projection and not projection[key]:
+                del projection[key]
+                extra.append(key)
+        elif key not in projection:
+            projection[key] = 1
+            extra.append(key)
+    return projection or None, extra
+
+
+class chunked_cursor(object):
+    """
+    A minimal pymongo.Cursor look-alike running several queries whose union is the original query.
+    Documents are merged in sort order (if sorted) and de-duplicated by _id, e.g. a document with an array field may match several chunks.
+    field is the field whose $in list was split, if known, so documents that can only match a single chunk are counted on the server.
+    """
+    def __init__(self, collection, specs, projection = None, sort = None, field = None):
+        self.collection = collection
+        self.specs = specs
+        self.projection = projection
+        self.sorter = sort
+        self.field = field
+        self._skip = 0
+        self._limit = None
+        self._iter = None
+
+    def sort(self, sort):
+        self.sorter = sort
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n or None ## as in pymongo, a limit of 0 is no limit
+        return self
+
+    def _docs(self):
+        sort = self.sorter or []
+        projection, extra = _with_keys(self.projection, [_id] + [key for key, _ in sort])
+        cursors = [self.collection.find(spec, projection, sort = self.sorter) for spec in self.specs]
+        docs = heapq.merge(*cursors, key = _sort_key(sort)) if sort else itertools.chain(*cursors)
+        seen = set()
+        for doc in docs:
+            i = doc[_id]
+            if i in seen:
+                continue
+            seen.add(i)
+            for key in extra:
+                doc.pop(key, None)
+            yield doc
+
+    def __iter__(self):
+        if self._iter is None:
+            self._iter = itertools.islice(self._docs(), self._skip, None if self._limit is None else self._skip + self._limit)
+        return self._iter
+
+    def next(self):
+        return next(iter(self))
+
+    __next__ = next
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step is not None:
+                raise IndexError('cursor does not support slice steps')
+            self._skip = item.start or 0
+            self._limit = None if item.stop is None else max(item.stop - self._skip, 0)
+            return self
+        res = chunked_cursor(self.collection, self.specs, self.projection, self.sorter, self.field).skip(item).limit(1)
+        for doc in res:
+            return doc
+        raise IndexError('no such item for cursor instance')
+
+    def distinct(self, key):
+        res = []
+        hashed = set()
+        for spec in self.specs:
+            for value in self.collection.distinct(key, spec):
+                try:
+                    if value in hashed:
+                        continue
+                    hashed.add(value)
+                except TypeError:
+                    if value in res:
+                        continue
+                res.append(value)
+        return res
+
+    def _ids(self, specs):
+        """
+        the _id of the documents matching any of specs, streamed rather than returned by a single (16MB limited) distinct
+        """
+        return set(doc[_id] for spec in specs for doc in self.collection.find(spec, {_id : 1}))
+
+    def count(self):
+        """
+        The chunks split the values of a field, so a document whose field is not an array (and not inside one) matches a single chunk: these are counted on the server.
+        Only documents with arrays along the field path, which may match several chunks, are de-duplicated by _id.
+        """
+        if self.field is None or any(isinstance(value, (Regex, type(_pattern))) for spec in self.specs for value in _in_values(spec, self.field)):
+            return len(self._ids(self.specs))
+        keys = self.field.split('.')
+        arrays = [{'.'.join(keys[:i]) : {_type : 'array'}} for i in range(1, len(keys) + 1)]
+        scalar = sum(self.collection.count_documents(mdict({_and : [spec, {_nor : arrays}]})) for spec in self.specs)
+        return scalar + len(self._ids([mdict({_and : [spec, {_or : arrays}]}) for spec in self.specs]))
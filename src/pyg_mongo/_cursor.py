@@ -1,14 +1,32 @@
 
 from pyg_base import logger, passthru, tree_update, dictable
 from pyg_base import zipper, is_strs, is_dict, Dict, is_dictable, is_int, as_list, ulist
-from pyg_mongo._q import q, _set, _id, _unset, _rename, _deleted, _data
+from pyg_mongo._q import q, _set, _id, _unset, _rename, _deleted, _data, _updated
 from pyg_mongo._reader import mongo_reader
 from pyg_mongo._base_reader import _pk, _dict1
+from pyg_mongo._chunked import _find, _specs, _count
+from pyg_mongo._monitor import monitored
+from functools import wraps
 import datetime
 
 
 __all__ = ['mongo_cursor', 'mongo_pk_cursor']
 
+_batch = 10000
+
+
+def _on_primary(method):
+    """
+    runs a writer method on the cursor reading from the primary, so the reads a write depends on (existence checks, documents moved to history) never see a lagging secondary.
+    The cursor itself is returned if the method returns the primary one.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        primary = self._primary()
+        res = method(primary, *args, **kwargs)
+        return self if res is primary else res
+    return wrapper
+
 class mongo_cursor(mongo_reader):
     """
     mongo_cursor is a souped-up combination of mongo.Cursor and mongo.Collection with a simple API.
@@ -102,6 +120,10 @@ class mongo_cursor(mongo_reader):
     
     
     """
+    __slots__ = ()
+
+    @monitored
+    @_on_primary
     def delete_many(self, *args, **kwargs):
         """
         Equivalent to drop: deletes all documents the cursor currently points to.
@@ -115,14 +137,18 @@ class mongo_cursor(mongo_reader):
         itself
         """
         target = self.inc(*args, **kwargs)
-        n = target.count()
+        n = _count(target.collection, target._spec) ## not cached: never skip a delete on a stale count
         spec = target._spec
         logger.info('INFO: deleting %i documents from %s.%s based on %s'%(n, self.collection.database.name, self.collection.name, spec))
         if n:
-            target.collection.delete_many(spec)
+            for s in _specs(spec):
+                target.collection.delete_many(s)
+            target._invalidate()
         return self
 
         
+    @monitored
+    @_on_primary
     def delete_one(self, *args, **kwargs):
         """
         drops a specific record after verifying exactly one exists.
@@ -139,19 +165,146 @@ class mongo_cursor(mongo_reader):
         """
         c = self.find_one(*args, **kwargs)
         c.collection.delete_one(c._spec)
+        c._invalidate()
         return self
 
+    @monitored
+    @_on_primary
     def drop(self, *args, **kwargs):
         res = self.delete_many(*args, **kwargs)
         if not self._is_deleted():
             target = self.deleted.inc(*args, **kwargs)
-            n = target.count()
+            n = _count(target.collection, target._spec)
             if n:
                 spec = target._spec
                 logger.info('INFO: deleting %i documents from %s.%s based on %s'%(n, target.collection.database.name, target.collection.name, spec))
-                target.collection.delete_many(spec)
+                for s in _specs(spec):
+                    target.collection.delete_many(s)
+                target._invalidate()
         return res
-    
+
+    def _history(self):
+        """
+        returns the deleted_ cursor holding the history of the current cursor, raising if we are already looking at history
+        """
+        if self._is_deleted():
+            raise ValueError('%s is already a deleted_ history collection'%self.collection.full_name)
+        return self.deleted
+
+    @monitored
+    def expire(self, seconds = None):
+        """
+        Sets a TTL (time-to-live) index on the 'deleted' timestamp of the history collection.
+        MongoDB will then remove history documents once they have been deleted for more than seconds.
+
+        :Note:
+        ------
+        'deleted' is stamped using datetime.datetime.now() which is local time while MongoDB TTL assumes UTC.
+        Expiry may therefore be out by your UTC offset.
+
+        :Parameters:
+        ----------
+        seconds : int/float/None
+            expiry in seconds. If None, the TTL index is dropped and history is kept forever.
+
+        :Returns:
+        -------
+        itself
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test', pk = 'key')
+        >>> t.expire(86400 * 30) ## keep 30 days of history
+        >>> assert t.deleted.collection.index_information()['deleted_1']['expireAfterSeconds'] == 86400 * 30
+        """
+        history = self._history().collection
+        keys = [(_deleted, 1)]
+        existing = {name : info for name, info in history.index_information().items() if info['key'] == keys}
+        if seconds is None:
+            for name in existing:
+                history.drop_index(name)
+        elif existing:
+            info = list(existing.values())[0]
+            if info.get('expireAfterSeconds') != int(seconds):
+                history.database.command('collMod', history.name, index = dict(keyPattern = dict(keys), expireAfterSeconds = int(seconds)))
+        else:
+            history.create_index(keys, expireAfterSeconds = int(seconds))
+        return self
+
+    @monitored
+    @_on_primary
+    def compact(self, versions = 1):
+        """
+        Keeps only the latest versions of each document in the history collection, removing older versions.
+        This runs as a single aggregation, grouping the history by primary keys and sorting by 'deleted'.
+
+        :Parameters:
+        ----------
+        versions : int
+            number of historic versions to keep per primary key. The default is 1. Use 0 to remove all history of the cursor.
+
+        :Returns:
+        -------
+        itself
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test', pk = 'key')
+        >>> for i in range(5):
+        >>>     t.insert_one(dict(key = 1, value = i))
+        >>> assert len(t.deleted) == 4
+        >>> t.compact(2)
+        >>> assert t.deleted.value == [2, 3]
+        """
+        pk = self._pk
+        if not pk:
+            raise ValueError('compacting history requires primary keys')
+        history = self._history()
+        pipeline = [{'$match' : history._spec},
+                    {'$sort' : {_deleted : -1}},
+                    {'$group' : {_id : {key : '$%s'%key for key in pk}, 'ids' : {'$push' : '$_id'}}},
+                    {'$match' : {'ids.%i'%versions : {'$exists' : True}}},
+                    {'$project' : {'ids' : {'$slice' : ['$ids', versions, {'$size' : '$ids'}]}}},
+                    {'$unwind' : '$ids'}]
+        ids = [doc['ids'] for doc in history.collection.aggregate(pipeline, allowDiskUse = True)]
+        logger.info('INFO: compacting %i documents from %s.%s'%(len(ids), history.collection.database.name, history.collection.name))
+        for i in range(0, len(ids), _batch):
+            history.collection.delete_many({_id : {'$in' : ids[i: i + _batch]}})
+        history._invalidate()
+        return self
+
+    @monitored
+    def retain(self, versions = None, seconds = None):
+        """
+        Applies a retention policy to the deleted_ history collection:
+
+        - indexes the history on primary keys and 'deleted' so that history lookups by key are fast
+        - if seconds is provided, sets a TTL index, see expire()
+        - if versions is provided, keeps only the latest versions per primary key, see compact()
+
+        :Parameters:
+        ----------
+        versions : int, optional
+            number of historic versions to keep per primary key. The default is None, keeping all.
+        seconds : int, optional
+            number of seconds to keep history for. The default is None, keeping history forever.
+
+        :Returns:
+        -------
+        itself
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test', pk = ['name', 'surname'])
+        >>> t.retain(versions = 10, seconds = 86400 * 365)
+        """
+        self._history().create_index(*self._pk, '-' + _deleted)
+        if seconds is not None:
+            self.expire(seconds)
+        if versions is not None:
+            self.compact(versions)
+        return self
+
     def _update_one(self, doc):
         """
         Uses the doc to find the existing document matching the doc. Then updates it. Throws an exception if no document found
@@ -164,8 +317,11 @@ class mongo_cursor(mongo_reader):
         c = self.find_one(doc = update)
         update.pop(_id, None)
         self.collection.update_one(c._spec, {_set: update})
+        self._invalidate()
         return c[0]
     
+    @monitored
+    @_on_primary
     def update_one(self, doc, upsert = True):
         """
         - updates a document if an _id is present in doc.
@@ -189,6 +345,8 @@ class mongo_cursor(mongo_reader):
         else:
             return self._update_one(doc)
     
+    @monitored
+    @_on_primary
     def update_many(self, doc, upsert  = False):
         """
         updates all documents in current cursor based on the doc. The two are equivalent:
@@ -206,13 +364,17 @@ class mongo_cursor(mongo_reader):
         """
         update = self._write(doc)
         update.pop(_id, None)
-        self.collection.update_many(self._spec, {_set : update})
+        for spec in _specs(self._spec):
+            self.collection.update_many(spec, {_set : update})
+        self._invalidate()
         return self
     
     def __setitem__(self, key, value):
         update = dict(zipper(key, value))
         self.set(**update)
     
+    @monitored
+    @_on_primary
     def set(self, **kwargs):
         """
         updates all documents in current cursor based on the kwargs. 
@@ -251,22 +413,42 @@ class mongo_cursor(mongo_reader):
                 self.update_one(doc)
         return self
 
+    def _stamped(self, update):
+        """
+        adds a fresh _updated stamp to an update of documents of a pk table, as _write does, so since() sees the change
+        """
+        if self._pk:
+            return dict(update, **{_set : {_updated : datetime.datetime.now()}})
+        return update
+
+    @monitored
+    @_on_primary
     def rename(self, **kwargs):
-        self.collection.update_many(self._spec, {_rename : kwargs})
+        for spec in _specs(self._spec):
+            self.collection.update_many(spec, self._stamped({_rename : kwargs}))
+        self._invalidate()
         return self
     
+    @_on_primary
     def __delitem__(self, item):
         if isinstance(item, int):
             self.collection.delete_one({_id : self[item][_id]})
+            self._invalidate()
         elif is_strs(item):
-            self.collection.update_many(self._spec, {_unset: _dict1(item)})
+            for spec in _specs(self._spec):
+                self.collection.update_many(spec, self._stamped({_unset: _dict1(item)}))
+            self._invalidate()
         elif is_dict(item):
             self.find(item).delete_one()
     
+    @monitored
+    @_on_primary
     def delete(self, item):
         del self[item]
         return self
     
+    @monitored
+    @_on_primary
     def insert_one(self, doc):
         """
         inserts/updates a single document. 
@@ -311,8 +493,11 @@ class mongo_cursor(mongo_reader):
             res = doc.copy()
             new = self._write(doc)
             res[_id] = self.collection.insert_one(new).inserted_id
+            self._invalidate()
             return res
 
+    @monitored
+    @_on_primary
     def insert_many(self, table):
         """
         inserts multiple documents into the collection
@@ -367,6 +552,7 @@ class mongo_cursor(mongo_reader):
         for doc in with_ids:
             spec = {_id: doc.pop(_id)}
             self.collection.update_one(spec, {_set: doc})
+        self._invalidate()
         return self
 
     def __add__(self, item):
@@ -380,7 +566,7 @@ class mongo_cursor(mongo_reader):
     def __call__(self, **kwargs):
         callargs = self._callargs(**kwargs)
         obj = mongo_cursor if not callargs.get(_pk) else mongo_pk_cursor
-        return obj(**callargs)
+        return obj(**callargs)._share(self)
         
 
 class mongo_pk_cursor(mongo_cursor):
@@ -389,16 +575,24 @@ class mongo_pk_cursor(mongo_cursor):
     for insertion though, the two are VERY different
     
     """
+    __slots__ = ()
+
+    @monitored
+    @_on_primary
     def delete_one(self, doc = {}):
         return self.find_one(doc).delete_many()
     
+    @monitored
+    @_on_primary
     def delete_many(self):
-        n = len(self)
+        n = _count(self.collection, self._spec)
         if n>0 and not self._is_deleted():
-            self.collection.update_many(q(self._spec, q.deleted.not_exists), {_set : dict(deleted = datetime.datetime.now())})
-            docs = [doc for doc in self.collection.find(self._spec)]
+            for spec in _specs(q(self._spec, q.deleted.not_exists)):
+                self.collection.update_many(spec, {_set : dict(deleted = datetime.datetime.now())})
+            docs = [doc for doc in _find(self.collection, self._spec)]
             ids = [doc[_id] for doc in docs]
-            self.deleted.collection.delete_many(q(_id = ids))
+            for spec in _specs(q(_id = ids)):
+                self.deleted.collection.delete_many(spec)
             self.deleted.collection.insert_many(docs)
         return super(mongo_pk_cursor, self).delete_many()
     
@@ -408,10 +602,11 @@ class mongo_pk_cursor(mongo_cursor):
     def _pk(self):
         if not self.pk:
             raise ValueError('a mongo_pk_cursor must have some primary keys')
-        res = ulist(sorted(set(as_list(self.pk))))
-        return res
+        return super(mongo_pk_cursor, self)._pk
             
 
+    @monitored
+    @_on_primary
     def insert_one(self, doc):
         """
         marks the old document as deleted and inserts the new one.
@@ -438,6 +633,7 @@ class mongo_pk_cursor(mongo_cursor):
             unset = _dict1(list(old))
             c.collection.update_one({_id : i}, {_unset: unset})
             c.collection.update_one({_id : i}, {_set: new})
+            c._invalidate()
             new[_id] = i
             if not self._is_deleted():
                 old[_deleted] = datetime.datetime.now()
@@ -447,6 +643,7 @@ class mongo_pk_cursor(mongo_cursor):
             if len(missing_keys)>0:
                 raise ValueError('cannot save a new doc with primary keys %s missing'%missing_keys)
             new[_id] = self.collection.insert_one(new).inserted_id
+            self._invalidate()
         return new[_id]
 
         
@@ -457,18 +654,22 @@ class mongo_pk_cursor(mongo_cursor):
         old = self.read(0, reader = passthru)
         if old is None:
             new[_id] = self.collection.insert_one(new).inserted_id
+            self._invalidate()
         else:
             i = old.pop(_id)
             new = tree_update(old, new)
             unset = _dict1(list(old))
             self.collection.update_one({_id : i}, {_unset: unset})
             self.collection.update_one({_id : i}, {_set: new})            
+            self._invalidate()
             new[_id] = i
             if not self._is_deleted():
                 old[_deleted] = datetime.datetime.now()
                 self.deleted.collection.insert_one(old)
         return new
     
+    @monitored
+    @_on_primary
     def update_one(self, doc, upsert = True):
         """
         updates an existing document
@@ -502,8 +703,11 @@ class mongo_pk_cursor(mongo_cursor):
         elif upsert:
             new = c._write(doc)
             new[_id] = c.collection.insert_one(self._write(new)).inserted_id
+            c._invalidate()
             return new ## always returns the encoded cell rather than the original
             
+    @monitored
+    @_on_primary
     def update_many(self, update, upsert = True):
         return type(update)([self.update_one(doc, upsert = upsert) for doc in update])
 
@@ -517,6 +721,7 @@ class mongo_pk_cursor(mongo_cursor):
     
 
 
+    @_on_primary
     def __delitem__(self, item):            
         if is_int(item):
             self.delete_one(self[item])
@@ -526,18 +731,25 @@ class mongo_pk_cursor(mongo_cursor):
             if len(cannot_drop) > 0:
                 raise ValueError('cannot drop primary keys %s'%cannot_drop)
             deleted = datetime.datetime.now()
-            for doc in self:
-                del doc[_id]
-                doc.update({_deleted: deleted})
-                self.collection.insert_one(self._write(doc))
-            self.collection.update_many(self._spec, {_unset: _dict1(item)})
+            if not self._is_deleted():
+                for doc in self:
+                    del doc[_id]
+                    doc.update({_deleted: deleted})
+                    self.deleted.collection.insert_one(self._write(doc))
+            for spec in _specs(self._spec):
+                self.collection.update_many(spec, self._stamped({_unset: _dict1(item)}))
+            self._invalidate()
         elif isinstance(item, dict):
             self.delete_one(item)
 
+    @monitored
+    @_on_primary
     def delete(self, item):
         del self[item]
         return self
 
+    @monitored
+    @_on_primary
     def insert_many(self, table):
         for doc in table:
             self.insert_one(doc)
@@ -552,6 +764,8 @@ class mongo_pk_cursor(mongo_cursor):
             raise ValueError('can only add a dict, a dictable or a list of dicts')
         return self
 
+    @monitored
+    @_on_primary
     def set(self, **kwargs):
         rows = [row for row in self]
         for row in rows:
@@ -0,0 +1,180 @@
+from pyg_base import Dict, mkdir
+import hashlib
+import pickle
+import struct
+import mmap
+import os
+import threading
+
+__all__ = ['disk_cache']
+
+_header = struct.Struct('<QI')
+_align = 64
+_suffix = '.pyg'
+
+
+def _dump(path, doc):
+    """
+    pickles doc into path using protocol 5: the large buffers (numpy arrays, pandas blocks) are written out-of-band and 64-byte aligned so they can be memory-mapped back
+    """
+    buffers = []
+    payload = pickle.dumps(doc, protocol = 5, buffer_callback = buffers.append)
+    raws = [buffer.raw() for buffer in buffers]
+    tmp = '%s.%i.tmp'%(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_header.pack(len(payload), len(raws)))
+        f.write(struct.pack('<%iQ'%len(raws), *[raw.nbytes for raw in raws]))
+        f.write(payload)
+        for raw in raws:
+            f.write(b'\0' * (-f.tell() % _align))
+            f.write(raw)
+    os.replace(tmp, path)
+
+
+def _load(path, use_mmap = True):
+    """
+    loads a document saved by _dump. If use_mmap, the out-of-band buffers are memory-mapped (read-only) rather than read into memory
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) if use_mmap else bytearray(f.read())
+    view = memoryview(data)
+    n, m = _header.unpack_from(view)
+    offset = _header.size
+    sizes = struct.unpack_from('<%iQ'%m, view, offset)
+    offset += 8 * m
+    payload = view[offset: offset + n]
+    offset += n
+    buffers = []
+    for size in sizes:
+        offset += -offset % _align
+        buffers.append(view[offset: offset + size])
+        offset += size
+    if offset > len(view):
+        raise EOFError('%s is truncated'%path)
+    return pickle.loads(payload, buffers = buffers)
+
+
+class disk_cache(object):
+    """
+    A persistent on-disk cache of decoded documents, keyed by (collection name, _id, version) where version is the '_updated' stamp of primary-keyed documents.
+    Each document is a single file of out-of-band pickled buffers so that numpy arrays and pandas objects are memory-mapped back on a hit.
+    Documents without a version cannot be validated across sessions and are not cached.
+
+    Use together with mongo_reader.use_cache. In revalidate mode (the default), a revisit costs one query projected on _id/_updated and a local read.
+
+    :Parameters:
+    ----------------
+    path : str
+        the directory holding the cache
+    nbytes : int, optional
+        maximum size of the directory. Least recently used documents are evicted first. The default is None, unbounded.
+    revalidate: bool
+        see doc_cache. The default is True.
+    use_mmap: bool
+        memory-map the arrays of cached documents. These are then read-only. The default is True.
+
+    :Example:
+    ---------
+    >>> t = mongo_table('test', 'test', pk = 'key').use_cache(disk_cache('c:/temp/cache', nbytes = 2**30))
+    >>> doc = t.read_one(key = 1) ## fetched from Mongo, decoded and saved
+
+    and in a new session...
+
+    >>> doc = t.read_one(key = 1) ## a projected version query and a memory-mapped local read
+
+    A memory cache can sit in front of the disk:
+
+    >>> t.use_cache(doc_cache(revalidate = True), disk_cache('c:/temp/cache'))
+    """
+    def __init__(self, path, nbytes = None, revalidate = True, use_mmap = True):
+        self.path = path.replace('\\', '/').rstrip('/') + '/'
+        mkdir(self.path)
+        self.nbytes = nbytes
+        self.revalidate = revalidate
+        self.use_mmap = use_mmap
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.RLock()
+        self._sizes = {entry.path : entry.stat().st_size for entry in os.scandir(self.path) if entry.name.endswith(_suffix)}
+
+    def _path(self, key):
+        return self.path + hashlib.sha1(repr(key).encode()).hexdigest() + _suffix
+
+    def get(self, key):
+        """
+        returns the cached document or None if key is not cached. A truncated or corrupt file is a miss.
+        """
+        path = self._path(key)
+        try:
+            doc = _load(path, self.use_mmap)
+        except (OSError, ValueError, EOFError, struct.error, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return doc
+
+    def put(self, key, doc, raw = None):
+        """
+        saves a decoded document to disk. Documents without a version are ignored.
+        """
+        if key[-1] is None:
+            return doc
+        path = self._path(key)
+        try:
+            _dump(path, doc)
+        except (pickle.PicklingError, TypeError, AttributeError, OSError):
+            return doc
+        with self._lock:
+            self._sizes[path] = os.path.getsize(path)
+            if self.nbytes is not None:
+                self._evict(keep = path)
+        return doc
+
+    def _evict(self, keep = None):
+        total = sum(self._sizes.values())
+        if total <= self.nbytes:
+            return
+        for path in sorted(self._sizes, key = lambda p: os.path.getmtime(p) if os.path.exists(p) else 0):
+            if total <= self.nbytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError: ## e.g. still memory-mapped on Windows
+                continue
+            total -= self._sizes.pop(path)
+            self.evictions += 1
+
+    def invalidate(self, name):
+        """
+        entries are versioned and hence never stale, so writes need not clear the disk
+        """
+        return self
+
+    def clear(self):
+        """
+        removes all documents from the cache
+        """
+        with self._lock:
+            for path in list(self._sizes):
+                try:
+                    os.remove(path)
+                    del self._sizes[path]
+                except OSError:
+                    pass
+            self.hits = self.misses = self.evictions = 0
+        return self
+
+    @property
+    def stats(self):
+        return Dict(hits = self.hits, misses = self.misses, evictions = self.evictions, entries = len(self._sizes), nbytes = sum(self._sizes.values()))
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __repr__(self):
+        return 'disk_cache(%s, nbytes = %s, revalidate = %s) %s'%(self.path, self.nbytes, self.revalidate, dict(self.stats))
@@ -0,0 +1,514 @@
+from pyg_mongo._q import mdict, _and, _or, _nor, _not, _eq, _ne, _gt, _ge, _lt, _le, _in, _not_in, _all, \
+    _exists, _regex, _options, _type, _mod
+from bson import ObjectId, Decimal128, Regex, Binary, Timestamp, Code
+import numpy as np
+import numbers
+import datetime
+import math
+import re
+
+__all__ = ['q_match', 'q_mask', 'q_filter']
+
+_size = '$size'
+_elem_match = '$elemMatch'
+
+_type_aliases = {'double': 1, 'string': 2, 'object': 3, 'array': 4, 'binData': 5, 'objectId': 7, 'bool': 8, 'date': 9, 'null': 10,
+                 'regex': 11, 'javascript': 13, 'int': 16, 'timestamp': 17, 'long': 18, 'decimal': 19, 'number': [1, 16, 18, 19]}
+
+_kind2bracket = dict(i = 2, u = 2, f = 2, b = 8, M = 9, U = 3)
+_kind2types = dict(i = {16, 18}, u = {16, 18}, f = {1}, b = {8}, M = {9}, U = {2})
+
+
+def _bracket(value):
+    """
+    MongoDB only compares values of the same type bracket: null, numbers, strings, objects, arrays, binary, ObjectId, bool, dates, regex
+    """
+    if value is None:
+        return 1
+    elif isinstance(value, (bool, np.bool_)):
+        return 8
+    elif isinstance(value, (numbers.Number, Decimal128)):
+        return 2
+    elif isinstance(value, str):
+        return 3
+    elif isinstance(value, dict):
+        return 4
+    elif isinstance(value, (list, tuple)):
+        return 5
+    elif isinstance(value, (bytes, bytearray)):
+        return 6
+    elif isinstance(value, ObjectId):
+        return 7
+    elif isinstance(value, (datetime.datetime, np.datetime64)):
+        return 9
+    elif isinstance(value, (re.Pattern, Regex)):
+        return 11
+    else:
+        return 10
+
+
+def _bson_types(value):
+    if value is None:
+        return {10}
+    elif isinstance(value, (bool, np.bool_)):
+        return {8}
+    elif isinstance(value, numbers.Integral):
+        return {16} if -2**31 <= value < 2**31 else {18}
+    elif isinstance(value, Decimal128):
+        return {19}
+    elif isinstance(value, numbers.Number):
+        return {1}
+    elif isinstance(value, str):
+        return {13, 15} if isinstance(value, Code) else {2}
+    elif isinstance(value, dict):
+        return {3}
+    elif isinstance(value, (list, tuple)):
+        return {4}
+    elif isinstance(value, (bytes, Binary)):
+        return {5}
+    elif isinstance(value, ObjectId):
+        return {7}
+    elif isinstance(value, Timestamp):
+        return {17}
+    elif isinstance(value, (datetime.datetime, np.datetime64)):
+        return {9}
+    elif isinstance(value, (re.Pattern, Regex)):
+        return {11}
+    return set()
+
+
+def _type_codes(arg):
+    res = set()
+    for t in arg if isinstance(arg, (list, tuple)) else [arg]:
+        t = _type_aliases.get(t, t)
+        res.update(t if isinstance(t, list) else [t])
+    return res
+
+
+def _scalar(value):
+    if isinstance(value, np.generic):
+        return value.astype('datetime64[us]').item() if isinstance(value, np.datetime64) else value.item()
+    return value
+
+
+def _equal(value, arg):
+    if _bracket(value) != _bracket(arg):
+        return False
+    try:
+        return bool(value == arg)
+    except (TypeError, ValueError):
+        return False
+
+
+def _compare(op):
+    def compare(value, arg):
+        if _bracket(value) != _bracket(arg):
+            return False
+        try:
+            return bool(op(value, arg))
+        except (TypeError, ValueError):
+            return False
+    return compare
+
+_comparisons = {_gt : _compare(lambda a, b: a > b),
+                _ge : _compare(lambda a, b: a >= b),
+                _lt : _compare(lambda a, b: a < b),
+                _le : _compare(lambda a, b: a <= b)}
+
+
+def _pattern(pattern, options = ''):
+    if isinstance(pattern, Regex):
+        pattern = pattern.try_compile()
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    flags = 0
+    for option, flag in dict(i = re.IGNORECASE, m = re.MULTILINE, x = re.VERBOSE, s = re.DOTALL).items():
+        if option in (options or ''):
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def _searcher(pattern):
+    def search(value):
+        return isinstance(value, str) and pattern.search(value) is not None
+    return search
+
+
+def _raw(doc, path):
+    """
+    the values at a dotted path. Traversing an array applies the rest of the path to each of its elements, as MongoDB does.
+    Returns an empty list if the path is missing.
+    """
+    values = [doc]
+    for key in path.split('.'):
+        res = []
+        for value in values:
+            if isinstance(value, dict):
+                if key in value:
+                    res.append(value[key])
+            elif isinstance(value, (list, tuple)):
+                if key.isdigit() and int(key) < len(value):
+                    res.append(value[int(key)])
+                res.extend(v[key] for v in value if isinstance(v, dict) and key in v)
+        values = res
+    return values
+
+
+def _expand(raw):
+    """
+    a field matches if either the value or, for arrays, any of its elements matches
+    """
+    res = []
+    for value in raw:
+        value = _scalar(value)
+        res.append(value)
+        if isinstance(value, (list, tuple)):
+            res.extend(_scalar(v) for v in value)
+    return res
+
+
+def _in_matcher(args):
+    regexes = [_searcher(_pattern(arg)) for arg in args if isinstance(arg, (re.Pattern, Regex))]
+    hashed = set()
+    others = []
+    for arg in args:
+        if isinstance(arg, (re.Pattern, Regex)):
+            continue
+        try:
+            hashed.add((_bracket(arg), arg))
+        except TypeError:
+            others.append(arg)
+    null = None in args
+    def match(raw, values):
+        if not raw and null:
+            return True
+        for value in values:
+            try:
+                if (_bracket(value), value) in hashed:
+                    return True
+            except TypeError:
+                pass
+            if others and any(_equal(value, arg) for arg in others):
+                return True
+            if regexes and any(search(value) for search in regexes):
+                return True
+        return False
+    return match
+
+
+def _op(op, arg, cond):
+    """
+    returns f(raw, values) for a single operator where raw are the values at the path and values also include the elements of arrays
+    """
+    if op == _eq:
+        if isinstance(arg, (re.Pattern, Regex)):
+            return _op(_regex, arg, {})
+        if arg is None:
+            return lambda raw, values: not raw or any(value is None for value in values)
+        return lambda raw, values: any(_equal(value, arg) for value in values)
+    elif op == _ne:
+        eq = _op(_eq, arg, cond)
+        return lambda raw, values: not eq(raw, values)
+    elif op in _comparisons:
+        compare = _comparisons[op]
+        arg = _scalar(arg)
+        return lambda raw, values: any(compare(value, arg) for value in values)
+    elif op == _in:
+        return _in_matcher(arg)
+    elif op == _not_in:
+        match = _in_matcher(arg)
+        return lambda raw, values: not match(raw, values)
+    elif op == _all:
+        matchers = [_op(_eq, a, {}) for a in arg]
+        return lambda raw, values: bool(raw) and all(match(raw, values) for match in matchers)
+    elif op == _exists:
+        return lambda raw, values: bool(raw) == bool(arg)
+    elif op == _regex:
+        search = _searcher(_pattern(arg, cond.get(_options)))
+        return lambda raw, values: any(search(value) for value in values)
+    elif op == _options:
+        return None
+    elif op == _type:
+        codes = _type_codes(arg)
+        return lambda raw, values: any(_bson_types(value) & codes for value in values)
+    elif op == _mod:
+        div, rem = arg
+        return lambda raw, values: any(_bracket(value) == 2 and math.fmod(int(value), div) == rem for value in values if value == value)
+    elif op == _size:
+        return lambda raw, values: any(isinstance(value, (list, tuple)) and len(value) == arg for value in raw)
+    elif op == _elem_match:
+        if min([key.startswith('$') for key in arg], default = False):
+            match = _field(arg)
+            return lambda raw, values: any(isinstance(value, (list, tuple)) and any(match([v]) for v in value) for value in raw)
+        match = _compile(arg)
+        return lambda raw, values: any(isinstance(value, (list, tuple)) and any(isinstance(v, dict) and match(v) for v in value) for value in raw)
+    elif op == _not:
+        if isinstance(arg, (re.Pattern, Regex)):
+            match = _op(_regex, arg, {})
+        else:
+            match = _field(arg)
+            return lambda raw, values: not match(raw)
+        return lambda raw, values: not match(raw, values)
+    raise ValueError('%s is not supported in-process'%op)
+
+
+def _ops(cond):
+    """
+    normalizes the condition on a field into a dict of operators
+    """
+    if isinstance(cond, (re.Pattern, Regex)):
+        return {_regex : cond}
+    elif isinstance(cond, dict) and len(cond) and min([key.startswith('$') for key in cond]):
+        return cond
+    else:
+        return {_eq : cond}
+
+
+def _field(cond):
+    """
+    returns f(raw) testing the values at a path against a condition
+    """
+    cond = _ops(cond)
+    ops = [fn for fn in [_op(op, arg, cond) for op, arg in cond.items()] if fn is not None]
+    def match(raw):
+        values = _expand(raw)
+        return all(fn(raw, values) for fn in ops)
+    return match
+
+
+def _path_matcher(path, cond):
+    match = _field(cond)
+    return lambda doc: match(_raw(doc, path))
+
+
+def _compile(query):
+    """
+    compiles a query into a python predicate of a document
+    """
+    preds = []
+    for key, value in query.items():
+        if key == _and:
+            preds.append(_all_of([_compile(v) for v in value]))
+        elif key == _or:
+            preds.append(_any_of([_compile(v) for v in value]))
+        elif key == _nor:
+            preds.append(_none_of([_compile(v) for v in value]))
+        elif key == _not:
+            preds.append(_none_of([_compile(value)]))
+        elif key.startswith('$'):
+            raise ValueError('%s is not supported in-process'%key)
+        else:
+            preds.append(_path_matcher(key, value))
+    if len(preds) == 1:
+        return preds[0]
+    return _all_of(preds)
+
+
+def _all_of(preds):
+    return lambda doc: all(pred(doc) for pred in preds)
+
+def _any_of(preds):
+    return lambda doc: any(pred(doc) for pred in preds)
+
+def _none_of(preds):
+    return lambda doc: not any(pred(doc) for pred in preds)
+
+
+def q_match(query):
+    """
+    compiles a query into a python predicate with MongoDB semantics: dotted paths traverse arrays, a field matches if any array element matches,
+    values of different types (e.g. 1 and '1', True and 1) never compare equal and $eq None matches missing fields.
+
+    Supported: $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $all, $exists, $regex, $type, $mod, $size, $elemMatch, $not, $and, $or, $nor
+
+    :Parameters:
+    ----------------
+    query : dict
+        typically created using q
+
+    :Returns:
+    -------
+    callable
+        predicate(doc) returning True if the document matches
+
+    :Example:
+    ---------
+    >>> match = q_match(q(q.a > 1, b = ['x', 'y']))
+    >>> assert match(dict(a = 2, b = 'x')) and not match(dict(a = 2, b = 'z'))
+    >>> assert q_match(q['c.d'] == 1)(dict(c = [dict(d = 0), dict(d = 1)]))
+    """
+    if isinstance(query, mdict):
+        res = query.__dict__.get('_match')
+        if res is None:
+            res = query._match = _compile(query)
+        return res
+    return _compile(query or {})
+
+
+def _columns(data):
+    """
+    returns (number of rows, a function returning a column as a numpy array or None if missing)
+    """
+    keys = set(data.columns if hasattr(data, 'columns') else data.keys())
+    n = len(data) if hasattr(data, 'columns') or hasattr(data, 'listby') else len(next(iter(data.values()), []))
+    def column(key):
+        if key not in keys:
+            return None
+        values = data[key]
+        if hasattr(values, 'to_numpy'):
+            values = values.to_numpy()
+        if isinstance(values, np.ndarray) and values.ndim == 1:
+            return values
+        values = list(values)
+        types = set(map(type, values))
+        if types and (types <= {int, float} or types == {bool} or types == {str}):
+            return np.array(values)
+        res = np.empty(len(values), dtype = object)
+        res[:] = values
+        return res
+    return n, column
+
+
+def _np_value(value):
+    if isinstance(value, datetime.datetime):
+        return None if value.tzinfo else np.datetime64(value)
+    return value
+
+
+def _vector(cond, col):
+    """
+    evaluates the condition on a field over a typed numpy column. Returns None if it cannot be vectorized.
+    """
+    kind = col.dtype.kind
+    bracket = _kind2bracket.get(kind)
+    if bracket is None:
+        return None
+    n = len(col)
+    res = np.ones(n, dtype = bool)
+    for op, arg in cond.items():
+        if op in (_eq, _ne):
+            if isinstance(arg, (re.Pattern, Regex)):
+                return None
+            value = _np_value(arg)
+            if _bracket(arg) == bracket and value is None:
+                return None
+            mask = col == value if _bracket(arg) == bracket else np.zeros(n, dtype = bool)
+        elif op in (_in, _not_in):
+            if any([isinstance(a, (re.Pattern, Regex)) or _bracket(a) == bracket and _np_value(a) is None for a in arg]):
+                return None
+            values = [_np_value(a) for a in arg if _bracket(a) == bracket]
+            mask = np.isin(col, values) if values else np.zeros(n, dtype = bool)
+        elif op in (_gt, _ge, _lt, _le):
+            value = _np_value(arg)
+            if _bracket(arg) != bracket:
+                mask = np.zeros(n, dtype = bool)
+            elif value is None:
+                return None
+            else:
+                mask = dict([(_gt, np.greater), (_ge, np.greater_equal), (_lt, np.less), (_le, np.less_equal)])[op](col, value)
+        elif op == _exists:
+            mask = np.full(n, bool(arg))
+        elif op == _type:
+            mask = np.full(n, bool(_kind2types[kind] & _type_codes(arg)))
+        elif op == _mod and bracket == 2:
+            div, rem = arg
+            with np.errstate(invalid = 'ignore'):
+                mask = np.fmod(np.trunc(col), div) == rem
+        else:
+            return None
+        if op in (_ne, _not_in):
+            mask = ~mask
+        res &= mask
+    return res
+
+
+def _field_mask(key, cond, n, column):
+    col = column(key)
+    if col is not None:
+        res = _vector(_ops(cond), col)
+        if res is not None:
+            return res
+        match = _field(cond)
+        return np.fromiter((match([v]) for v in col), dtype = bool, count = n)
+    head = key.split('.')[0]
+    col = column(head) if '.' in key else None
+    if col is not None:
+        match = _path_matcher(key, cond)
+        return np.fromiter((match({head : v}) for v in col), dtype = bool, count = n)
+    return np.full(n, _field(cond)([]))
+
+
+def _mask(query, n, column):
+    masks = []
+    for key, value in query.items():
+        if key == _and:
+            masks.extend(_mask(v, n, column) for v in value)
+        elif key == _or:
+            masks.append(np.logical_or.reduce([_mask(v, n, column) for v in value] + [np.zeros(n, dtype = bool)]))
+        elif key == _nor:
+            masks.append(~np.logical_or.reduce([_mask(v, n, column) for v in value] + [np.zeros(n, dtype = bool)]))
+        elif key == _not:
+            masks.append(~_mask(value, n, column))
+        elif key.startswith('$'):
+            raise ValueError('%s is not supported in-process'%key)
+        else:
+            masks.append(_field_mask(key, value, n, column))
+    return np.logical_and.reduce(masks + [np.ones(n, dtype = bool)])
+
+
+def q_mask(query, data):
+    """
+    evaluates a query over columnar data, returning a boolean numpy mask of the rows matching.
+    Conditions on numeric, boolean, datetime64 and string columns are vectorized, others are evaluated row by row with the semantics of q_match.
+    Every row is taken to have every column, so a None in a column is a null value rather than a missing field.
+
+    :Parameters:
+    ----------------
+    query : dict
+        typically created using q
+    data : dictable, pd.DataFrame, dict of columns or a list of documents
+
+    :Returns:
+    -------
+    np.ndarray of bools
+
+    :Example:
+    ---------
+    >>> df = pd.DataFrame(dict(a = [1,2,3], b = ['x', 'y', 'z']))
+    >>> assert list(q_mask(q(q.a > 1, b = ['x', 'y']), df)) == [False, True, False]
+    """
+    query = query or {}
+    if isinstance(data, (list, tuple)):
+        match = q_match(query)
+        return np.fromiter((match(doc) for doc in data), dtype = bool, count = len(data))
+    n, column = _columns(data)
+    return _mask(query, n, column)
+
+
+def q_filter(query, data):
+    """
+    filters data in-process, returning the rows/documents matching the query, see q_match and q_mask.
+
+    :Parameters:
+    ----------------
+    query : dict
+        typically created using q
+    data : dictable, pd.DataFrame, dict of columns or a list of documents
+
+    :Returns:
+    -------
+    the subset of data matching, of the same type
+
+    :Example:
+    ---------
+    >>> rs = dictable(a = [1,2,3], b = ['x', 'y', 'z'])
+    >>> assert q_filter(q.a >= 2, rs) == dictable(a = [2,3], b = ['y', 'z'])
+    >>> assert q_filter(q.a >= 2, list(rs)) == list(rs)[1:]
+    """
+    if isinstance(data, (list, tuple)):
+        match = q_match(query or {})
+        return type(data)([doc for doc in data if match(doc)])
+    mask = q_mask(query, data)
+    if isinstance(data, dict) and not hasattr(data, 'listby'):
+        return type(data)({key : np.asarray(value)[mask] if isinstance(value, np.ndarray) else [v for v, m in zip(value, mask) if m] for key, value in data.items()})
+    return data[mask]
@@ -0,0 +1,413 @@
+from pyg_base import Dict, dictable, logger
+from pymongo import monitoring
+from bson import encode as bson_encode
+from contextvars import ContextVar
+from collections import deque
+from functools import wraps
+import threading
+import queue
+import datetime
+import bisect
+import time
+
+__all__ = ['mongo_monitor', 'monitor']
+
+_seconds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_bytes = (2**10, 2**12, 2**14, 2**16, 2**18, 2**20, 2**22, 2**24)
+_trips = (1, 2, 3, 4, 5, 10, 20, 50, 100)
+
+_operation = ContextVar('pyg_mongo_operation', default = None)
+_explainable = ('read', 'read_one', 'count', 'distinct', 'distinct_counts', 'docs') ## reads whose plan is that of the cursor's find (or pipeline)
+
+
+class _histogram(object):
+    """
+    A cumulative histogram with fixed bucket upper bounds, as in Prometheus
+    """
+    __slots__ = ['buckets', 'counts', 'sum', 'count']
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, p):
+        """
+        the upper bound of the bucket holding the p-quantile
+        """
+        if not self.count:
+            return None
+        rank = p * self.count
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        total = 0
+        for bound, n in zip(self.buckets + ('+Inf',), self.counts):
+            total += n
+            yield bound, total
+
+
+class _call(object):
+    """
+    the originating reader/cursor method of the commands run within it
+    """
+    __slots__ = ['table', 'method', 'commands']
+
+    def __init__(self, table, method):
+        self.table = table
+        self.method = method
+        self.commands = 0
+
+
+class _stats(object):
+    __slots__ = ['calls', 'commands', 'failures', 'seconds', 'sent', 'received', 'trips']
+
+    def __init__(self):
+        self.calls = self.commands = self.failures = 0
+        self.seconds = _histogram(_seconds)
+        self.sent = _histogram(_bytes)
+        self.received = _histogram(_bytes)
+        self.trips = _histogram(_trips)
+
+
+def _plan_stages(plan):
+    """
+    walks a query plan from the root, returning its stages and the indexes it scans
+    """
+    stages, indexes = [], []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop(0)
+        if not isinstance(node, dict):
+            continue
+        node = node.get('queryPlan', node)
+        if 'stage' in node:
+            stages.append(node['stage'])
+        if 'indexName' in node:
+            indexes.append(node['indexName'])
+        if 'inputStage' in node:
+            nodes.append(node['inputStage'])
+        nodes.extend(node.get('inputStages', []))
+    return stages, indexes
+
+
+def _explain_summary(res):
+    """
+    summarises the response of an explain command: the winning plan (e.g. COLLSCAN or FETCH/IXSCAN), the indexes used and the documents examined vs returned
+    """
+    if 'queryPlanner' not in res: ## aggregations explain the query feeding the pipeline in its first stage
+        for stage in res.get('stages', []):
+            if '$cursor' in stage:
+                res = dict(stage['$cursor'], executionStats = stage['$cursor'].get('executionStats', res.get('executionStats', {})))
+                break
+        else:
+            shards = res.get('shards', {})
+            for shard in shards.values():
+                return _explain_summary(shard)
+    stages, indexes = _plan_stages(res.get('queryPlanner', {}).get('winningPlan', {}))
+    stats = res.get('executionStats', {})
+    return Dict(plan = '/'.join(stages), 
+                collscan = 'COLLSCAN' in stages,
+                indexes = indexes,
+                returned = stats.get('nReturned'),
+                docs_examined = stats.get('totalDocsExamined'),
+                keys_examined = stats.get('totalKeysExamined'),
+                millis = stats.get('executionTimeMillis'))
+
+
+def _labels(**labels):
+    return '{%s}'%','.join('%s="%s"'%(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items())
+
+
+class mongo_monitor(monitoring.CommandListener):
+    """
+    Command-level instrumentation of the mongo_reader/mongo_cursor API, built on pymongo command monitoring.
+    Each command sent to the server is tagged with the table and the (outermost) method that issued it, e.g. insert_one, read, dedup.
+    Per table and method, we keep histograms of the latency of the commands, the bytes sent and received and the number of round trips per call.
+
+    The listener is registered with pymongo on import, so it sees every client created afterwards. It is disabled by default and costs a function call per command until enabled.
+
+    :Parameters:
+    ----------------
+    nbytes : bool
+        measure the size of commands and replies. This re-encodes them and so has a cost for large documents. The default is False.
+
+    :Example:
+    ---------
+    >>> from pyg_mongo import monitor
+    >>> monitor.enable()
+    >>> t = mongo_table('test', 'test', pk = 'key')
+    >>> t.insert_one(dict(key = 1, value = 2))
+    >>> t.stats() ## calls, commands, round trips per call, latency and bytes of insert_one on test.test
+    >>> print(monitor.prometheus())
+    """
+    def __init__(self, nbytes = False):
+        self.enabled = False
+        self.nbytes = nbytes
+        self.threshold = None
+        self.explain = True
+        self.verbosity = 'executionStats'
+        self._lock = threading.Lock()
+        self._started = {}
+        self._stats = {}
+        self._slow = deque(maxlen = 1000)
+        self._explained = {}
+        self._explains = queue.Queue(maxsize = 1000)
+        self._explainer = None
+
+    def enable(self, nbytes = None):
+        if nbytes is not None:
+            self.nbytes = nbytes
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        self._started.clear()
+        return self
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+            self._slow.clear()
+            self._explained.clear()
+        return self
+
+    def slow_log(self, threshold = 0.1, explain = True, entries = 1000, verbosity = 'executionStats'):
+        """
+        records every monitored operation taking more than threshold seconds, with its spec, projection and sort.
+        If explain, slow reads are also explained (once per query) so a collection scan or a poorly selective index shows up.
+        Explains run in a background thread, so the record's plan is filled in (and the warning logged) shortly after the slow call returns. Writes are not explained.
+        Works independently of enable().
+
+        :Parameters:
+        ----------------
+        threshold : float, optional
+            in seconds. The default is 0.1. Use None to stop logging.
+        explain : bool
+            capture the plan of slow reads. The default is True.
+        entries : int
+            the number of slow operations kept. The default is 1000.
+        verbosity : str
+            'executionStats' (the default) records the documents examined vs returned, running the query again in the background thread, once per query. 
+            'queryPlanner' only plans the query, e.g. where re-running slow queries is too costly.
+
+        :Example:
+        ---------
+        >>> from pyg_mongo import monitor
+        >>> monitor.slow_log(threshold = 0.05)
+        >>> t = mongo_table('test', 'test')
+        >>> t.inc(q.name == re.compile('a')).read(0) ## an unanchored regex scans the collection
+        >>> monitor.flush().slow()[['method', 'seconds', 'spec', 'plan', 'docs_examined', 'returned']]
+        """
+        with self._lock:
+            self.threshold = threshold
+            self.explain = explain
+            self.verbosity = verbosity
+            self._slow = deque(self._slow, maxlen = entries)
+        return self
+
+    def _log_slow(self, cursor, method, seconds):
+        spec = getattr(cursor, '_spec', None)
+        pipeline = cursor.pipeline if isinstance(getattr(type(cursor), 'pipeline', None), property) else None ## readers turn unknown attributes into distinct()
+        record = Dict(time = datetime.datetime.now(), table = cursor.collection.full_name, method = method, seconds = seconds,
+                      spec = spec, projection = getattr(cursor, '_projection', None), sort = getattr(cursor, '_sort', None), 
+                      pipeline = pipeline,
+                      plan = None, collscan = None, indexes = None, returned = None, docs_examined = None, keys_examined = None, millis = None)
+        with self._lock:
+            self._slow.append(record)
+        if self.explain and method in _explainable and hasattr(cursor, 'explain'):
+            try:
+                self._explains.put_nowait((cursor, record, self.verbosity))
+                self._start_explainer()
+                return
+            except queue.Full: ## the explainer is behind, skip the plan rather than block
+                pass
+        self._warn(record)
+
+    def _warn(self, record):
+        logger.warning('WARNING: slow %s on %s took %.3fs%s spec: %s'%(record.method, record.table, record.seconds, 
+                       '' if record.plan is None else ' (%s, %s docs examined, %s returned)'%(record.plan, record.docs_examined, record.returned), record.spec))
+
+    def _start_explainer(self):
+        if self._explainer is None or not self._explainer.is_alive():
+            with self._lock:
+                if self._explainer is None or not self._explainer.is_alive():
+                    self._explainer = threading.Thread(target = self._explain_slow, name = 'pyg_mongo_explain', daemon = True)
+                    self._explainer.start()
+
+    def _explain_slow(self):
+        while True:
+            cursor, record, verbosity = self._explains.get()
+            try:
+                key = (repr(record.pipeline) if record.pipeline is not None else cursor.fingerprint, verbosity)
+                summary = self._explained.get(key)
+                if summary is None:
+                    try:
+                        summary = cursor.explain(verbosity = verbosity)
+                    except Exception as e:
+                        logger.info('INFO: could not explain %s on %s: %s'%(record.method, record.table, e))
+                        summary = {}
+                    with self._lock:
+                        if len(self._explained) >= self._slow.maxlen:
+                            self._explained.clear()
+                        self._explained[key] = summary
+                with self._lock:
+                    record.update(summary)
+                self._warn(record)
+            finally:
+                self._explains.task_done()
+
+    def flush(self):
+        """
+        waits for the slow operations logged so far to be explained
+        """
+        self._explains.join()
+        return self
+
+    def slow(self, table = None):
+        """
+        returns a dictable of the slow operations recorded by slow_log, optionally for a single table (db.collection)
+        """
+        with self._lock:
+            return dictable([record for record in self._slow if table is None or record.table == table])
+
+    def _get(self, table, method):
+        key = (table, method)
+        res = self._stats.get(key)
+        if res is None:
+            res = self._stats[key] = _stats()
+        return res
+
+    def started(self, event):
+        if not self.enabled:
+            return
+        call = _operation.get()
+        if call is None:
+            collection = event.command.get(event.command_name)
+            table = '%s.%s'%(event.database_name, collection) if isinstance(collection, str) else event.database_name
+            call = _call(table, None)
+        call.commands += 1
+        sent = len(bson_encode(event.command)) if self.nbytes else 0
+        self._started[(event.connection_id, event.request_id)] = (call, sent)
+
+    def _finished(self, event, failed):
+        tag = self._started.pop((event.connection_id, event.request_id), None)
+        if tag is None:
+            return
+        call, sent = tag
+        received = len(bson_encode(event.reply)) if self.nbytes and not failed else 0
+        with self._lock:
+            stats = self._get(call.table, call.method)
+            stats.commands += 1
+            stats.failures += failed
+            stats.seconds.observe(event.duration_micros / 1e6)
+            if self.nbytes:
+                stats.sent.observe(sent)
+                stats.received.observe(received)
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
+
+    def _called(self, call):
+        with self._lock:
+            stats = self._get(call.table, call.method)
+            stats.calls += 1
+            stats.trips.observe(call.commands)
+
+    def stats(self, table = None):
+        """
+        returns a dictable of the statistics, per table and method. Commands not issued by a monitored method have method None.
+
+        :Parameters:
+        ----------------
+        table : str, optional
+            the full name (db.collection) of a table. The default is None, all tables.
+        """
+        with self._lock:
+            items = sorted([(key, stats) for key, stats in self._stats.items() if table is None or key[0] == table], key = lambda item: (item[0][0], str(item[0][1])))
+            return dictable([Dict(table = t, method = method,
+                                  calls = stats.calls,
+                                  commands = stats.commands,
+                                  round_trips = stats.trips.sum / stats.trips.count if stats.trips.count else None,
+                                  failures = stats.failures,
+                                  seconds = stats.seconds.sum,
+                                  p50 = stats.seconds.quantile(0.5),
+                                  p99 = stats.seconds.quantile(0.99),
+                                  sent = stats.sent.sum,
+                                  received = stats.received.sum) for (t, method), stats in items])
+
+    def prometheus(self, prefix = 'pyg_mongo'):
+        """
+        returns the histograms in the Prometheus text exposition format
+        """
+        metrics = [('command_seconds', 'latency of the commands sent to the server', 'seconds'),
+                   ('command_sent_bytes', 'size of the commands sent to the server', 'sent'),
+                   ('command_received_bytes', 'size of the replies received from the server', 'received'),
+                   ('round_trips', 'number of commands sent per call', 'trips')]
+        lines = []
+        with self._lock:
+            items = sorted(self._stats.items(), key = lambda item: (item[0][0], str(item[0][1])))
+            for name, text, attr in metrics:
+                if attr in ('sent', 'received') and not self.nbytes:
+                    continue
+                metric = '%s_%s'%(prefix, name)
+                lines.extend(['# HELP %s %s'%(metric, text), '# TYPE %s histogram'%metric])
+                for (table, method), stats in items:
+                    histogram = getattr(stats, attr)
+                    if not histogram.count:
+                        continue
+                    for bound, total in histogram.cumulative():
+                        lines.append('%s_bucket%s %i'%(metric, _labels(table = table, method = method or '', le = bound), total))
+                    lines.append('%s_sum%s %s'%(metric, _labels(table = table, method = method or ''), histogram.sum))
+                    lines.append('%s_count%s %i'%(metric, _labels(table = table, method = method or ''), histogram.count))
+            metric = '%s_command_failures_total'%prefix
+            lines.extend(['# HELP %s number of failed commands'%metric, '# TYPE %s counter'%metric])
+            for (table, method), stats in items:
+                lines.append('%s%s %i'%(metric, _labels(table = table, method = method or ''), stats.failures))
+        return '\n'.join(lines) + '\n'
+
+    def __repr__(self):
+        return 'mongo_monitor(enabled = %s, nbytes = %s)\n%s'%(self.enabled, self.nbytes, self.stats())
+
+
+monitor = mongo_monitor()
+monitoring.register(monitor)
+
+
+def monitored(function):
+    """
+    decorates a reader/cursor method so that the commands it issues are tagged with its name and slow calls are logged. Nested calls are attributed to the outermost method.
+    """
+    method = function.__name__
+    @wraps(function)
+    def wrapped(self, *args, **kwargs):
+        if not (monitor.enabled or monitor.threshold is not None) or _operation.get() is not None:
+            return function(self, *args, **kwargs)
+        call = _call(self.collection.full_name, method)
+        token = _operation.set(call)
+        t0 = time.perf_counter()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - t0
+            _operation.reset(token)
+            if monitor.enabled:
+                monitor._called(call)
+            if monitor.threshold is not None and seconds > monitor.threshold and method != 'explain':
+                monitor._log_slow(self, method, seconds)
+    return wrapped
@@ -0,0 +1,212 @@
+from pyg_base import as_list, dictable, is_int, is_str
+from pyg_mongo._q import q, _id
+from pyg_mongo._base_reader import _dict1, _client_key
+from pyg_mongo._monitor import monitored, _explain_summary
+
+__all__ = ['mongo_pipeline']
+
+_count = 'count'
+_joined = '_joined'
+
+
+def _accumulator(value):
+    """
+    converts an aggregation spec into a $group accumulator:
+
+    - 'count' : the number of documents
+    - (op, field): e.g. ('sum', 'x'), ('avg', 'x'), ('max', 'x'), ('push', 'x')
+    - a dict is used as is, e.g. {'$sum': {'$multiply': ['$x', '$y']}}
+    """
+    if isinstance(value, dict):
+        return value
+    elif value == _count:
+        return {'$sum' : 1}
+    elif isinstance(value, (list, tuple)) and len(value) == 2:
+        op, field = value
+        return {'$%s'%op.lstrip('$') : '$%s'%field if is_str(field) else field}
+    raise ValueError('cannot convert %s into an accumulator. Use "count", (op, field) or a dict'%value)
+
+
+class mongo_pipeline(object):
+    """
+    A fluent builder of aggregation pipelines, starting from a cursor's filter, sort and projection.
+    The pipeline runs on the server (with allowDiskUse) and documents are decoded by the cursor's reader.
+    Each method returns a new pipeline.
+
+    :Example:
+    ---------
+    >>> t = mongo_table('test', 'test')
+    >>> t.insert_many(dictable(name = ['a', 'b', 'a'], x = [1, 2, 3]))
+    >>> res = t.find(q.x > 0).group(by = 'name', total = ('sum', 'x'), n = 'count').sort('-total').limit(10)
+    >>> assert res[::] == dictable(name = ['a', 'b'], total = [4, 2], n = [2, 1])
+    >>> res.pipeline
+    [{'$match': {'x': {'$gt': 0}}},
+     {'$group': {'_id': {'name': '$name'}, 'total': {'$sum': '$x'}, 'n': {'$sum': 1}}},
+     {'$project': {'_id': 0, 'name': '$_id.name', 'total': 1, 'n': 1}},
+     {'$sort': {'total': -1}},
+     {'$limit': 10}]
+    """
+    def __init__(self, cursor, stages = None):
+        self.cursor = cursor
+        if stages is None:
+            stages = []
+            spec = cursor._spec
+            if spec:
+                stages.append({'$match' : spec})
+            if cursor.sorter:
+                stages.append({'$sort' : dict(cursor._sort)})
+            if cursor.projection:
+                stages.append({'$project' : cursor._projection})
+        self.stages = stages
+
+    @property
+    def collection(self):
+        return self.cursor.collection
+
+    @property
+    def pipeline(self):
+        return list(self.stages)
+
+    def append(self, *stages):
+        """
+        returns a new pipeline with raw stages added
+        """
+        return type(self)(self.cursor, self.stages + list(stages))
+
+    def match(self, *args, **kwargs):
+        return self.append({'$match' : q(*args, **kwargs)})
+
+    find = inc = match
+
+    def group(self, by = None, **aggregations):
+        """
+        groups documents by the keys in by, computing aggregations per group. The result documents are flat: the by keys and the aggregations.
+
+        :Parameters:
+        ----------
+        by : str/list of str, optional
+            keys to group by. The default is None, a single group
+        **aggregations :
+            name = 'count' or (op, field) or a raw accumulator dict
+        """
+        by = as_list(by)
+        group = {_id : {key.replace('.', '_') : '$%s'%key for key in by} if by else None}
+        group.update({name : _accumulator(value) for name, value in aggregations.items()})
+        project = {_id : 0}
+        project.update({key.replace('.', '_') : '$%s.%s'%(_id, key.replace('.', '_')) for key in by})
+        project.update({name : 1 for name in aggregations})
+        return self.append({'$group' : group}, {'$project' : project})
+
+    def join(self, right, on, how = 'left', projection = None):
+        """
+        joins each document with the matching documents of the right cursor, on the server, using $lookup.
+        Fields of the left document take precedence over those of the right.
+
+        :Parameters:
+        ----------
+        right : mongo_reader
+            a cursor on a collection in the same database. Its filter (and projection) apply to the documents joined.
+        on : str/list of str or a dict
+            keys to join on. Use a dict {left_key: right_key} when the names differ.
+        how : 'left' or 'inner'
+            'left' keeps documents with no match, 'inner' drops them. A document matching several right documents appears once per match.
+        projection : optional
+            the fields of the right documents to join. The default is the right cursor's projection.
+
+        :Example:
+        ---------
+        >>> trades = mongo_table('trades', 'test')
+        >>> instruments = mongo_table('instruments', 'test')
+        >>> trades.inc(q.qty > 0).join(instruments, on = 'ticker', projection = ['ticker', 'currency'])[::]
+        """
+        if how not in ('left', 'inner'):
+            raise ValueError('how must be "left" or "inner", not %s'%how)
+        left_db = self.collection.database
+        right_db = right.collection.database
+        if left_db.name != right_db.name or _client_key(left_db.client) != _client_key(right_db.client):
+            raise ValueError('can only join collections in the same database, %s and %s'%(self.collection.full_name, right.collection.full_name))
+        on = on if isinstance(on, dict) else {key : key for key in as_list(on)}
+        variables = {'k%i'%i : '$%s'%key for i, key in enumerate(on)}
+        conditions = [{'$eq' : ['$%s'%key, '$$k%i'%i]} for i, key in enumerate(on.values())]
+        lookup = [{'$match' : {'$expr' : conditions[0] if len(conditions) == 1 else {'$and' : conditions}}}]
+        spec = right._spec
+        if spec:
+            lookup.append({'$match' : spec})
+        projection = _dict1(projection) if projection is not None else right._projection
+        if projection:
+            lookup.append({'$project' : projection})
+        return self.append({'$lookup' : {'from' : right.collection.name, 'let' : variables, 'pipeline' : lookup, 'as' : _joined}},
+                           {'$unwind' : {'path' : '$%s'%_joined, 'preserveNullAndEmptyArrays' : how == 'left'}},
+                           {'$replaceRoot' : {'newRoot' : {'$mergeObjects' : ['$%s'%_joined, '$$ROOT']}}},
+                           {'$project' : {_joined : 0}})
+
+    def sort(self, *sorter):
+        return self.append({'$sort' : _dict1(as_list(sorter))})
+
+    def limit(self, n):
+        return self.append({'$limit' : n})
+
+    def skip(self, n):
+        return self.append({'$skip' : n})
+
+    def project(self, projection):
+        return self.append({'$project' : _dict1(projection)})
+
+    def unwind(self, path, preserve = False):
+        return self.append({'$unwind' : {'path' : '$%s'%path, 'preserveNullAndEmptyArrays' : preserve}})
+
+    def _docs(self, stages = None):
+        return self.collection.aggregate(self.stages + (stages or []), allowDiskUse = True)
+
+    def __iter__(self):
+        for doc in self._docs():
+            yield self.cursor._read(doc)
+
+    @monitored
+    def read(self, item = 0, reader = None):
+        if is_int(item):
+            if item < 0:
+                item = self.count() + item
+            for doc in self._docs([{'$skip' : item}, {'$limit' : 1}] if item else [{'$limit' : 1}]):
+                return self.cursor._read(doc, reader = reader)
+            raise IndexError('pipeline index %i out of range'%item)
+        elif isinstance(item, slice):
+            if item.step not in (None, 1):
+                raise ValueError('pipeline does not support slice steps')
+            stages = []
+            start = item.start or 0
+            if start < 0 or (item.stop is not None and item.stop < 0):
+                n = self.count()
+                start = start + n if start < 0 else start
+                stop = None if item.stop is None else item.stop + n if item.stop < 0 else item.stop
+            else:
+                stop = item.stop
+            if start:
+                stages.append({'$skip' : start})
+            if stop is not None:
+                if stop <= start:
+                    return dictable([])
+                stages.append({'$limit' : stop - start})
+            return dictable([self.cursor._read(doc, reader = reader) for doc in self._docs(stages)])
+        raise TypeError('cannot read %s from a pipeline'%item)
+
+    __getitem__ = read
+
+    @monitored
+    def count(self):
+        for doc in self._docs([{'$count' : _count}]):
+            return doc[_count]
+        return 0
+
+    __len__ = count
+
+    @monitored
+    def explain(self, verbosity = 'executionStats', raw = False):
+        """
+        explains how the server runs the pipeline, see mongo_reader.explain
+        """
+        res = self.collection.database.command('explain', {'aggregate' : self.collection.name, 'pipeline' : self.stages, 'cursor' : {}}, verbosity = verbosity)
+        return res if raw else _explain_summary(res)
+
+    def __repr__(self):
+        return 'mongo_pipeline for %s\n%s'%(self.collection, '\n'.join(str(stage) for stage in self.stages))
@@ -0,0 +1,210 @@
+from pyg_base import Dict, dictable, as_list, is_strs
+from pyg_encoders import decode
+import threading
+import itertools
+import heapq
+import time
+
+__all__ = ['decode_profiler', 'profiler']
+
+_obj = '_obj'
+_id = '_id'
+_kinds = [('bson2pd', 'dataframe'), ('bson2np', 'ndarray'), ('parquet', 'parquet'), ('csv', 'csv'), ('npy', 'npy'), ('pickle', 'pickle')]
+
+
+def _field_type(value):
+    """
+    classifies a stored (encoded) field: dataframe, ndarray, parquet, csv, npy and pickle for encoded objects, the encoded class for other objects, else the python type
+
+    :Example:
+    ---------
+    >>> assert _field_type(encode(pd.Series([1,2]))) == 'dataframe'
+    >>> assert _field_type(encode(np.arange(3))) == 'ndarray'
+    >>> assert _field_type(1) == 'int'
+    """
+    if isinstance(value, dict):
+        obj = value.get(_obj)
+        if obj is None:
+            return 'dict'
+        obj = str(obj)
+        for keyword, kind in _kinds:
+            if keyword in obj:
+                return kind
+        return obj.split('"')[-2].split('.')[-1] if obj.count('"') >= 2 else obj
+    return type(value).__name__
+
+
+def _name(function):
+    if is_strs(function):
+        return str(function)
+    while hasattr(function, 'func'):
+        function = function.func
+    return getattr(function, '__name__', type(function).__name__)
+
+
+class _timing(object):
+    __slots__ = ['count', 'seconds', 'max']
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+class decode_profiler(object):
+    """
+    An opt-in profiler of the reader and writer chains that mongo_reader runs on every document.
+    Per table, it times each reader/writer callable and, when the reader is the default decode, each top-level field by its stored type
+    (an encoded dataframe or ndarray, a parquet/csv/npy/pickle path, or a plain python type). The slowest documents are kept too.
+
+    :Parameters:
+    ----------------
+    documents : int
+        the number of slowest documents kept. The default is 100.
+
+    :Example:
+    ---------
+    >>> from pyg_mongo import profiler
+    >>> profiler.enable()
+    >>> t = mongo_table('test', 'test', pk = 'key')
+    >>> t.insert_one(dict(key = 1, data = pd.DataFrame(np.random.normal(0,1,(1000,10)))))
+    >>> doc = t.read_one(key = 1)
+    >>> profiler.types()     ## time spent decoding dataframes, ints...
+    >>> profiler.fields()    ## ...per field
+    >>> profiler.documents() ## the slowest documents
+    """
+    def __init__(self, documents = 100):
+        self.enabled = False
+        self.n = documents
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self.clear()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def clear(self):
+        with self._lock:
+            self._callables = {}
+            self._fields = {}
+            self._documents = []
+        return self
+
+    def _timing(self, timings, key):
+        res = timings.get(key)
+        if res is None:
+            res = timings[key] = _timing()
+        return res
+
+    def _decode(self, table, doc):
+        """
+        decode(doc) field by field, timing each. For a dict without an _obj key, decode decodes the values independently so the result is the same.
+        """
+        res = {}
+        timings = []
+        for key, value in doc.items():
+            t0 = time.perf_counter()
+            res[decode(key)] = decode(value)
+            timings.append((key, _field_type(value), time.perf_counter() - t0))
+        with self._lock:
+            for key, kind, seconds in timings:
+                self._timing(self._fields, (table, key, kind)).add(seconds)
+        return type(doc)(**res)
+
+    def _run(self, cursor, doc, functions, mode):
+        table = cursor.collection.full_name
+        res = doc
+        timings = []
+        t0 = time.perf_counter()
+        for function in as_list(functions):
+            t = time.perf_counter()
+            if mode == 'read' and is_strs(function):
+                res = res[function]
+            elif mode == 'read' and function is decode and isinstance(res, dict) and _obj not in res:
+                res = self._decode(table, res)
+            else:
+                res = function(res)
+            timings.append((_name(function), time.perf_counter() - t))
+        total = time.perf_counter() - t0
+        i = None
+        if isinstance(doc, dict):
+            i = doc.get(_id) or (Dict({key : doc.get(key) for key in cursor._pk}) if cursor.pk else None)
+        with self._lock:
+            for name, seconds in timings:
+                self._timing(self._callables, (table, mode, name)).add(seconds)
+            item = (total, next(self._counter), table, mode, i)
+            if len(self._documents) < self.n:
+                heapq.heappush(self._documents, item)
+            elif total > self._documents[0][0]:
+                heapq.heapreplace(self._documents, item)
+        return res
+
+    def read(self, cursor, doc, reader):
+        """
+        runs the reader chain on doc, timing each callable
+        """
+        return self._run(cursor, doc, reader, 'read')
+
+    def write(self, cursor, doc, writer):
+        """
+        runs the writer chain on doc, timing each callable
+        """
+        return self._run(cursor, doc, writer, 'write')
+
+    @staticmethod
+    def _report(timings, columns, table = None):
+        rows = [dict(zip(columns, key), count = t.count, seconds = t.seconds, mean = t.seconds / t.count, max = t.max)
+                for key, t in timings.items() if table is None or key[0] == table]
+        return dictable(sorted(rows, key = lambda row: -row['seconds']))
+
+    def callables(self, table = None):
+        """
+        time spent per table and reader/writer callable, slowest first
+        """
+        with self._lock:
+            return self._report(self._callables, ['table', 'mode', 'callable'], table)
+
+    def fields(self, table = None):
+        """
+        time spent decoding each top-level field, per table, slowest first
+        """
+        with self._lock:
+            return self._report(self._fields, ['table', 'field', 'type'], table)
+
+    def types(self, table = None):
+        """
+        time spent decoding fields of each stored type, per table, slowest first
+        """
+        with self._lock:
+            timings = {}
+            for (t, field, kind), timing in self._fields.items():
+                res = self._timing(timings, (t, kind))
+                res.count += timing.count
+                res.seconds += timing.seconds
+                res.max = max(res.max, timing.max)
+            return self._report(timings, ['table', 'type'], table)
+
+    def documents(self, table = None):
+        """
+        the slowest documents to read or write, slowest first
+        """
+        with self._lock:
+            rows = [Dict(table = t, mode = mode, _id = i, seconds = seconds) for seconds, _, t, mode, i in sorted(self._documents, reverse = True)]
+        return dictable([row for row in rows if table is None or row.table == table])
+
+    def __repr__(self):
+        return 'decode_profiler(enabled = %s)\n%s'%(self.enabled, self.types())
+
+
+profiler = decode_profiler()
@@ -1,15 +1,13 @@
 import re
-import numpy as np
 import datetime
 from collections import Counter
 
 from pyg_base import is_bool, try_back, replace, alphabet, ALPHABET, is_str, \
     as_list, logger, tree_repr, NoneType
-from pyg_encoders import encode
 
-from operator import and_, or_
-from functools import reduce
 from bson import ObjectId
+import bisect
+import sys
 
 
 __all__ = ['Q','q', 'mdict']
@@ -21,7 +19,8 @@ _regex = '$regex'
 _bin = 'bin'
 _and = '$and'
 _or = '$or'
-_not_in = '$nin'
+_nor = '$nor'
+_all = '$all'
 _eq = '$eq'
 _ne = '$ne'
 _ge = '$gte'
@@ -41,14 +40,13 @@ _prev = '_prev'
 _data = 'data'
 _doc = 'doc'
 _deleted = 'deleted'
+_updated = '_updated'
 _options = '$options'
 
 
 
 _type2bson = {float : [1,19], 
               str : 2,
-              np.nan : 10, 
-              np.ndarray : 4, 
               _id : 7, 
               _js : [13,15], 
               bool : 8, 
@@ -60,6 +58,8 @@ _type2bson = {float : [1,19],
               int : [16,18]
               }
 
+_np_type2bson = dict(nan = 10, ndarray = 4) ## numpy objects, resolved only if numpy is loaded
+
 _sorted = try_back(sorted)
 
 def _is_query(query):
@@ -118,37 +118,295 @@ def _case_proxies(keys):
     return res
     
 
-def _as_items(query):
+_q_lists = (_and, _or, _nor)
+_v_lists = (_in, _not_in, _all)
+_literals = (_eq, _ne)
+
+
+def _sorted_tuple(values):
+    try:
+        return tuple(sorted(values))
+    except TypeError:
+        return tuple(values)
+
+
+def _hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return (type(value).__name__, repr(value))
+
+
+def _canonical(value, literal = False):
     """
-    converts a query into keys and tuples
+    converts a query into a hashable canonical form.
+    Sibling conditions, operator documents and $in/$nin values are order-independent and are sorted. 
+    Literal values (e.g. of $eq) keep their order as {"a": {"$eq": [1,2]}} and {"a": {"$eq": [2,1]}} are different queries.
+    
+    :Example:
+    ---------
+    >>> assert _canonical(q(a = 1, b = [1,2])) == _canonical({'$and': [{'b': {'$in': [2,1]}}, {'a': {'$eq': 1}}]})
+    >>> assert _canonical(q.a == [[1,2]]) != _canonical(q.a == [[2,1]])
     """
-    if query is None:
-        return []
-    elif isinstance(query, dict):
-        return _sorted([(key, _as_items(value)) for key, value in query.items()])
-    elif isinstance(query, list):
-        return _sorted([_as_items(key) for key in query])
+    if isinstance(value, dict):
+        if literal:
+            return tuple((key, _canonical(v, True)) for key, v in value.items())
+        return _sorted_tuple([(key, _canonical_op(key, v)) for key, v in value.items()])
+    elif isinstance(value, (list, tuple)):
+        values = [_canonical(v, literal) for v in value]
+        return tuple(values) if literal else _sorted_tuple(values)
     else:
-        return query
+        return _hashable(value)
 
-def _q_set(values):
-    if len(values) > 1:
-        values = _sorted(values, key = _as_items)
-        items = [_as_items(v) for v in values]
-        values = [values[i] for i in range(len(values)) if i ==0 or items[i]!=items[i-1]]
-        return values[1:] if items[0] == [] else values
-    elif len(values) == 1:
-        return [] if _as_items(values[0]) == [] else values
+
+def _canonical_op(key, value):
+    if not isinstance(value, (list, tuple, dict)):
+        return _hashable(value)
+    elif key in _q_lists:
+        return _sorted_tuple([_canonical(v) for v in value])
+    elif key in _v_lists:
+        return _sorted_tuple([_canonical(v, True) for v in value])
+    elif key.startswith('$'):
+        return _canonical(value, literal = key in _literals or not isinstance(value, dict))
+    else: ## a field: either an operator document or a literal document to match
+        return _canonical(value, literal = not (isinstance(value, dict) and len(value) and min([k.startswith('$') for k in value])))
+
+
+def _q_key(query):
+    """
+    returns the canonical form of a query, cached on mdict 
+    """
+    if isinstance(query, mdict):
+        res = query.__dict__.get('_canon')
+        if res is None:
+            res = query._canon = _canonical(query)
+        return res
+    return _canonical(query)
+
+
+def _q_items(query, key):
+    """
+    yields the (canonical, query) pairs of the queries combined by key, flattening nested key queries and dropping empty ones
+    """
+    if isinstance(query, mdict) and query.__dict__.get('_chained') == key:
+        for item in zip(query._keys, query[key]):
+            yield item
+    elif isinstance(query, dict) and len(query) == 1 and key in query and isinstance(query[key], list):
+        for value in query[key]:
+            for item in _q_items(value, key):
+                yield item
+    elif query:
+        yield _q_key(query), query
+
+
+def _q_combine(values, key, owned = None):
+    """
+    combines queries with key ($and/$or). This is linear in the number of queries combined (bar the sort): 
+    
+    - nested queries are flattened, 
+    - duplicates are removed using a hash of their canonical form 
+    - the canonical forms are cached on the result, so combining it further does not re-process its queries.
+    - if owned is the largest combined query and nothing else refers to it (e.g. the running result of reduce(and_, conditions)), its lists are extended in place rather than copied, so chaining n conditions one at a time is linear too.
+    """
+    chained = [value for value in values if isinstance(value, mdict) and value.__dict__.get('_chained') == key]
+    base = max(chained, key = lambda value: len(value._keys)) if chained else None
+    if base is None:
+        keys, queries, seen, ordered = [], [], set(), True
+    elif base is owned:
+        keys, queries, seen, ordered = base._keys, base[key], base._seen, base._ordered
     else:
-        return values
+        keys, queries, seen, ordered = list(base._keys), list(base[key]), set(base._seen), base._ordered
+    new = [item for value in values if value is not base for item in _q_items(value, key)]
+    if len(new) < 8 and ordered:
+        for k, value in new:
+            if k not in seen:
+                seen.add(k)
+                try:
+                    i = bisect.bisect_right(keys, k)
+                except TypeError:
+                    i = len(keys)
+                    ordered = False
+                keys.insert(i, k)
+                queries.insert(i, value)
+    else:
+        for k, value in new:
+            if k not in seen:
+                seen.add(k)
+                keys.append(k)
+                queries.append(value)
+        if ordered:
+            try:
+                order = sorted(range(len(keys)), key = keys.__getitem__)
+                keys[:] = [keys[i] for i in order]
+                queries[:] = [queries[i] for i in order]
+            except TypeError:
+                ordered = False
+    if len(queries) == 0:
+        return mdict()
+    elif len(queries) == 1:
+        res = queries[0]
+        return res if isinstance(res, mdict) else mdict(res)
+    res = mdict({key : queries})
+    res._chained = key
+    res._keys = keys
+    res._seen = seen
+    res._ordered = ordered
+    return res
+
+
+def _q_set(values):
+    """
+    sorts and removes duplicate and empty queries
+    """
+    res = {}
+    for value in values:
+        if value:
+            res.setdefault(_q_key(value), value)
+    return [res[key] for key in _sorted(list(res))]
+
+
+_scalars = (str, int, float, ObjectId, datetime.datetime, NoneType) ## types encode leaves unchanged and that mkey.__eq__ maps to $eq. bool is not included as it maps to $in
+
+
+class mtemplate(object):
+    """
+    A compiled query of a fixed shape, created by Q.compile. 
+    The canonical order of the conditions is determined once, so binding values into the template avoids re-encoding, re-sorting and re-hashing the query.
+    Values that are not plain scalars (lists, bools, dicts, regex, arrays...) fall back to the generic q(...)
+    
+    :Example:
+    ---------
+    >>> tmpl = q.compile('name', 'surname', q.age > 30)
+    >>> assert tmpl(name = 'james', surname = 'joyce') == q(q.age > 30, name = 'james', surname = 'joyce')
+    >>> assert tmpl(name = ['james', 'jim'], surname = 'joyce') == q(q.age > 30, name = ['james', 'jim'], surname = 'joyce') ## generic
+    """
+    def __init__(self, query, fields, fixed):
+        self._q = query
+        self._fixed = fixed
+        self._fields = {field: query[field]._key for field in fields}
+        items = [item for value in fixed for item in _q_items(value, _and)]
+        items = list(dict(items).items())
+        names = [key[0][0] for key, _ in items] + list(self._fields.values())
+        self._compiled = len(set(names)) == len(names) ## if a field appears twice, the order depends on the values
+        if self._compiled:
+            slots = sorted([(key[0][0], key, value) for key, value in items] + [(name, field, None) for field, name in self._fields.items()], key = lambda slot: slot[0])
+            self._keys = [key if value is not None else None for _, key, value in slots]
+            self._queries = [value for _, _, value in slots]
+            self._slots = [(i, key, name) for i, (name, key, value) in enumerate(slots) if value is None]
+
+    def _generic(self, **values):
+        return self._q(*self._fixed, **values)
+
+    def __call__(self, **values):
+        if not self._compiled or len(values) != len(self._slots):
+            return self._generic(**values)
+        keys = self._keys[:]
+        queries = self._queries[:]
+        for i, field, name in self._slots:
+            if field not in values or type(values[field]) not in _scalars:
+                return self._generic(**values)
+            value = values[field]
+            keys[i] = ((name, ((_eq, value),)),)
+            queries[i] = mdict({name : {_eq : value}})
+        if len(queries) == 0:
+            return mdict()
+        elif len(queries) == 1:
+            return queries[0]
+        res = mdict({_and : queries})
+        res._chained = _and
+        res._keys = keys
+        res._seen = set(keys)
+        res._ordered = True
+        return res
+
+    def __repr__(self):
+        return 'mtemplate(%s)'%', '.join(['%s = ?'%field for field in self._fields] + [str(dict(value)) for value in self._fixed])
+
+
+def _q_prefix(query, prefix):
+    """
+    prefixes all the fields referenced in a query, e.g. to match against 'fullDocument' in a change stream
+    
+    :Example:
+    ---------
+    >>> assert _q_prefix(q(a = 1, b = 2), 'fullDocument.') == {'$and': [{'fullDocument.a': {'$eq': 1}}, {'fullDocument.b': {'$eq': 2}}]}
+    """
+    if isinstance(query, dict):
+        res = {}
+        for key, value in query.items():
+            if key in (_and, _or, _nor):
+                res[key] = [_q_prefix(v, prefix) for v in value]
+            elif key == _not:
+                res[key] = _q_prefix(value, prefix)
+            elif key.startswith('$'):
+                res[key] = value
+            else:
+                res[prefix + key] = value
+        return type(query)(res)
+    return query
 
 def _q_and(values):
-    values = _q_set(values)
-    return reduce(and_, values) if len(values)>0 else mdict()
+    return _q_combine(values, _and)
 
 def _q_or(values):
-    values = _q_set(values)
-    return reduce(or_, values) if len(values)>0 else mdict()
+    return _q_combine(values, _or)
+
+
+def _array_values(value):
+    """
+    converts 1-d numpy arrays, pandas Index/Series and pyarrow arrays into a list of unique BSON-ready values, vectorized by dtype.
+    Returns None for anything else, e.g. a DataFrame.
+    
+    :Example:
+    ---------
+    >>> assert _array_values(np.array([3,1,3])) == [1,3]
+    >>> assert _array_values(pd.to_datetime(['2020-01-01'])) == [datetime.datetime(2020,1,1)]
+    >>> assert _array_values([1,2]) is None
+    >>> assert _array_values(pd.DataFrame(dict(a = [1,2]))) is None
+    """
+    np = sys.modules.get('numpy') ## if numpy is not loaded, value cannot be an array
+    if np is None or getattr(value, 'ndim', 1) != 1:
+        return None
+    if not isinstance(value, np.ndarray):
+        if not (hasattr(value, 'to_numpy') and type(value).__module__.split('.')[0] in ('pandas', 'pyarrow')):
+            return None
+        try:
+            value = value.to_numpy(zero_copy_only = False) if type(value).__module__.startswith('pyarrow') else value.to_numpy()
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(value, np.ndarray) or value.ndim != 1:
+            return None
+    kind = value.dtype.kind
+    if kind == 'M':
+        return np.unique(value).astype('datetime64[us]').tolist()
+    elif kind in 'iufbUS':
+        return np.unique(value).tolist()
+    values = value.tolist()
+    try:
+        values = list(dict.fromkeys(values))
+    except TypeError:
+        pass
+    return [_encode(v) for v in values]
+
+
+_plain = _scalars + (bool,) ## types encode leaves unchanged
+
+
+def _encode(value):
+    """
+    encodes a query value for mongo. Plain scalars, and lists or operator documents of plain scalars, are returned as they are (copied), 
+    so pyg_encoders is only imported once something else is encoded and importing q stays light.
+    """
+    tp = type(value)
+    if tp in _plain:
+        return value
+    elif tp is list and all(type(v) in _plain for v in value):
+        return list(value)
+    elif tp is dict and all(type(v) in _plain or (type(v) is list and all(type(w) in _plain for w in v)) for v in value.values()):
+        return {k : list(v) if type(v) is list else v for k, v in value.items()}
+    from pyg_encoders import encode
+    return encode(value, unchanged = ObjectId)
 
 
 class mkey(object):
@@ -179,8 +437,9 @@ class mkey(object):
     def __call__(self, **kwargs):
         return _q_and([self[key] == value for key, value in kwargs.items()])
     
-    def _set(self, other):
-        other = encode(other, unchanged = ObjectId)
+    def _set(self, other, encoded = False):
+        if not encoded:
+            other = _encode(other)
         return mdict({self._key : other})
     
     def __pos__(self):
@@ -206,7 +465,10 @@ class mkey(object):
                 return self._set({_regex : other.pattern, _options: 'i'})
             else:                
                 return self._set({_regex : other.pattern})
-        other = encode(other, unchanged = ObjectId)
+        values = _array_values(other)
+        if values is not None:
+            return self._set({_eq: values[0]} if len(values) == 1 else {_in : values}, encoded = True)
+        other = _encode(other)
         if isinstance(other, list):
             if len(other) == 1:
                 return self._set({_eq: other[0]})
@@ -222,7 +484,10 @@ class mkey(object):
     def __ne__(self, other):
         if isinstance(other, re.Pattern):
             return self._set({_not : {_regex : other.pattern}})
-        elif isinstance(other, list):
+        values = _array_values(other)
+        if values is not None:
+            return self._set({_ne : values[0]} if len(values) == 1 else {_not_in : values}, encoded = True)
+        if isinstance(other, list):
             if len(other) == 1:
                 return self._set({_ne : other})
             else:
@@ -261,7 +526,9 @@ class mkey(object):
         """
          see https://docs.mongodb.com/manual/reference/operator/type  
         """
-        bson_types = _sorted(set(sum([as_list(_type2bson.get(t)) for t in types],[])))
+        np = sys.modules.get('numpy')
+        np_types = {getattr(np, name) : value for name, value in _np_type2bson.items()} if np else {}
+        bson_types = _sorted(set(sum([as_list(np_types.get(t, _type2bson.get(t))) for t in types],[])))
         return self._set({_type : bson_types})
 
 
@@ -302,28 +569,28 @@ class modkey(object):
     
 class mdict(dict):
     def _chain(self, other, key):
+        owned = _owned_refs and sys.getrefcount(self) <= _owned_refs ## self is only held by the expression being evaluated
         rollback = False
         if not isinstance(other, dict):
             _mkey = other
             other = +other
             rollback = True
-        if list(self.keys()) == [key]:
-            res = mdict({key : list(self[key])})
-            res[key].append(other)
-        elif list(other.keys()) == [key]:
-            res = mdict({key : list(other[key])})
-            res[key].append(self)
-        else:
-            res = mdict({key : [self, other]})
-        if rollback:
+        res = _q_combine([self, other], key, owned = None if rollback else self if owned else None)
+        if rollback and res is not self and res is not other:
             res._mkey = _mkey
             res._prev = self
             res._key = key
-        res[key] = _q_set(res[key])
-        if len(res[key]) == 1:
-            return self
-        else:
-            return res
+        return res
+
+    def __setitem__(self, key, value):
+        for attr in ('_canon', '_chained', '_match'):
+            self.__dict__.pop(attr, None)
+        super(mdict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        for attr in ('_canon', '_chained', '_match'):
+            self.__dict__.pop(attr, None)
+        super(mdict, self).__delitem__(key)
     
     def __and__(self, other):
         return self._chain(other, _and)
@@ -395,7 +662,27 @@ class mdict(dict):
 
     def __str__(self):
         return 'M%s'%(dict(self).__str__().replace('M{', '{'))
-    
+
+
+def _owned_refs_count():
+    """
+    the reference count mdict._chain sees for a query held only by the expression being evaluated, e.g. the running result of reduce(and_, conditions).
+    Returns 0 (never extend in place) if the interpreter does not tell it apart from a query also held by a variable.
+    """
+    if not hasattr(sys, 'getrefcount'):
+        return 0
+    counts = []
+    class probe(mdict):
+        def _chain(self, other, key):
+            counts.append(sys.getrefcount(self))
+            return self
+    probe() & {}
+    held = probe()
+    held & {}
+    return counts[0] if counts[0] < counts[1] else 0
+
+_owned_refs = _owned_refs_count()
+
 
 class Q(dict):
     """
@@ -462,6 +749,31 @@ class Q(dict):
         values = [self[key] == value for key, value in kwargs.items()] + [self[arg] for arg in args]
         return _q_and(values)
     
+    def compile(self, *conditions, **fixed):
+        """
+        compiles a query template. Use this when a query of the same shape is built many times with different values.
+
+        :Parameters:
+        ----------------
+        *conditions : str or dict
+            strings are the fields whose values are bound later. Queries are fixed conditions included in every query.
+        **fixed : 
+            further fixed conditions, as in q(**fixed)
+
+        :Returns:
+        -------
+        mtemplate
+            call it with the field values to get the query
+
+        :Example:
+        ---------
+        >>> tmpl = q.compile('name', 'surname', q.age > 30)
+        >>> assert tmpl(name = 'james', surname = 'joyce') == q(q.age > 30, name = 'james', surname = 'joyce')
+        """
+        fields = [condition for condition in conditions if is_str(condition)]
+        queries = [self[condition] for condition in conditions if not is_str(condition)] + ([self(**fixed)] if fixed else [])
+        return mtemplate(self, fields, queries)
+
     def __getitem__(self, value):
         if isinstance(value, list) and min([isinstance(v, (dict, list, NoneType)) for v in value], default = True):
             values = [self[v] for v in value]
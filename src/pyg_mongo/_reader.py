@@ -1,15 +1,62 @@
-from pyg_base import as_list, is_strs, is_str, is_dict, is_int, dictable
-from pyg_mongo._q import _id, _doc, q, _set
-from pyg_mongo._base_reader import mongo_base_reader, _items1
+from pyg_base import as_list, is_strs, is_str, is_dict, is_int, dictable, Dict
+from pyg_mongo._q import _id, _doc, q, _and, _set, _deleted, _updated, _q_prefix
+from pyg_mongo._base_reader import mongo_base_reader, _items1, _dict1
+from pyg_mongo._cache import doc_cache, single_flight, _doc_caches, _result_caches, _flights, _copy
+from pyg_mongo._chunked import _find, _count, _specs, _with_keys, _sort_key
+from pyg_mongo._pipeline import mongo_pipeline
+from pyg_mongo._monitor import monitored, monitor
+from pyg_mongo._advisor import advisor
 import datetime
 
 __all__ = ['mongo_reader']
 
 
+def _pk_values(doc, keys):
+    """
+    returns a hashable tuple of the primary key values of a document
+    """
+    res = tuple(doc.get(key) for key in keys)
+    try:
+        hash(res)
+        return res
+    except TypeError:
+        return repr(res)
+
+
+def _id_conditions(spec):
+    """
+    the conditions of a query on _id, ignoring all others: a query matching (at least) the documents of spec, given only their _id
+    
+    :Example:
+    ---------
+    >>> assert _id_conditions(q(_id = 1, a = 2)) == q(_id = 1)
+    >>> assert _id_conditions(q(a = 2)) == {}
+    """
+    if not spec:
+        return q()
+    if _id in spec:
+        return q({_id : spec[_id]})
+    return q(*[{_id : condition[_id]} for condition in spec.get(_and, []) if _id in condition])
+
+
+def _item_key(item):
+    """
+    a hashable key for the item read, or None
+    """
+    if is_int(item):
+        return item
+    elif isinstance(item, slice):
+        return (item.start, item.stop, item.step)
+    elif isinstance(item, (list, range, tuple)):
+        return ('list', tuple(item))
+    return None
+
+
 class mongo_reader(mongo_base_reader):
+    __slots__ = ()
     
     def _assert_one_or_none(self):
-        n = self.count()
+        n = _count(self.collection, self._spec) ## not cached or coalesced: writers decide insert vs replace on this count
         if n>1:
             pk = self._pk
             if pk:
@@ -18,7 +65,7 @@ class mongo_reader(mongo_base_reader):
                     if len(multiple_values) > 1:
                         raise KeyError('too many %s = %s found'%(key, multiple_values))
                 self = self.dedup()
-                n = self.count()
+                n = _count(self.collection, self._spec)
                 if n <= 1:
                     return n
             raise ValueError('%s\nNon-unique %i documents %s... e.g. \n%s'%(self.collection, n, self._spec, self.read(slice(None,3,None))))
@@ -37,11 +84,16 @@ class mongo_reader(mongo_base_reader):
             res = res.find(self._id(doc))
         return res._assert_unique()
 
+    @monitored
     def read_one(self, doc = None, *args, **kwargs):
         reader = kwargs.pop('reader', None)
-        return self.find_one(doc, *args, **kwargs).read(0, reader = reader)
+        target = self.find(*args, **kwargs)
+        if doc:
+            target = target.find(self._id(doc))
+        return target._coalesce(('read_one',), lambda: target._assert_unique().read(0, reader = reader), reader)
                     
 
+    @monitored
     def read(self, item = 0, reader = None):
         """
         reads the next document from the collection.
@@ -62,10 +114,19 @@ class mongo_reader(mongo_base_reader):
         item = 0
 
         """
-        cursor = self.cursor
+        key = _item_key(item)
+        if key is None:
+            return self._read_item(item, reader)
+        return self._coalesce(('read', key), lambda: self._read_item(item, reader), reader)
+
+    def _read_item(self, item = 0, reader = None):
         if is_int(item):
             if item < 0:
                 item = self.count() + item
+            caches = self._caches(reader)
+            if caches:
+                return self._read_cached(item, caches)
+            cursor = self.cursor
             if item > 0:
                 cursor = cursor.skip(item)
             doc = cursor.next()
@@ -78,7 +139,151 @@ class mongo_reader(mongo_base_reader):
         elif isinstance(item, (list, range, tuple)):
             return [self.read(i, reader = reader) for i in item]
 
-    
+
+    def use_cache(self, *caches, **kwargs):
+        """
+        Enables a read-through cache of decoded documents for the collection. 
+        The cache is shared by all cursors on the collection and is invalidated by writes made through mongo_cursor/mongo_pk_cursor in this process.
+        Only reads using the default reader and no projection are cached.
+
+        :Parameters:
+        ----------
+        *caches : doc_cache/disk_cache
+            caches to use, checked in order. Use use_cache(None) to disable caching.
+        **kwargs :
+            if no caches are provided, parameters for a new doc_cache: entries, nbytes, ttl, revalidate
+
+        :Returns:
+        -------
+        itself
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test', pk = 'key').use_cache(entries = 10000, ttl = 60)
+        >>> t.caches[0].stats        
+        """
+        if not caches:
+            caches = [doc_cache(**kwargs)]
+        caches = [cache for cache in caches if cache is not None and cache is not False]
+        if caches:
+            _doc_caches[self.collection] = caches
+        else:
+            _doc_caches.pop(self.collection, None)
+        return self
+
+    @property
+    def caches(self):
+        return _doc_caches.get(self.collection, [])
+
+    def use_result_cache(self, ttl = 1, entries = 10000):
+        """
+        Memoizes count(), len() and distinct(key) results for the collection, keyed by the cursor fingerprint.
+        Results are dropped after ttl seconds and on any write made through mongo_cursor/mongo_pk_cursor in this process.
+        
+        :Parameters:
+        ----------
+        ttl : float
+            seconds a result is valid for, bounding how stale writes by other processes can be. Use use_result_cache(None) to disable.
+        entries : int
+            maximum number of results held
+
+        :Returns:
+        -------
+        itself
+        
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test').use_result_cache(ttl = 5)
+        >>> t.name ## a server distinct
+        >>> t.name ## cached
+        """
+        if ttl is None or ttl is False:
+            _result_caches.pop(self.collection, None)
+        else:
+            _result_caches[self.collection] = doc_cache(entries = entries, ttl = ttl)
+        return self
+
+    def use_single_flight(self, enabled = True):
+        """
+        Coalesces concurrent identical read/read_one/count/distinct calls on the collection (same cursor fingerprint, item and reader): 
+        one server call is made and its decoded result is shared, see single_flight.
+
+        :Returns:
+        -------
+        itself
+        """
+        if enabled:
+            _flights.setdefault(self.collection, single_flight())
+        else:
+            _flights.pop(self.collection, None)
+        return self
+
+    @property
+    def flight(self):
+        """
+        the single_flight of the collection, if enabled. flight.stats shows how many calls were coalesced.
+        """
+        return _flights.get(self.collection)
+
+    def _coalesce(self, key, calc, reader = None):
+        flight = _flights.get(self.collection)
+        if flight is None:
+            return calc()
+        key = (self.fingerprint, self.reader, reader) + key
+        try:
+            hash(key)
+        except TypeError:
+            return calc()
+        return flight(key, calc)
+
+    def _cached(self, key, calc):
+        """
+        returns calc(), memoized in the result cache of the collection if there is one
+        """
+        cache = _result_caches.get(self.collection)
+        if cache is None:
+            return calc()
+        key = (self.collection.full_name, self.fingerprint) + key
+        res = cache.get(key)
+        if res is None:
+            res = cache.put(key, calc())
+        return res
+
+    @monitored
+    def distinct(self, key):
+        return self._coalesce(('distinct', key), lambda: self._cached(('distinct', key), lambda: super(mongo_reader, self).distinct(key)))
+
+    def _caches(self, reader = None):
+        if reader is None and self.reader is None and self.projection is None:
+            return _doc_caches.get(self.collection)
+
+    def _read_cached(self, item, caches):
+        """
+        reads the item-th document via the caches, see use_cache
+        """
+        name = self.collection.full_name
+        raw = None
+        if caches[0].revalidate:
+            stub = _find(self.collection, self._spec, {_id : 1, _updated : 1}, sort = self._sort).skip(item).limit(1).next()
+            key = (name, stub[_id], stub.get(_updated))
+        else:
+            raw = _find(self.collection, self._spec, self._projection, sort = self._sort).skip(item).limit(1).next()
+            key = (name, raw[_id], raw.get(_updated))
+        for i, cache in enumerate(caches):
+            doc = cache.get(key)
+            if doc is not None:
+                for c in caches[:i]:
+                    c.put(key, doc)
+                return doc
+        if raw is None:
+            raw = self.collection.find_one({_id : key[1]})
+            if raw is None: ## deleted since we looked
+                return self._read_cached(item, caches)
+        doc = self._read(raw)
+        for cache in caches:
+            cache.put(key, doc, raw)
+        return _copy(doc)
+
     def __getitem__(self, item):
         if is_str(item):
             return self.distinct(item)
@@ -87,6 +292,7 @@ class mongo_reader(mongo_base_reader):
         else:
             return self.read(item)
             
+    @monitored
     def docs(self, *keys, doc = _doc):
         """
         self[::] flattens the entire document.
@@ -100,6 +306,55 @@ class mongo_reader(mongo_base_reader):
         return res
 
 
+    def aggregate(self, *stages):
+        """
+        starts an aggregation pipeline from the cursor's filter, sort and projection, see mongo_pipeline.
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test')
+        >>> t.aggregate({'$unwind': '$tags'}).group(by = 'tags', n = 'count')[::]
+        """
+        return mongo_pipeline(self).append(*stages)
+
+    def group(self, by = None, **aggregations):
+        """
+        groups the cursor's documents on the server, see mongo_pipeline.group
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test')
+        >>> t.insert_many(dictable(name = ['a', 'b', 'a'], x = [1, 2, 3]))
+        >>> assert t.group(by = 'name', total = ('sum', 'x'), n = 'count').sort('name')[::] == dictable(name = ['a', 'b'], total = [4, 2], n = [2, 1])
+        """
+        return mongo_pipeline(self).group(by, **aggregations)
+
+    def join(self, right, on, how = 'left', projection = None):
+        """
+        joins the cursor's documents with those of a cursor on another collection in the same database, on the server. see mongo_pipeline.join
+
+        :Example:
+        ---------
+        >>> trades = mongo_table('trades', 'test')
+        >>> instruments = mongo_table('instruments', 'test')
+        >>> trades.join(instruments.inc(active = True), on = 'ticker', how = 'inner')[::]
+        """
+        return mongo_pipeline(self).join(right, on = on, how = how, projection = projection)
+
+    def stats(self):
+        """
+        returns the command statistics of the table, per originating method. see mongo_monitor
+
+        :Example:
+        ---------
+        >>> from pyg_mongo import monitor
+        >>> monitor.enable()
+        >>> t = mongo_table('test', 'test', pk = 'key')
+        >>> t.insert_one(dict(key = 1))
+        >>> assert t.stats().inc(method = 'insert_one').calls == [1]
+        """
+        return monitor.stats(self.collection.full_name)
+
     def create_index(self, *keys):
         keys = as_list(keys) or self._pk
         if len(keys) > 0:
@@ -109,10 +364,20 @@ class mongo_reader(mongo_base_reader):
     def keys(self, item = 0):
         return self.read(item).keys()
 
+    @monitored
     def count(self):
-        return self.collection.count_documents(self._spec)
+        if advisor.enabled:
+            advisor.record(self)
+        return self._coalesce(('count',), lambda: self._cached(('count',), lambda: _count(self.collection, self._spec)))
 
-    __len__ = count    
+    def __len__(self):
+        """
+        as count(), but uses the collection metadata for an unfiltered cursor
+        """
+        spec = self._spec
+        if spec:
+            return self.count()
+        return self._cached(('len',), self.collection.estimated_document_count)
 
     def __repr__(self):
         n = len(self)
@@ -147,10 +412,178 @@ class mongo_reader(mongo_base_reader):
         This means often unexpected behaviour and in particular can lead to infinite loops too.
         We therefore choose to fix the _ids in advance.
         """
-        _ids = self.collection.distinct(_id, self._spec)
+        _ids = _find(self.collection, self._spec).distinct(_id)
         for i in _ids:
             yield self.inc({_id : i}).read(0)
             
+    def as_of(self, timestamp, reader = None):
+        """
+        Iterates over the documents as they were at a point in time, reconciling the live collection with its deleted_ history.
+
+        For each primary key (or _id if no pk), the version live at timestamp is:
+
+        - the earliest historic version deleted after timestamp, if there is one
+        - the live version otherwise
+
+        Versions created (stamped with _updated) after timestamp are ignored. The cursor projection and sort apply; a sorted result is sorted in memory.
+
+        :Note:
+        ------
+        MongoDB $unionWith cannot span databases and the history lives in deleted_<db>.
+        We therefore reduce the history to a single version per key server-side and stream the live documents for the remaining keys.
+        The history lookup is supported by the pk + deleted index, see mongo_cursor.retain()
+
+        :Parameters:
+        ----------
+        timestamp : datetime
+            the point in time.
+        reader : callable/list of callables, optional
+            reader to apply to the documents. The default is None, using the cursor reader.
+
+        :Returns:
+        -------
+        generator of documents
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test', pk = 'key')
+        >>> t.insert_one(dict(key = 1, value = 'old'))
+        >>> then = datetime.datetime.now()
+        >>> t.insert_one(dict(key = 1, value = 'new'))
+        >>> assert [doc['value'] for doc in t.as_of(then)] == ['old']
+        >>> assert dictable(list(t.as_of(datetime.datetime.now()))).value == ['new']
+        """
+        if self._is_deleted():
+            raise ValueError('as_of should be called on the live collection rather than on %s'%self.collection.full_name)
+        keys = self._pk or [_id]
+        projection, extra = _with_keys(self._projection, keys + [_updated] + [key for key, _ in self._sort or []])
+        existed = q(q[_updated] <= timestamp) | q[_updated].not_exists ## documents written before pk tables were stamped have no _updated
+        history = self.deleted
+        pipeline = [{'$match' : q(history._spec, q[_deleted] > timestamp, existed)},
+                    {'$sort' : dict([(key, -1) for key in keys] + [(_deleted, 1)])}, ## walks the (pk, -deleted) index backwards
+                    {'$group' : {_id : {key : '$%s'%key for key in keys}, _doc : {'$first' : '$$ROOT'}}},
+                    {'$replaceRoot' : {'newRoot' : '$' + _doc}}]
+        if projection:
+            pipeline.append({'$project' : projection})
+        def docs():
+            seen = set()
+            for doc in history.collection.aggregate(pipeline, allowDiskUse = True):
+                seen.add(_pk_values(doc, keys))
+                doc.pop(_deleted, None)
+                yield doc
+            for doc in _find(self.collection, self._spec, projection):
+                if _pk_values(doc, keys) not in seen and not (doc.get(_updated) and doc[_updated] > timestamp): ## not created after timestamp
+                    yield doc
+        res = docs()
+        if self._sort:
+            res = sorted(res, key = _sort_key(self._sort))
+        for doc in res:
+            for key in extra:
+                doc.pop(key, None)
+            yield self._read(doc, reader = reader)
+
+    @monitored
+    def since(self, token = None, reader = None, window = 5):
+        """
+        Returns the changes to the cursor documents since a bookmark.
+        For primary-keyed tables, _write stamps an '_updated' timestamp on every document written, and deleted documents are kept in deleted_ collection.
+
+        The stamp is taken by the writer's clock before the write is committed, so a write stamped just before this call may only become visible after it.
+        The bookmark returned is therefore held back by window seconds: a change is not missed provided it commits within window seconds of being stamped 
+        (and the clocks of the writers and of this process agree to within window seconds). In exchange, changes made within window seconds of a call are returned again by the next call.
+
+        :Parameters:
+        ----------
+        token : datetime, optional
+            the bookmark returned by the previous call. The default is None, returning all documents.
+        reader : callable/list of callables, optional
+            reader to apply to the documents. The default is None, using the cursor reader.
+        window : float
+            the safety window, in seconds, by which the bookmark is held back. The default is 5.
+
+        :Returns:
+        -------
+        Dict
+            upserted: a dictable of documents inserted or updated since token
+            deleted: a dictable of the primary keys of documents deleted since token and not since re-inserted
+            token: the bookmark to be used for the next call
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test', pk = 'key')
+        >>> res = t.since()
+        >>> t.insert_one(dict(key = 1, value = 1))
+        >>> t.inc(key = 2).delete_many()
+        >>> res = t.since(res.token)
+        >>> assert res.upserted.key == [1]
+        """
+        pk = self._pk
+        if not pk:
+            raise ValueError('since() requires a table with primary keys as only these are stamped with %s'%_updated)
+        now = datetime.datetime.now() - datetime.timedelta(seconds = window)
+        now = now.replace(microsecond = now.microsecond - now.microsecond % 1000) ## MongoDB stores milliseconds
+        if token is None:
+            return Dict(upserted = self.read(slice(None), reader = reader), deleted = dictable([], pk), token = now)
+        upserted = self.inc(q[_updated] >= token).read(slice(None), reader = reader)
+        history = self.deleted.inc(q[_deleted] >= token)
+        keys = [doc[_id] for doc in history.collection.aggregate([{'$match' : history._spec}, 
+                                                                   {'$group' : {_id : {key : '$%s'%key for key in pk}}}], allowDiskUse = True)]
+        if keys:
+            live = set(_pk_values(doc, pk) for doc in self.collection.find(q(self._spec, q[keys]), _dict1(pk)))
+            keys = [key for key in keys if _pk_values(key, pk) not in live]
+        return Dict(upserted = upserted, deleted = dictable(keys) if keys else dictable([], pk), token = now)
+
+    def watch(self, token = None, reader = None, pre_images = False, **kwargs):
+        """
+        Opens a change stream on the collection and returns a generator of changes to the cursor documents.
+        Requires MongoDB running as a replica set (a single-node replica set is enough).
+
+        A delete event carries only the _id of the document deleted, so deletes are filtered by the _id conditions of the cursor only:
+        a watcher on t.inc(key = 1) receives the deletes of all keys. Use pre_images = True to filter deletes by the full cursor spec.
+
+        :Parameters:
+        ----------
+        token : resume token, optional
+            the token of the last change processed. The default is None, watching changes from now on.
+        reader : callable/list of callables, optional
+            reader to apply to the documents. The default is None, using the cursor reader.
+        pre_images : bool
+            filter deletes using the document as it was before deletion. Requires MongoDB 6.0+ and changeStreamPreAndPostImages enabled on the collection. The default is False.
+        **kwargs :
+            passed to pymongo Collection.watch
+
+        :Returns:
+        -------
+        generator of Dict(operation, _id, doc, token)
+            for deletes, doc is None
+
+        :Example:
+        ---------
+        >>> t = mongo_table('test', 'test', pk = 'key')
+        >>> changes = t.watch()
+        >>> t.insert_one(dict(key = 1, value = 1))
+        >>> change = next(changes)
+        >>> assert change.operation == 'insert' and change.doc['value'] == 1
+        """
+        operations = ['insert', 'update', 'replace']
+        spec = self._spec
+        if pre_images:
+            kwargs['full_document_before_change'] = 'required'
+            deletes = _q_prefix(spec, 'fullDocumentBeforeChange.')
+        else:
+            deletes = _q_prefix(_id_conditions(spec), 'documentKey.')
+        match = q(q.operationType == operations, _q_prefix(spec, 'fullDocument.')) | q(q.operationType == 'delete', deletes)
+        stream = self.collection.watch([{'$match' : match}], full_document = 'updateLookup', resume_after = token, **kwargs)
+        def changes():
+            with stream:
+                for change in stream:
+                    doc = change.get('fullDocument')
+                    yield Dict(operation = change['operationType'], 
+                               _id = change['documentKey'][_id],
+                               doc = None if doc is None else self._read(doc, reader = reader), 
+                               token = change[_id])
+        return changes()
+
     def __getattr__(self, key):
         if key.startswith('_'):
             return super(mongo_reader, self).__getattr__(key)
@@ -158,6 +591,7 @@ class mongo_reader(mongo_base_reader):
             return self.distinct(key)
     
 
+    @monitored
     def dedup(self):
         """
         Although in principle, if a single process reads/writes to Mongo, we should not get duplicates. 
@@ -175,13 +609,17 @@ class mongo_reader(mongo_base_reader):
             bad = self(projection = pk)[::].sort(_id).listby(pk).inc(lambda _id: len(_id)>1) 
             if len(bad):
                 spec = q._id == sum(bad[lambda _id: _id[:-1]], [])
-                self.collection.update_many(spec, {_set : dict(deleted = datetime.datetime.now())})
+                for s in _specs(spec):
+                    self.collection.update_many(s, {_set : dict(deleted = datetime.datetime.now())})
                 if not self._is_deleted():
-                    docs = [doc for doc in self.collection.find(spec)]
+                    docs = [doc for doc in _find(self.collection, spec)]
                     ids = [doc[_id] for doc in docs]
-                    self.deleted.collection.delete_many(q(_id = ids))
+                    for s in _specs(q(_id = ids)):
+                        self.deleted.collection.delete_many(s)
                     self.deleted.collection.insert_many(docs)
-                self.collection.delete_many(spec)
+                for s in _specs(spec):
+                    self.collection.delete_many(s)
+                self._invalidate()
         return self
 
 
@@ -1,24 +1,141 @@
 from pyg_base import is_str, cfg_read, get_cache, cache
+from pyg_base import _cfg
 from pyg_mongo._reader import mongo_reader
 from pyg_mongo._cursor import mongo_cursor, mongo_pk_cursor
-
+from pyg_mongo._base_reader import _read_preference, _read_concern, _client_keys
+import threading
+import copy
+import os
 
 from pymongo import MongoClient
 
-__all__ = ['mongo_table']
+__all__ = ['mongo_table', 'mongo_cfg']
 
+_mongo_cfg_cache = get_cache('mongo_cfg')
+_clients = get_cache('mongo_client')
+_lock = threading.Lock()
 
-def _url(url):
+
+def _cfg_stamp():
     """
-    converts the URL address to actual url based on the cfg['mongo'] locations. see cfg_read() for help.
+    identifies the state of the config files: the PYG_CFG paths with the modification time and size of each file
     """
-    cfg = cfg_read()
-    mongo = cfg.get('mongo', {})
-    _url = url or 'null'
-    if _url in mongo:
-        return mongo[_url]
+    paths = _cfg.CFG.split(',') if isinstance(_cfg.CFG, str) else []
+    stamp = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamp.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stamp.append((path, None, None))
+    return tuple(stamp)
+
+
+def mongo_cfg(reload = False):
+    """
+    returns cfg['mongo'], the named mongo locations, see cfg_read().
+    The config files are re-read only when one of them changes (by modification time or size), or if reload = True.
+    The in-memory config is compared by value on every call, so cfg_write (or editing cfg_read()['mongo'] in place) is seen too.
+
+    A location is either a url or a dict of a url and MongoClient options:
+
+    >>> {"mongo": {"null": "mongodb://localhost:27017",
+    >>>            "prod": {"url": "mongodb://db1,db2,db3/?replicaSet=rs0", "maxPoolSize": 200, "compressors": "zstd", "readPreference": "secondaryPreferred"}}}
+
+    When the mongo locations change, the tables already opened are dropped from the mongo_table cache, so they are re-opened on the new location,
+    and the MongoClients of locations that now resolve elsewhere are closed. Tables still held on such a client can no longer be used.
+
+    :Parameters:
+    ----------------
+    reload : bool
+        re-read the config files even if they have not changed. The default is False.
+
+    :Example:
+    ---------
+    >>> cfg = cfg_read()
+    >>> cfg['mongo'] = dict(test = 'mongodb://localhost:27017')
+    >>> cfg_write(cfg)
+    >>> assert mongo_cfg()['test'] == 'mongodb://localhost:27017'
+    >>> assert _url('test') == 'mongodb://localhost:27017'
+    """
+    stamp = _cfg_stamp()
+    if reload or _mongo_cfg_cache.get('stamp') != stamp:
+        cfg = cfg_read()
+        _mongo_cfg_cache['stamp'] = stamp
     else:
-        return url
+        cfg = _cfg.CACHE.get('CFG', {})
+    mongo = cfg.get('mongo', {})
+    if mongo != _mongo_cfg_cache.get('mongo'):
+        with _lock:
+            _relocate(copy.deepcopy(mongo))
+    return _mongo_cfg_cache['mongo']
+
+
+def _resolve(mongo, key):
+    """
+    resolves a location name (or a url) against the mongo locations into a url and a tuple of sorted options
+    """
+    location = mongo.get(key, None if key == 'null' else key)
+    if isinstance(location, dict):
+        options = dict(location)
+        url = options.pop('url', options.pop('host', None))
+        return url, tuple(sorted(options.items()))
+    return location, ()
+
+
+def _relocate(mongo):
+    """
+    switches to new mongo locations: tables opened are forgotten and the clients of locations that resolve elsewhere are closed
+    """
+    urls = _mongo_cfg_cache.get('urls', {})
+    new = {key : _resolve(mongo, key) for key in urls}
+    stale = set((url, repr(options)) for key, (url, options) in urls.items() if new[key] != (url, options))
+    stale -= set((url, repr(options)) for url, options in new.values())
+    for key, client in list(_clients.items()):
+        if key[1:] in stale:
+            del _clients[key]
+            _client_keys.pop(id(client), None)
+            client.close()
+    _mongo_cfg_cache['urls'] = new
+    _mongo_cfg_cache['mongo'] = mongo
+    _mongo_table.clear_cache()
+
+
+def _location(url):
+    """
+    resolves a location (a name in cfg['mongo'], a url or a dict of a url and MongoClient options) into a url and a tuple of sorted options
+    """
+    if isinstance(url, dict):
+        return _resolve(dict(location = url), 'location')
+    mongo = mongo_cfg()
+    urls = _mongo_cfg_cache['urls']
+    key = url or 'null'
+    res = urls.get(key)
+    if res is None:
+        res = urls[key] = _resolve(mongo, key)
+    return res
+
+
+def _url(url):
+    """
+    converts the URL address to actual url based on the cfg['mongo'] locations. see cfg_read() and mongo_cfg() for help.
+    """
+    return _location(url)[0]
+
+
+def _client(client, url = None, options = ()):
+    """
+    returns a client per (client class, url, options), shared by all the tables opened on that location so they share its connection pool
+    """
+    key = (client, url, repr(options))
+    res = _clients.get(key)
+    if res is None:
+        with _lock:
+            res = _clients.get(key)
+            if res is None:
+                res = _clients[key] = client(url, **dict(options))
+                _client_keys[id(res)] = (url, options)
+    return res
     
 
 _mongo_table_cache = get_cache('mongo_table') 
@@ -27,7 +144,7 @@ _mongo_table_cache['r'] = mongo_reader, mongo_reader, MongoClient
 
 
 @cache
-def _mongo_table(table, db, pk = None, url = None, reader = None, writer = None, mode = 'w', **kwargs):    
+def _mongo_table(table, db, pk = None, url = None, reader = None, writer = None, mode = 'w', read_preference = None, tags = None, max_staleness = -1, read_concern = None, **kwargs):    
     if mode is None:
         mode = 'w'
     if is_str(mode):
@@ -37,15 +154,17 @@ def _mongo_table(table, db, pk = None, url = None, reader = None, writer = None,
     else:
         obj = mode
         client = MongoClient
-    url = _url(url)
-    c = client(url)[db][table]
+    url, options = _location(url)
+    c = _client(client, url, options)[db][table]
+    if read_preference is not None or read_concern is not None:
+        c = c.with_options(read_preference = _read_preference(read_preference, tags, max_staleness), read_concern = _read_concern(read_concern))
     res = obj(c, pk = pk, writer = writer, reader = reader, **kwargs)
     if isinstance(res, (mongo_reader)) and len(res) == 0:
          res.create_index()
     return res
 
 
-def mongo_table(table, db, pk = None, url = None, reader = None, writer = None, mode = 'w', **kwargs):    
+def mongo_table(table, db, pk = None, url = None, reader = None, writer = None, mode = 'w', read_preference = None, tags = None, max_staleness = -1, read_concern = None, **kwargs):    
     """
     mongo table is the entry point for multiple mongo_cursor objects.
     
@@ -61,8 +180,9 @@ def mongo_table(table, db, pk = None, url = None, reader = None, writer = None,
         primary keys associated with the table. if left blank, this will behave like a usual mongo table with duplicate documents possible.
         If primary keys are provided, documents will be managed like sql tables: we maintain a table with unique primary keys and e.g. we are unable to insert a document without primary keys
         
-    url: str
-        url for mongodb connection, defaults to localhost
+    url: str/dict
+        url for mongodb connection, defaults to localhost. Either a location name in cfg['mongo'] (see mongo_cfg), a url or a dict of a url and MongoClient options.
+        Tables on the same location share a MongoClient.
         
     reader: callable(s)
         function(s) applied to the document read from MongoDB before returning to user. If left blank, will default to pyg_encoders.decode
@@ -82,6 +202,19 @@ def mongo_table(table, db, pk = None, url = None, reader = None, writer = None,
         
     mode: str 
         'w' or 'r'. defaults to writer. if 'r', all writing functions are disabled
+
+    read_preference: str, optional
+        primary, primaryPreferred, secondary, secondaryPreferred or nearest. Use e.g. mode = 'r', read_preference = 'secondaryPreferred' to move analytics reads off the primary.
+        Writers always read from the primary for the reads a write depends on; use cursor.consistent() for read-your-writes. See also cursor.read_from().
+
+    tags: dict/list of dicts, optional
+        tag sets of the replica-set members to read from, e.g. dict(dc = 'ny')
+
+    max_staleness: int
+        maximum replication lag, in seconds, of a member read from. defaults to -1, no maximum.
+
+    read_concern: str, optional
+        local, available, majority, linearizable or snapshot
     
     :Example: simple mongo table
     ---------
@@ -140,4 +273,5 @@ def mongo_table(table, db, pk = None, url = None, reader = None, writer = None,
     cfg = cfg_read()
     
     """ 
-    return _mongo_table(table, db, pk = pk, url = url, reader = reader, writer = writer, mode = mode, **kwargs)      
+    return _mongo_table(table, db, pk = pk, url = url, reader = reader, writer = writer, mode = mode, 
+                        read_preference = read_preference, tags = tags, max_staleness = max_staleness, read_concern = read_concern, **kwargs)      
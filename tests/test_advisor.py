@@ -0,0 +1,27 @@
+from pyg_mongo import mongo_table, advisor, q
+from pyg_mongo._advisor import _query_shape, _serves
+
+
+def test_query_shape():
+    assert _query_shape(q(q.c > 3, a = 1, b = [1,2]), [('d', -1)]) == (('a', 'b'), (('d', -1),), ('c',))
+    assert _query_shape(q(q.a == 1, q(x = 1) | q(y = 2))) == (('a',), (), ())
+    assert _serves([('name', 1), ('date', 1), ('x', 1)], (('name',), (('date', -1),), ('x',)))
+    assert not _serves([('date', 1), ('name', 1)], (('name',), (('date', -1),), ()))
+
+
+def test_index_advisor():
+    t = mongo_table('test', 'test')
+    t.drop()
+    t.collection.drop_indexes()
+    t.insert_many([dict(name = 'a', x = i, date = i) for i in range(5)])
+    advisor.clear().enable()
+    t.inc(q.x > 1, name = 'a').sort('-date')[::]
+    t.inc(name = 'a').sort('-date')[::]
+    t.inc(name = 'a').count()
+    res = advisor.advise(t.collection.full_name)
+    assert res.index == [[('name', 1), ('date', -1), ('x', 1)]] and res.queries == [3] and res.shapes == [3]
+    assert advisor.apply(t.collection.full_name, wait = True) == ['name_1_date_-1_x_1']
+    assert len(advisor.advise(t.collection.full_name)) == 0
+    advisor.disable().clear()
+    t.collection.drop_indexes()
+    t.drop()
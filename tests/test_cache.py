@@ -0,0 +1,144 @@
+from pyg_base import eq
+from pyg_mongo import mongo_table, doc_cache, disk_cache
+import pandas as pd
+import numpy as np
+import os
+
+
+def test_doc_cache_lru():
+    cache = doc_cache(entries = 2)
+    cache.put(('t', 1, None), dict(a = 1))
+    cache.put(('t', 2, None), dict(a = 2))
+    assert cache.get(('t', 1, None)) == dict(a = 1)
+    cache.put(('t', 3, None), dict(a = 3))
+    assert cache.get(('t', 2, None)) is None
+    assert cache.stats.hits == 1 and cache.stats.misses == 1 and cache.stats.evictions == 1
+    cache.clear('t')
+    assert len(cache) == 0
+
+
+def test_doc_cache_invalidates_one_collection():
+    cache = doc_cache(entries = 100)
+    for i in range(60):
+        cache.put(('a' if i % 3 else 'b', i, None), dict(i = i))
+    assert len(cache) == 60 and len(cache._names['a']) == 40
+    cache.invalidate('a')
+    assert len(cache) == 20 and 'a' not in cache._names and cache.get(('b', 0, None)) == dict(i = 0) and cache.get(('a', 1, None)) is None
+    for i in range(100):
+        cache.put(('c', i, None), dict(i = i)) ## evicts all of b
+    assert 'b' not in cache._names and len(cache._names['c']) == 100
+    cache.invalidate('b').invalidate('c')
+    assert len(cache) == 0 and cache._names == {}
+
+
+def test_doc_cache_returns_copies():
+    cache = doc_cache()
+    cache.put(('t', 1, None), dict(a = 1))
+    doc = cache.get(('t', 1, None))
+    doc['a'] = 2
+    assert cache.get(('t', 1, None)) == dict(a = 1)
+    cache.put(('t', 2, None), dict(a = [1, dict(b = 2)], data = pd.Series([1,2,3])))
+    doc = cache.get(('t', 2, None))
+    doc['a'][1]['b'] = 3
+    doc['a'].append(4)
+    doc['data'][0] = 0
+    doc = cache.get(('t', 2, None))
+    assert doc['a'] == [1, dict(b = 2)] and eq(doc['data'], pd.Series([1,2,3]))
+
+
+def test_mongo_reader_use_cache():
+    t = mongo_table('test', 'test', pk = 'key')
+    t.reset.drop()
+    t.use_cache(entries = 10, revalidate = True)
+    t.insert_one(dict(key = 1, data = pd.Series([1,2,3])))
+    assert eq(t.read_one(key = 1)['data'], pd.Series([1,2,3]))
+    assert eq(t.read_one(key = 1)['data'], pd.Series([1,2,3]))
+    assert t.caches[0].stats.hits == 1
+    t.insert_one(dict(key = 1, data = pd.Series([4,5,6])))
+    assert eq(t.read_one(key = 1)['data'], pd.Series([4,5,6]))
+    t.use_cache(None)
+    assert t.caches == []
+    t.reset.drop()
+
+
+def test_disk_cache(tmp_path):
+    path = str(tmp_path)
+    cache = disk_cache(path)
+    doc = dict(a = np.arange(100), s = pd.Series([1., 2., 3.]), name = 'test')
+    cache.put(('t', 1, 'v1'), doc)
+    cache.put(('t', 2, None), doc) ## no version, not cached
+    assert len(cache) == 1
+    res = disk_cache(path).get(('t', 1, 'v1')) ## a new session
+    assert eq(res, doc)
+    assert not res['a'].flags.writeable ## memory-mapped
+    assert cache.get(('t', 1, 'v2')) is None
+    small = disk_cache(path, nbytes = 1)
+    small.put(('t', 3, 'v1'), doc)
+    assert len(small) == 1 and small.get(('t', 1, 'v1')) is None
+    small.clear()
+    assert len(disk_cache(path)) == 0
+
+
+def test_disk_cache_truncated_file_is_a_miss(tmp_path):
+    cache = disk_cache(str(tmp_path))
+    cache.put(('t', 1, 'v1'), dict(a = np.arange(1000)))
+    path = cache._path(('t', 1, 'v1'))
+    for n in [os.path.getsize(path) - 100, 20, 5]:
+        with open(path, 'r+b') as f:
+            f.truncate(n)
+        assert cache.get(('t', 1, 'v1')) is None
+
+
+def test_mongo_reader_use_result_cache():
+    t = mongo_table('test', 'test')
+    t.drop()
+    t.insert_many([dict(a = i, b = i % 2) for i in range(10)])
+    t.use_result_cache(ttl = 60)
+    assert t.b == [0,1] and len(t) == 10 and t.inc(b = 1).count() == 5
+    t.collection.insert_one(dict(a = 100, b = 2)) ## bypasses the cursor, so not seen
+    assert t.b == [0,1] and len(t) == 10
+    t.insert_one(dict(a = 101, b = 3)) ## invalidates
+    assert t.b == [0,1,2,3] and len(t) == 12
+    t.use_result_cache(None)
+    t.drop()
+
+
+def test_mongo_reader_use_single_flight():
+    from concurrent.futures import ThreadPoolExecutor
+    import time
+    t = mongo_table('test', 'test', pk = 'key')
+    t.reset.drop()
+    t.insert_one(dict(key = 1, v = 1))
+    t.use_single_flight()
+    calls = []
+    def slow(doc):
+        calls.append(1)
+        time.sleep(0.3)
+        return dict(doc)
+    with ThreadPoolExecutor(8) as pool:
+        docs = list(pool.map(lambda _: t.read_one(key = 1, reader = slow), range(8)))
+    assert len(calls) < 8 and t.flight.stats.coalesced > 0
+    assert all(doc['v'] == 1 for doc in docs)
+    generation = t.flight.generation
+    t.insert_one(dict(key = 2, v = 2))
+    assert t.flight.generation == generation + 1
+    t.use_single_flight(False)
+    assert t.flight is None
+    t.reset.drop()
+
+
+def test_mongo_pk_cursor_writes_ignore_cached_counts():
+    t = mongo_table('test', 'test', pk = 'key')
+    t.reset.drop()
+    t.use_result_cache(ttl = 60).use_single_flight()
+    assert t.inc(key = 1).count() == 0 ## cached
+    t.collection.insert_one(t._write(dict(key = 1, v = 0))) ## another writer, so nothing is invalidated
+    assert t.inc(key = 1).count() == 0
+    for v in range(1, 4):
+        t.insert_one(dict(key = 1, v = v))
+        assert t.collection.count_documents(dict(key = 1)) == 1
+    assert t.read_one(key = 1)['v'] == 3
+    t.update_one(dict(key = 1, v = 4))
+    assert t.collection.count_documents(dict(key = 1)) == 1
+    t.use_result_cache(None).use_single_flight(False)
+    t.reset.drop()
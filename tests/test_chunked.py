@@ -0,0 +1,78 @@
+from pyg_mongo import mongo_table, q
+from pyg_mongo._chunked import _chunk_specs
+import pyg_mongo._chunked as chunked
+import numpy as np
+import pandas as pd
+import datetime
+import pytest
+
+
+def test_q_array_values():
+    assert dict(q.a == np.array([3,1,3])) == {'a': {'$in': [1,3]}}
+    assert dict(q.a == np.array([3])) == {'a': {'$eq': 3}}
+    assert dict(q.a != pd.Index([1,2])) == {'a': {'$nin': [1,2]}}
+    assert dict(q.a == pd.to_datetime(['2020-01-01', '2021-01-01'])) == {'a': {'$in': [datetime.datetime(2020,1,1), datetime.datetime(2021,1,1)]}}
+    from pyg_mongo._q import _array_values
+    assert _array_values(pd.DataFrame(dict(a = [1,2], b = [3,4]))) is None
+    assert _array_values(np.ones((2,2))) is None
+
+
+def test_chunk_specs():
+    assert _chunk_specs(q(a = [1,2,3])) is None
+    specs = _chunk_specs(q(q.a == list(range(250)), b = 1), 100)
+    assert len(specs) == 3
+    assert specs[0] == {'$and': [{'b': {'$eq': 1}}, {'a': {'$in': list(range(100))}}]}
+    assert specs[-1] == {'$and': [{'b': {'$eq': 1}}, {'a': {'$in': list(range(200, 250))}}]}
+    assert _chunk_specs(q.a == list(range(250)), 100)[1] == {'a': {'$in': list(range(100, 200))}}
+    values = ['%05i'%i + 'x' * 1000 for i in range(2000)] ## few values but over nbytes once encoded
+    specs = _chunk_specs(q.a == values, nbytes = 500000)
+    assert len(specs) > 1 and sum(len(spec['a']['$in']) for spec in specs) == 2000
+    assert all(len(chunked.bson_encode(spec)) <= 500000 for spec in specs)
+
+
+def test_chunked_cursor_skip_limit_commute():
+    cursor = chunked.chunked_cursor(None, [])
+    assert (cursor.limit(5).skip(10)._skip, cursor._limit) == (10, 5)
+    cursor = chunked.chunked_cursor(None, []).skip(10).limit(5)
+    assert (cursor._skip, cursor._limit) == (10, 5)
+    assert chunked.chunked_cursor(None, [])[3:5]._limit == 2
+
+
+def test_sort_key_follows_bson_order():
+    from bson import ObjectId, Decimal128, Timestamp, Regex, MinKey, MaxKey
+    values = [MinKey(), None, float('nan'), -1, Decimal128('1.5'), 2, 'B', 'a', b'z', b'aa', ObjectId('0'*24), ObjectId('1'*24), False, True, 
+              datetime.datetime(2020,1,1), Timestamp(1, 1), Regex('a'), MaxKey()]
+    shuffled = values[::-1]
+    docs = sorted([dict(a = value) for value in shuffled], key = chunked._sort_key([('a', 1)]))
+    assert [repr(doc['a']) for doc in docs] == [repr(value) for value in values]
+    assert [doc.get('a') for doc in sorted([dict(a = 1), dict(b = 1), dict(a = 'x')], key = chunked._sort_key([('a', -1)]))] == ['x', 1, None]
+    for value in [[1,2], dict(x = 1)]:
+        with pytest.raises(ValueError):
+            chunked._sort_key([('a', 1)])(dict(a = value))
+    with pytest.raises(ValueError):
+        chunked._sort_key([('a.b', 1)])(dict(a = [dict(b = 1)]))
+
+
+def test_mongo_reader_chunked_in(monkeypatch):
+    monkeypatch.setattr(chunked, '_max_in', 7)
+    t = mongo_table('test', 'test')
+    t.drop()
+    t.insert_many([dict(a = i, b = i % 3, tags = [i, i+1]) for i in range(50)])
+    c = t.inc(q.a == np.arange(40))
+    assert len(c) == 40
+    assert c.sort('-a')[::].a == list(range(39, -1, -1))
+    assert c.sort('b', '-a')[::].a == sorted(range(40), key = lambda i: (i%3, -i))
+    assert c.sort('a')[5:9].a == [5,6,7,8]
+    cursor = chunked._find(t.collection, c._spec, sort = [('a', 1)])
+    assert [doc['a'] for doc in cursor.limit(3).skip(5)] == [5,6,7]
+    assert c.distinct('b') == [0,1,2]
+    d = t.inc(q.tags == list(range(40))) ## documents match several chunks
+    assert len(d) == 40 and len(d[::]) == 40
+    assert chunked._count(t.collection, dict(a = {'$in': list(range(10)) * 3})) == 10 ## repeated values do not double count
+    with pytest.raises(ValueError):
+        c.sort('tags')[::] ## MongoDB sorts arrays on their smallest element, which merging cannot reproduce
+    monkeypatch.setattr(chunked.chunked_cursor, '_ids', lambda self, specs: set())
+    assert len(c) == 40 and len(d) < 40 ## a is never an array, so chunks are counted on the server, only documents with tags arrays are de-duplicated
+    t.inc(q.a == list(range(20))).delete_many()
+    assert len(t) == 30
+    t.drop()
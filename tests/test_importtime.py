@@ -0,0 +1,20 @@
+from importtime import check_importtime
+import subprocess
+import pytest
+import os
+import sys
+
+_env = dict(os.environ, PYTHONPATH = os.pathsep.join(sys.path))
+
+
+def test_import_is_lazy():
+    code = "import sys, pyg_mongo; print(sorted(m for m in ('pymongo', 'pyg_base', 'numpy', 'pandas') if m in sys.modules))"
+    assert subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, env = _env, check = True).stdout.strip() == '[]'
+    code = "import sys; from pyg_mongo import q; q.a == 1; print(sorted(m for m in ('pymongo', 'pyg_encoders') if m in sys.modules))"
+    assert subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, env = _env, check = True).stdout.strip() == '[]'
+
+
+@pytest.mark.slow
+def test_importtime_budget():
+    res = check_importtime({'import pyg_mongo' : 50, 'from pyg_mongo import mongo_table' : None}, env = _env)
+    assert res[0]['pyg_mongo_ms'] < res[1]['pyg_mongo_ms']
@@ -0,0 +1,38 @@
+from pyg_base import dictable
+from pyg_mongo import q, q_match, q_mask, q_filter
+import numpy as np
+import pandas as pd
+import datetime
+import re
+
+
+def test_q_match():
+    match = q_match(q(q.a > 1, b = ['x', 'y']))
+    assert match(dict(a = 2, b = 'x'))
+    assert not match(dict(a = 2, b = 'z'))
+    assert not match(dict(a = '2', b = 'x')) ## strings and numbers do not compare
+    assert q_match(q.a == 1)(dict(a = [0, 1]))
+    assert not q_match(q.a == 1)(dict(a = True))
+    assert q_match(q(a = True))(dict(a = 1))
+    assert q_match(q['c.d'] == 1)(dict(c = [dict(d = 0), dict(d = 1)]))
+    assert q_match(q.a == None)(dict(b = 1))
+    assert q_match(q.a.not_exists)(dict(b = 1)) and not q_match(q.a.not_exists)(dict(a = None))
+    assert q_match(q.a == re.compile('^h', re.I))(dict(a = 'Hello'))
+    assert q_match(q.a % 3 == 1)(dict(a = 7))
+    assert q_match(q.a.isinstance(float))(dict(a = 1.5)) and not q_match(q.a.isinstance(float))(dict(a = 1))
+    assert q_match((q.a == 1) | (q.b == 1))(dict(b = 1))
+    assert q_match(~(q.a == 1))(dict(a = 2))
+    assert q_match(q.t > datetime.datetime(2020,1,1))(dict(t = datetime.datetime(2021,1,1)))
+
+
+def test_q_mask_and_filter():
+    df = pd.DataFrame(dict(a = np.arange(100) % 7, b = np.linspace(0, 1, 100), s = np.array(['x','y'])[np.arange(100) % 2]))
+    rows = df.to_dict('records')
+    for query in [q.a == 3, q.a == [1,2], q.a != [1,2], q(q.b > 0.5, s = 'x'), (q.a == 1) | (q.s == 'y'), q.a % 3 == 1, q.s == re.compile('x'), q.a == '3', q.c == None]:
+        mask = q_mask(query, df)
+        assert list(mask) == [q_match(query)(row) for row in rows]
+        assert list(q_mask(query, dictable(df))) == list(mask)
+        assert len(q_filter(query, df)) == mask.sum()
+    rs = dictable(a = [1,2,3], b = ['x', 'y', 'z'])
+    assert q_filter(q.a >= 2, rs) == dictable(a = [2,3], b = ['y', 'z'])
+    assert q_filter(q.a >= 2, list(rs)) == list(rs)[1:]
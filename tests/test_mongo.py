@@ -1,10 +1,12 @@
 from pyg_base import ulist, dictable,Dict, eq
 from pyg_encoders import pd_read_parquet
-from pyg_mongo import mongo_reader, mongo_cursor, q, mongo_table, mongo_pk_cursor
+from pyg_mongo import mongo_reader, mongo_cursor, q, mongo_table, mongo_pk_cursor, mongo_cfg
 from pyg_base import *
 import numpy as np; import pandas as pd
 import jsonpickle as jp
 import pytest
+import json
+import os
 
     
 def test_mongo_cursor():
@@ -95,4 +97,95 @@ def test_mongo_cursor_root():
     t.drop()
 
     
-    
\ No newline at end of file
+    
+
+def test_mongo_cfg_is_cached_until_the_file_changes(tmp_path, monkeypatch):
+    from pyg_base import _cfg
+    from pyg_mongo import _table
+    path = str(tmp_path / 'cfg.json')
+    with open(path, 'w') as f:
+        json.dump(dict(mongo = dict(test = 'mongodb://localhost:27017', pooled = dict(url = 'mongodb://localhost:27017', maxPoolSize = 7))), f)
+    monkeypatch.setattr(_cfg, 'CFG', path)
+    monkeypatch.setitem(_cfg.CACHE, 'CFG', {})
+    assert _table._url('test') == 'mongodb://localhost:27017'
+    assert _table._location('pooled') == ('mongodb://localhost:27017', (('maxPoolSize', 7),))
+    assert _table._url('unknown') == 'unknown'
+    reads = []
+    cfg_read = _table.cfg_read
+    monkeypatch.setattr(_table, 'cfg_read', lambda: reads.append(1) or cfg_read())
+    for _ in range(10):
+        _table._url('test')
+    assert reads == []
+    with open(path, 'w') as f:
+        json.dump(dict(mongo = dict(test = 'mongodb://127.0.0.1:27017')), f)
+    stat = os.stat(path)
+    os.utime(path, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert _table._url('test') == 'mongodb://127.0.0.1:27017'
+    assert len(reads) == 1
+    mongo_cfg(reload = True)
+    assert len(reads) == 2
+    client = mongo_table('test', 'test', url = 'test').collection.database.client
+    assert client is mongo_table('test', 'test', pk = 'key', url = 'test').collection.database.client
+    from pyg_mongo._base_reader import _client_key
+    assert _client_key(client) == ('mongodb://127.0.0.1:27017', ())
+
+
+def test_mongo_cfg_sees_in_memory_changes_and_closes_stale_clients(monkeypatch):
+    from pyg_base import _cfg, cfg_read, cfg_write
+    from pyg_mongo import _table
+    from pymongo import MongoClient
+    monkeypatch.setattr(_cfg, 'CFG', None)
+    monkeypatch.setitem(_cfg.CACHE, 'CFG', {})
+    monkeypatch.setattr(_table, '_clients', {})
+    cfg = cfg_read()
+    cfg['mongo'] = dict(test = dict(url = 'mongodb://x:1', connect = False), other = dict(url = 'mongodb://z:1', connect = False))
+    cfg_write(cfg)
+    assert _table._url('test') == 'mongodb://x:1'
+    client = _table._client(MongoClient, *_table._location('test'))
+    other = _table._client(MongoClient, *_table._location('other'))
+    assert client is _table._client(MongoClient, *_table._location('test'))
+    cfg['mongo']['test'] = dict(url = 'mongodb://y:1', connect = False) ## the same dict, edited in place
+    cfg_write(cfg)
+    assert _table._url('test') == 'mongodb://y:1'
+    assert client not in _table._clients.values() and other in _table._clients.values()
+    assert _table._client(MongoClient, *_table._location('test')) is not client
+    for c in _table._clients.values():
+        c.close()
+
+
+def test_mongo_table_read_preference():
+    from pymongo.read_preferences import SecondaryPreferred, Nearest, ReadPreference
+    r = mongo_table('test', 'test', mode = 'r', read_preference = 'secondaryPreferred', read_concern = 'majority')
+    assert r.collection.read_preference == SecondaryPreferred() and r.collection.read_concern.level == 'majority'
+    t = mongo_table('test', 'test', pk = 'key', read_preference = 'nearest', tags = dict(dc = 'ny'))
+    assert t.collection.read_preference == Nearest([dict(dc = 'ny')])
+    assert t.deleted.collection.read_preference == t.collection.read_preference
+    assert t.inc(key = 1).collection.read_preference == t.collection.read_preference
+    c = t.consistent()
+    assert c.collection.read_preference == ReadPreference.PRIMARY and c.collection.read_concern.level == 'local'
+    assert c.consistent() is c and c._primary() is c
+    assert type(c) == type(t) and c.pk == t.pk
+    s = c.read_from('secondaryPreferred', max_staleness = 120)
+    assert s.collection.read_preference.max_staleness == 120 and s.collection.read_concern.level == 'local'
+    c.drop()
+    t.insert_one(dict(key = 1, value = 1))
+    t.insert_one(dict(key = 1, value = 2)) ## the existence check reads from the primary
+    assert c.inc(key = 1)[0]['value'] == 2 and len(c.deleted.inc(key = 1)) == 1
+    assert r.inc(key = 1).read_from(read_concern = 'local')[0]['value'] == 2
+    assert t.drop() is t
+    assert t.read_from(read_concern = 'majority').collection.read_preference == t.collection.read_preference
+    assert t.read_from(max_staleness = 120).collection.read_preference == Nearest([dict(dc = 'ny')], 120)
+    assert t._primary() is t._primary() and t._primary().collection.read_preference == ReadPreference.PRIMARY
+    assert c.fingerprint != t.fingerprint and c != t and c.fingerprint == t.consistent().fingerprint
+    r.use_result_cache(ttl = 60)
+    n = r.count()
+    r.collection.insert_one(dict(key = 2, value = 2)) ## bypasses the cursor, so nothing is invalidated
+    assert r.count() == n and r.consistent().count() == n + 1 ## the count cached reading from secondaries is not served to a consistent read
+    r.use_result_cache(None)
+    r.collection.delete_many(dict(key = 2, value = 2))
+    with pytest.raises(ValueError):
+        c.read_from(tags = dict(dc = 'ny')) ## primary takes no tags
+    with pytest.raises(ValueError):
+        t.read_from('primary', tags = dict(dc = 'ny'))
+    with pytest.raises(ValueError):
+        t.read_from('everywhere')
@@ -0,0 +1,48 @@
+import re
+from pyg_mongo import mongo_table, monitor, q
+
+
+def test_monitor_stats():
+    monitor.enable(nbytes = True).clear()
+    t = mongo_table('test', 'test', pk = 'key')
+    t.drop()
+    t.insert_one(dict(key = 1, value = 2))
+    t.insert_one(dict(key = 1, value = 3))
+    assert t.inc(key = 1).read_one().value == 3
+    stats = t.stats()
+    assert stats.inc(method = 'insert_one').calls == [2]
+    insert = stats.inc(method = 'insert_one')[0]
+    assert insert.commands >= 2 and insert.round_trips == insert.commands / 2 and insert.sent > 0 and insert.received > 0
+    assert stats.inc(method = 'read_one').calls == [1]
+    text = monitor.prometheus()
+    assert 'pyg_mongo_command_seconds_bucket{table="test.test",method="insert_one",le="+Inf"}' in text
+    assert 'pyg_mongo_round_trips_count{table="test.test",method="read_one"} 1' in text
+    monitor.disable().clear()
+    t.insert_one(dict(key = 2, value = 2))
+    assert len(t.stats()) == 0
+    t.drop()
+
+
+def test_monitor_slow_log_and_explain():
+    t = mongo_table('test', 'test')
+    t.drop()
+    t.insert_many([dict(name = 'a%i'%i, x = i) for i in range(100)])
+    summary = t.inc(q.name == re.compile('a1')).explain()
+    assert summary.collscan and summary.docs_examined == 100 and summary.returned == 11
+    assert t.inc(q.x > 90).aggregate().explain().returned == 9
+    monitor.clear().slow_log(threshold = 0)
+    t.inc(q.name == re.compile('a1')).read(0)
+    monitor.flush() ## explained before the insert below changes the count
+    t.insert_one(dict(name = 'b', x = 0))
+    slow = monitor.flush().slow(t.collection.full_name)
+    read = slow.inc(method = 'read')
+    assert len(read) == 1 and read[0].collscan and read[0].spec == {'name': {'$regex': 'a1'}} and read[0].docs_examined == 100 and read[0].returned == 11
+    assert slow.inc(method = 'insert_one')[0].plan is None ## writes are not explained
+    monitor.clear().slow_log(threshold = 0, verbosity = 'queryPlanner')
+    t.inc(q.name == re.compile('a1')).read(0)
+    read = monitor.flush().slow(t.collection.full_name).inc(method = 'read')
+    assert read[0].collscan and read[0].docs_examined is None ## planned only
+    monitor.slow_log(None).clear()
+    t.inc(x = 1).read(0)
+    assert len(monitor.slow()) == 0
+    t.drop()
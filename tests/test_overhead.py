@@ -0,0 +1,18 @@
+from pyg_mongo import mongo_table
+from overhead import check_overhead, default_budgets
+import pytest
+
+_db = 'pyg_test_overhead' ## a throwaway database, dropped by check_overhead
+
+
+@pytest.mark.slow
+def test_overhead_within_budget():
+    db = mongo_table('test', 'test').collection.database.client[_db]
+    res = check_overhead(db, n = 100, repeat = 20)
+    assert sorted(res.op) == sorted(default_budgets)
+
+
+def test_overhead_over_budget_raises():
+    db = mongo_table('test', 'test').collection.database.client[_db]
+    with pytest.raises(AssertionError):
+        check_overhead(db, n = 10, repeat = 5, rounds = 1, budgets = dict(find = (None, 0)))
@@ -0,0 +1,36 @@
+import pytest
+from pyg_base import dictable
+from pyg_mongo import mongo_table, q
+
+
+def test_mongo_pipeline_group():
+    t = mongo_table('test', 'test')
+    t.drop()
+    t.insert_many(dictable(name = ['a', 'b', 'a', 'c'], x = [1, 2, 3, -1], tags = [[1,2], [2], [3], []]))
+    res = t.find(q.x > 0).group(by = 'name', total = ('sum', 'x'), n = 'count').sort('-total').limit(10)
+    assert res.pipeline[0] == {'$match': {'x': {'$gt': 0}}}
+    assert res[::] == dictable(name = ['a', 'b'], total = [4, 2], n = [2, 1])
+    assert len(res) == 2 and res[0] == dict(name = 'a', total = 4, n = 2) and res[-1]['name'] == 'b'
+    assert list(res) == list(res[::])
+    assert t.group(n = 'count', mx = ('max', 'x'))[::] == dictable(n = [4], mx = [3])
+    assert t.aggregate({'$unwind': '$tags'}).group(by = 'tags', n = 'count').sort('tags')[::] == dictable(tags = [1,2,3], n = [1,2,1])
+    t.drop()
+
+
+def test_mongo_pipeline_join():
+    trades = mongo_table('trades', 'test')
+    instruments = mongo_table('instruments', 'test')
+    trades.drop(); instruments.drop()
+    trades.insert_many(dictable(ticker = ['a', 'b', 'c', 'a'], qty = [1, 2, 3, -4]))
+    instruments.insert_many(dictable(ticker = ['a', 'b'], ccy = ['USD', 'EUR'], active = [True, False]))
+    res = trades.inc(q.qty > 0).join(instruments, on = 'ticker', projection = ['ticker', 'ccy'])
+    assert res.pipeline[1]['$lookup']['pipeline'] == [{'$match': {'$expr': {'$eq': ['$ticker', '$$k0']}}}, {'$project': {'ticker': 1, 'ccy': 1}}]
+    assert sorted(res[::].ccy, key = str) == ['EUR', 'USD', None]
+    inner = trades.join(instruments.inc(active = True), on = 'ticker', how = 'inner')
+    assert sorted(inner[::].qty) == [-4, 1]
+    assert inner.count() == 2
+    with pytest.raises(ValueError):
+        trades.join(mongo_table('instruments', 'other'), on = 'ticker')
+    with pytest.raises(ValueError):
+        trades.join(instruments, on = 'ticker', how = 'outer')
+    trades.drop(); instruments.drop()
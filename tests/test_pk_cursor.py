@@ -136,3 +136,26 @@ def test_pk_cursor_dates_to_parquet():
     assert db().read(0, passthru)['data']['path'] == 'c:/temp/a/20000101/data.parquet'
     db().reset.drop()
 
+
+def test_pk_cursor_retain():
+    t = mongo_table('test', 'test', pk = 'key')
+    t.reset.drop()
+    for i in range(5):
+        t.insert_one(dict(key = 1, value = i))
+        t.insert_one(dict(key = 2, value = i))
+    assert len(t.deleted) == 8
+    t.retain(versions = 2, seconds = 3600)
+    assert len(t.deleted) == 4
+    assert sorted(t.deleted.inc(key = 1).value) == [2, 3]
+    indexes = t.deleted.collection.index_information()
+    assert indexes['deleted_1']['expireAfterSeconds'] == 3600
+    assert 'key_1_deleted_-1' in indexes
+    t.expire(60)
+    assert t.deleted.collection.index_information()['deleted_1']['expireAfterSeconds'] == 60
+    t.expire(None)
+    assert 'deleted_1' not in t.deleted.collection.index_information()
+    t.compact(0)
+    assert len(t.deleted) == 0
+    with pytest.raises(ValueError):
+        t.deleted.compact()
+    t.reset.drop()
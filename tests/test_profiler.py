@@ -0,0 +1,32 @@
+from pyg_mongo import mongo_table, profiler
+from pyg_mongo._profiler import _field_type
+from pyg_encoders import encode
+import pandas as pd
+import numpy as np
+
+
+def test_field_type():
+    assert _field_type(encode(pd.Series([1,2]))) == 'dataframe'
+    assert _field_type(encode(np.arange(3))) == 'ndarray'
+    assert _field_type(1) == 'int'
+    assert _field_type(dict(a = 1)) == 'dict'
+
+
+def test_decode_profiler():
+    t = mongo_table('test', 'test', pk = 'key')
+    t.drop()
+    profiler.clear().enable()
+    df = pd.DataFrame(np.random.normal(0,1,(1000,10)))
+    t.insert_one(dict(key = 1, data = df, a = np.arange(5), x = 1))
+    doc = t.read_one(key = 1)
+    assert (doc['data'] == df).all().all() and isinstance(doc['a'], np.ndarray)
+    table = t.collection.full_name
+    assert sorted(profiler.callables(table).mode) == ['read', 'write']
+    assert set(profiler.types(table).type) >= {'dataframe', 'ndarray', 'int'}
+    assert profiler.fields(table).inc(field = 'data').type == ['dataframe']
+    docs = profiler.documents(table)
+    assert docs.inc(mode = 'read')._id == [doc['_id']] and docs.inc(mode = 'write')._id == [dict(key = 1)]
+    profiler.disable().clear()
+    assert (t.read_one(key = 1)['data'] == df).all().all()
+    assert len(profiler.fields()) == 0
+    t.drop()
@@ -148,3 +148,55 @@ def test_q_regex():
     assert len(t.inc(item = re.compile('^test', re.IGNORECASE))) == 3
     t.drop()
 
+
+
+def test_q_flattens_and_dedups():
+    from functools import reduce
+    from operator import and_
+    assert D(((q.a == 1) & (q.b == 2)) & ((q.c == 1) & (q.d == 2))) == {'$and': [{'a': {'$eq': 1}}, {'b': {'$eq': 2}}, {'c': {'$eq': 1}}, {'d': {'$eq': 2}}]}
+    assert D((q.a == 1) & ((q.a == 1) & (q.b == 1))) == {'$and': [{'a': {'$eq': 1}}, {'b': {'$eq': 1}}]}
+    assert D(q() & (q.a == 1)) == {'a': {'$eq': 1}}
+    assert D((q.a == 1) & q()) == {'a': {'$eq': 1}}
+    assert type(q() & {'a': 1}) == type(q())
+    assert D((q() & {'a': 1}) & (q.b == 1)) == {'$and': [{'a': 1}, {'b': {'$eq': 1}}]}
+    conditions = [q['x%i'%i] == i for i in range(2000)]
+    assert D(reduce(and_, conditions)) == D(q(*conditions[::-1]))
+    assert len(reduce(and_, conditions + conditions)['$and']) == 2000
+    ab = (q.a == 1) & (q.b == 2)
+    abc = ab & (q.c == 3)
+    abd = ab & (q.d == 4)
+    assert D(ab) == {'$and': [{'a': {'$eq': 1}}, {'b': {'$eq': 2}}]} ## extending a held query does not change it
+    assert D(abc)['$and'][-1] == {'c': {'$eq': 3}} and D(abd)['$and'][-1] == {'d': {'$eq': 4}} and len(abd['$and']) == 3
+    import time
+    def timed(n):
+        conditions = [q['x%i'%i] == i for i in range(n)]
+        res = []
+        for _ in range(3):
+            t = time.perf_counter()
+            reduce(and_, conditions)
+            res.append(time.perf_counter() - t)
+        return min(res)
+    assert timed(8000) < 24 * timed(1000) ## linear is 8x, quadratic 64x
+
+
+def test_q_canonical():
+    from pyg_mongo._q import _canonical
+    assert _canonical(q(a = 1, b = [1,2])) == _canonical({'$and': [{'b': {'$in': [2,1]}}, {'a': {'$eq': 1}}]})
+    assert _canonical(q.a == [[1,2]]) != _canonical(q.a == [[2,1]])
+    assert _canonical(q.a % 2 == 1) != _canonical(q.a % 1 == 2)
+
+
+def test_q_compile():
+    import datetime
+    tmpl = q.compile('name', 'surname', q.age > 30)
+    for values in [dict(name = 'james', surname = 'joyce'), 
+                   dict(name = None, surname = datetime.datetime(2000,1,1)),
+                   dict(name = ['james', 'jim'], surname = 'joyce'),
+                   dict(name = True, surname = 1.5),
+                   dict(name = 'james'),
+                   dict(name = 'james', surname = 'joyce', age = 3)]:
+        assert D(tmpl(**values)) == D(q(q.age > 30, **values))
+        assert D(tmpl(**values) & (q.x == 1)) == D(q(q.age > 30, q.x == 1, **values))
+    assert D(q.compile('a', b = 2)(a = 1)) == D(q(a = 1, b = 2))
+    assert D(q.compile('a')(a = 1)) == {'a': {'$eq': 1}}
+    assert D(q.compile('a', q.a > 0)(a = 1)) == D(q(q.a > 0, a = 1))
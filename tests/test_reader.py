@@ -1,5 +1,5 @@
 from pyg_base import dt, eq, passthru
-from pyg_mongo import mongo_table, mongo_reader, mongo_cursor
+from pyg_mongo import mongo_table, mongo_reader, mongo_cursor, mongo_base_reader, q
 import pytest
 import pandas as pd
 
@@ -83,3 +83,135 @@ def test_mongo_reader_distinct():
 
     reader._whatever = 1
     assert reader._whatever == 1
+
+
+def test_mongo_reader_as_of():
+    t = mongo_table('test', 'test', pk = 'key')
+    t.reset.drop()
+    t.insert_one(dict(key = 1, value = 'old'))
+    t.insert_one(dict(key = 2, value = 'unchanged'))
+    then = dt()
+    t.insert_one(dict(key = 1, value = 'new'))
+    t.insert_one(dict(key = 1, value = 'newer'))
+    reader = mongo_table('test', 'test', pk = 'key', mode = 'r')
+    assert sorted([(doc['key'], doc['value']) for doc in reader.as_of(then)]) == [(1, 'old'), (2, 'unchanged')]
+    assert sorted([(doc['key'], doc['value']) for doc in reader.as_of(dt())]) == [(1, 'newer'), (2, 'unchanged')]
+    assert [doc['value'] for doc in reader.inc(key = 1).as_of(then)] == ['old']
+    t.insert_one(dict(key = 3, value = 'created'))
+    t.insert_one(dict(key = 3, value = 'updated'))
+    assert [doc['key'] for doc in reader.sort('-key').as_of(then)] == [2, 1]
+    assert [doc['key'] for doc in reader.sort('-key').as_of(dt())] == [3, 2, 1]
+    docs = list(reader.sort('key').project('value').as_of(then))
+    assert [doc['value'] for doc in docs] == ['old', 'unchanged'] and not any('key' in doc or '_updated' in doc for doc in docs)
+    t.reset.drop()
+
+
+def test_mongo_reader_since():
+    t = mongo_table('test', 'test', pk = 'key')
+    t.reset.drop()
+    t.insert_one(dict(key = 1, value = 1))
+    t.insert_one(dict(key = 2, value = 2))
+    res = t.since(window = 0)
+    assert sorted(res.upserted.key) == [1, 2] and len(res.deleted) == 0
+    t.insert_one(dict(key = 1, value = 3))
+    t.inc(key = 2).delete_many()
+    res = t.since(res.token, window = 0)
+    assert res.upserted.key == [1] and res.upserted.value == [3]
+    assert res.deleted.key == [2]
+    token = res.token
+    res = t.since(token, window = 0)
+    assert len(res.upserted) == 0 and len(res.deleted) == 0
+    res = t.since(token)
+    assert res.token < token ## the bookmark is held back by 5 seconds so recent changes are returned again
+    res = t.since(res.token)
+    assert res.upserted.key == [1] and res.deleted.key == [2]
+    with pytest.raises(ValueError):
+        mongo_table('test', 'test').since()
+    t.reset.drop()
+
+
+def test_mongo_reader_since_sees_renames_and_deleted_fields():
+    import time
+    t = mongo_table('test', 'test', pk = 'key')
+    t.reset.drop()
+    t.insert_one(dict(key = 1, value = 1, other = 1))
+    t.insert_one(dict(key = 2, value = 2, other = 2))
+    time.sleep(0.01) ## stamps are in milliseconds and the bookmark includes its own millisecond
+    token = t.since(window = 0).token
+    t.inc(key = 1).rename(value = 'price')
+    res = t.since(token, window = 0)
+    assert res.upserted.key == [1] and res.upserted.price == [1] and 'value' not in res.upserted.keys()
+    time.sleep(0.01)
+    token = t.since(window = 0).token
+    del t.inc(key = 2)['other']
+    res = t.since(token, window = 0)
+    assert res.upserted.key == [2] and 'other' not in res.upserted.keys()
+    assert t.inc(key = 2).count() == 1 and t.deleted.inc(key = 2)[0]['other'] == 2 ## the old document is kept in history, not in the table
+    t.reset.drop()
+
+
+def test_mongo_reader_watch():
+    t = mongo_table('test', 'test', pk = 'key')
+    if not t.collection.database.client.admin.command('hello').get('setName'):
+        pytest.skip('change streams require a replica set')
+    t.reset.drop()
+    changes = t.watch()
+    t.insert_one(dict(key = 1, value = 1))
+    change = next(changes)
+    assert change.operation == 'insert' and change.doc['value'] == 1
+    t.reset.drop()
+
+
+def test_mongo_reader_watch_filters_deletes_by_id():
+    from pyg_mongo._reader import _id_conditions
+    assert _id_conditions(q(_id = 1, a = 2)) == q(_id = 1)
+    assert _id_conditions(q(q._id > 1, a = 2, b = 3)) == q(q._id > 1)
+    assert _id_conditions(q(a = 2)) == {}
+
+
+def test_mongo_reader_fingerprint():
+    t = mongo_table('test', 'test', mode = 'r')
+    a = t.inc(a = 1, b = 2)
+    b = t.inc(b = 2).inc(a = 1)
+    assert a.fingerprint == b.fingerprint and a == b
+    assert a.sort('x').fingerprint != a.fingerprint
+    assert a.project(['x', 'y']).fingerprint == a.project(['y', 'x']).fingerprint
+    c = a.copy()
+    fingerprint = c.fingerprint
+    c.spec = dict(c = 1)
+    assert c.fingerprint != fingerprint
+
+
+def test_mongo_reader_distinct_aggregation():
+    from pyg_base import dictable
+    t = mongo_table('test', 'test')
+    t.drop()
+    t.insert_many([dict(name = n, tags = [1, 2] if i % 2 else 3) for i, n in enumerate('abacab')])
+    assert list(t.iter_distinct('name')) == t.distinct('name') == ['a','b','c']
+    assert t.distinct_counts('name') == dictable(name = ['a','b','c'], count = [3,2,1])
+    assert t.distinct_counts('tags') == dictable(tags = [1,2,3], count = [3,3,3])
+    assert list(t.inc(name = 'a').iter_distinct('tags')) == [3]
+    t.drop()
+    t.insert_many([dict(tags = [1, 2]), dict(tags = 3), dict(tags = []), dict(name = 'x'), dict(tags = None), dict(tags = [None, 4])])
+    assert list(t.iter_distinct('tags')) == sorted(t.collection.distinct('tags'), key = lambda value: (value is not None, value)) == [None, 1, 2, 3, 4]
+    assert t.distinct_counts('tags') == dictable(tags = [None, 1, 2, 3, 4], count = [2, 1, 1, 1, 1]) ## no group for the empty array or the missing field
+    t.drop()
+
+
+def test_mongo_reader_cached_state():
+    t = mongo_table('test', 'test', pk = ['b', 'a'])
+    a = t.inc(a = 1)
+    spec = a._spec
+    assert a._spec is spec and a._pk == ['a', 'b']
+    b = a.sort('c')
+    assert b._spec is spec and b._pk is a._pk and a.sorter is None
+    assert a.inc(b = 2)._spec != spec and a._spec is spec
+    p = a.project(['x'])
+    assert p._projection == {'x': 1} and p.sort('x')._projection is p._projection
+    c = a.copy()
+    c.spec = dict(c = 1)
+    assert c._spec is not spec and '"c"' in str(c._spec)
+    c.pk = 'z'
+    assert c._pk == ['z']
+    assert all(vars(type(cursor)).get('__slots__') == () for cursor in (t, a, mongo_table('test', 'test', mode = 'r'))) ## the cached values live in slots
+    assert isinstance(vars(mongo_base_reader)['_spec_'], type(mongo_base_reader.collection))